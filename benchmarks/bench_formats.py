@@ -0,0 +1,65 @@
+import shutil
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from src.core.sample import Sample
+from src.core.writers import build_writer
+from src.utils.formatting import LabelFormatter
+
+# label rendering and the dataset writers of every output format. part of python -m benchmarks.run
+
+CLASS_MAP = {"helmet": 0, "vest": 1}
+
+def make_samples(n, boxes_per_image=5, size=640, image=None):
+    rng = np.random.default_rng(0)
+    samples = []
+    for i in range(n):
+        xy = rng.uniform(0, size * 0.7, (boxes_per_image, 2))
+        boxes = np.hstack([xy, xy + rng.uniform(8, size * 0.3, (boxes_per_image, 2))])
+        labels = ["helmet" if k % 2 else "vest" for k in range(boxes_per_image)]
+        sample = Sample(index=i, seed=i, prompt="benchmark")
+        sample.boxes = boxes.tolist()
+        sample.scores = rng.uniform(0.3, 1.0, boxes_per_image).tolist()
+        sample.labels = labels
+        sample.class_ids = [CLASS_MAP[label] for label in labels]
+        sample.image = image
+        samples.append(sample)
+    return samples
+
+def render_all(fmt, samples):
+    for s in samples:
+        LabelFormatter.render(fmt, s.boxes, s.labels, s.filename, 640, 640, CLASS_MAP, "jpg", s.class_ids)
+
+def write_all(config, samples):
+    # a fresh output dir every time, the writers append to what they find
+    output_dir = tempfile.mkdtemp(prefix="soda-bench-")
+    try:
+        config["project"]["output_dir"] = output_dir
+        writer = build_writer(config)
+        with writer:
+            for sample in samples:
+                writer.write(sample, 640, 640)
+        writer.finalize()
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def cases(scale):
+    render_sizes = [1_000, 10_000] if scale == "small" else [1_000, 100_000, 1_000_000]
+    for n in render_sizes:
+        samples = make_samples(n)
+        for fmt in LabelFormatter.EXTENSIONS:
+            yield f"formats/render/{fmt}/{n}", n, lambda fmt=fmt, s=samples: render_all(fmt, s)
+
+    # small images, so the numbers show the writers and not the jpeg encoder
+    image = Image.new("RGB", (64, 64), (90, 120, 150))
+    for n in ([1_000] if scale == "small" else [1_000, 10_000]):
+        samples = make_samples(n, image=image)
+        for layout, fmt in [("files", "yolo"), ("files", "voc"), ("files", "json"), ("files", "coco"), ("tar", "yolo"), ("tar", "coco")]:
+            config = {
+                "project": {},
+                "output": {"format": fmt, "layout": layout, "image_format": "jpg", "image_quality": 90, "shard_size": 1000},
+                "detection": {"class_map": CLASS_MAP}
+            }
+            yield f"formats/write/{layout}/{fmt}/{n}", n, lambda c=config, s=samples: write_all(c, s)
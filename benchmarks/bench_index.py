@@ -0,0 +1,79 @@
+import atexit
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from src.core.dataset_index import DatasetIndex
+
+# the dataset index of --stats: parsing label files into it, rescanning an unchanged output dir and
+# the queries on its columns. part of python -m benchmarks.run
+
+def label_dir(n, boxes_per_image=5):
+    # a yolo output dir with n label files, removed when the benchmarks exit
+    output_dir = tempfile.mkdtemp(prefix="soda-bench-")
+    atexit.register(shutil.rmtree, output_dir, True)
+    os.makedirs(os.path.join(output_dir, "labels"))
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        rows = rng.uniform(0.05, 0.5, (boxes_per_image, 4))
+        with open(os.path.join(output_dir, "labels", f"sample_{i:07d}.txt"), "w") as f:
+            f.write("\n".join(f"{k % 8} {r[0]:.6f} {r[1]:.6f} {r[2]:.6f} {r[3]:.6f}" for k, r in enumerate(rows)))
+    return output_dir
+
+def coco_index(images, boxes_per_image=5):
+    # an index of images * boxes_per_image boxes, from one coco file so it builds in seconds
+    output_dir = tempfile.mkdtemp(prefix="soda-bench-")
+    atexit.register(shutil.rmtree, output_dir, True)
+    rng = np.random.default_rng(0)
+    xywh = rng.uniform(0, 300, (images * boxes_per_image, 4)).round(2).tolist()
+    scores = rng.uniform(0.3, 1.0, images * boxes_per_image).round(4).tolist()
+    with open(os.path.join(output_dir, "annotations.json"), "w") as f:
+        json.dump({
+            "images": [{"id": i, "file_name": f"sample_{i:07d}.jpg", "width": 640, "height": 640} for i in range(images)],
+            "annotations": [
+                {"image_id": k // boxes_per_image, "category_id": k % 8, "bbox": box, "score": score}
+                for k, (box, score) in enumerate(zip(xywh, scores))
+            ]
+        }, f)
+    index = DatasetIndex(output_dir, workers=1)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        index.update()
+    return index
+
+def scan(output_dir):
+    shutil.rmtree(os.path.join(output_dir, "index"), ignore_errors=True)
+    # one process, the pool would measure the machine's core count
+    DatasetIndex(output_dir, workers=1).update()
+
+def indexed_label_dir(n):
+    # a label dir with its index built, what --stats finds on the second call
+    output_dir = label_dir(n)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        DatasetIndex(output_dir, workers=1).update()
+    return output_dir
+
+def query(index, fn):
+    # a fresh load every time, nothing cached from the last run
+    return fn(DatasetIndex(index.output_dir).load())
+
+def cases(scale):
+    for n in ([5_000] if scale == "small" else [100_000]):
+        output_dir = label_dir(n)
+        yield f"index/scan/yolo/{n}", n, lambda d=output_dir: scan(d)
+
+    # stat calls on every label file, bound by the file system. big enough that a few ms of noise
+    # don't move it by much
+    n = 50_000 if scale == "small" else 200_000
+    output_dir = indexed_label_dir(n)
+    yield f"index/rescan/{n}", n, lambda d=output_dir: DatasetIndex(d, workers=1).update(), False
+
+    images = 20_000 if scale == "small" else 200_000
+    index = coco_index(images)
+    boxes = images * 5
+    yield f"index/histogram/{boxes}", boxes, lambda: query(index, lambda i: i.class_histogram())
+    yield f"index/sizes/{boxes}", boxes, lambda: query(index, lambda i: i.size_stats())
+    yield f"index/where/{boxes}", boxes, lambda: query(index, lambda i: i.where("class=3 area<0.01 score>=0.5"))
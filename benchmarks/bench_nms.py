@@ -0,0 +1,75 @@
+import argparse
+
+import numpy as np
+
+from benchmarks.harness import best_of
+from src.utils.postprocessing import nms, batched_nms, filter_detections
+
+# compares the original per-image nms with batched_nms. run from the repo root:
+#   python -m benchmarks.bench_nms
+# the cases below are also part of python -m benchmarks.run
+
+def random_detections(n, rng, size=1024, num_classes=2, num_images=1):
+    xy = rng.uniform(0, size, (n, 2))
+    wh = rng.uniform(8, size / 4, (n, 2))
+    boxes = np.hstack([xy, np.minimum(xy + wh, size)])
+    scores = rng.uniform(0.0, 1.0, n)
+    classes = rng.integers(0, num_classes, n)
+    image_ids = rng.integers(0, num_images, n)
+    return boxes, scores, classes, image_ids
+
+def old_class_aware(boxes, scores, classes, image_ids):
+    # what the pipeline would need with the original nms: one call per image and class
+    keep = []
+    for key in set(zip(image_ids.tolist(), classes.tolist())):
+        idx = np.flatnonzero((image_ids == key[0]) & (classes == key[1]))
+        keep.extend(idx[nms(boxes[idx].tolist(), scores[idx].tolist())])
+    return keep
+
+def batch_results(samples, rng, boxes_per_image=20, size=1024):
+    # detector outputs as the pipeline hands them to filter_detections
+    results = []
+    for _ in range(samples):
+        boxes, scores, classes, _ = random_detections(boxes_per_image, rng, size=size)
+        results.append({
+            "boxes": boxes.tolist(),
+            "scores": scores.tolist(),
+            "labels": ["helmet" if c == 0 else "vest" for c in classes],
+            "class_ids": classes.tolist()
+        })
+    return results
+
+def cases(scale):
+    rng = np.random.default_rng(0)
+    sizes = [1_000, 10_000] if scale == "small" else [1_000, 10_000, 100_000, 1_000_000]
+    for n in sizes:
+        # about 100 candidate boxes per image, like an unthresholded detector
+        boxes, scores, classes, image_ids = random_detections(n, rng, num_images=max(1, n // 100))
+        yield f"nms/batched_nms/{n}", n, lambda b=boxes, s=scores, c=classes, i=image_ids: batched_nms(b, s, c, i)
+
+    nms_cfg = {"iou_threshold": 0.3, "per_class": {"vest": {"iou_threshold": 0.5}}}
+    for n in ([1_000] if scale == "small" else [1_000, 10_000, 100_000]):
+        results = batch_results(n, rng)
+        yield f"nms/filter_detections/{n}", n, lambda r=results: filter_detections(r, nms_cfg)
+
+def main():
+    parser = argparse.ArgumentParser(description="nms micro-benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--images", type=int, default=8, help="images the boxes are spread over")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'boxes':>8} {'nms':>12} {'class-aware nms':>16} {'batched_nms':>12} {'soft':>12} {'speedup':>8}")
+    for n in args.sizes:
+        boxes, scores, classes, image_ids = random_detections(n, rng, num_images=args.images)
+        t_old = best_of(lambda: nms(boxes.tolist(), scores.tolist()), args.repeats)
+        t_old_aware = best_of(lambda: old_class_aware(boxes, scores, classes, image_ids), args.repeats)
+        t_new = best_of(lambda: batched_nms(boxes, scores, classes, image_ids), args.repeats)
+        t_soft = best_of(lambda: batched_nms(boxes, scores, classes, image_ids, method="soft", score_threshold=0.05), 1)
+        print(f"{n:>8} {t_old * 1e3:>10.3f}ms {t_old_aware * 1e3:>14.3f}ms {t_new * 1e3:>10.3f}ms "
+              f"{t_soft * 1e3:>10.3f}ms {t_old_aware / t_new:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import copy
+import importlib.util
+import os
+import shutil
+import tempfile
+
+import yaml
+
+from src.core.factory import build_backends
+from src.core.pipeline import DatasetPipeline
+
+# what DatasetPipeline itself costs per sample: the fake backends return instantly, so everything
+# measured is scheduling, nms, encoding, label and manifest writes. part of python -m benchmarks.run
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+def base_config():
+    with open(CONFIG, "r") as f:
+        cfg = yaml.safe_load(f)
+    cfg["project"].update({"mode": "fake", "devices": None, "detector_device": None})
+    cfg["generation"].update({"seed": 1234, "target_saved": None, "batch_size": 1})
+    cfg["generation"]["params"].update({"width": 64, "height": 64})
+    cfg["system"].update({"optimize_gpu": False, "pipelined": False, "save_empty_images": True})
+    cfg["fake"] = {"generation_latency": 0.0, "detection_latency": 0.0, "min_boxes": 1, "max_boxes": 3}
+    cfg["instrumentation"] = {"enabled": True, "report_every": 0}
+    return cfg
+
+def run_pipeline(cfg, count):
+    cfg = copy.deepcopy(cfg)
+    output_dir = tempfile.mkdtemp(prefix="soda-bench-")
+    try:
+        cfg["project"]["output_dir"] = output_dir
+        cfg["generation"]["count"] = count
+        gen, det = build_backends(cfg)
+        pipeline = DatasetPipeline(generator=gen, detector=det, config=cfg)
+        pipeline.run(cfg["generation"]["prompt"], cfg["detection"]["prompt"], count)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def run_api(cfg, count):
+    # api mode against the local replicate stub, http and the api engine included
+    from src.testing.replicate_stub import ReplicateStub
+
+    os.environ.setdefault("REPLICATE_API_TOKEN", "stub")
+    with ReplicateStub(image_size=(64, 64), max_boxes=3) as stub:
+        cfg = copy.deepcopy(cfg)
+        cfg["project"]["mode"] = "api"
+        cfg["detection"]["prompt"] = "thread"
+        cfg["api"].update({"base_url": stub.base_url, "requests_per_second": 0})
+        run_pipeline(cfg, count)
+
+def cases(scale):
+    cfg = base_config()
+    sizes = [200] if scale == "small" else [1_000, 10_000]
+    for n in sizes:
+        yield f"pipeline/serial/{n}", n, lambda n=n: run_pipeline(cfg, n)
+
+        batched = copy.deepcopy(cfg)
+        batched["generation"]["batch_size"] = 8
+        yield f"pipeline/batch8/{n}", n, lambda n=n, c=batched: run_pipeline(c, n)
+
+        pipelined = copy.deepcopy(batched)
+        pipelined["system"]["pipelined"] = True
+        yield f"pipeline/pipelined/{n}", n, lambda n=n, c=pipelined: run_pipeline(c, n)
+
+        tar = copy.deepcopy(batched)
+        tar["output"].update({"layout": "tar", "format": "coco"})
+        yield f"pipeline/tar_coco/{n}", n, lambda n=n, c=tar: run_pipeline(c, n)
+
+        # every fake image is different, so this is the cost of hashing and querying alone
+        dedup = copy.deepcopy(batched)
+        dedup["dedup"] = {"enabled": True, "method": "phash", "max_distance": 6}
+        yield f"pipeline/dedup/{n}", n, lambda n=n, c=dedup: run_pipeline(c, n)
+
+    if importlib.util.find_spec("replicate") is None:
+        print("replicate isn't installed, skipping the api cases")
+        return
+    for n in ([50] if scale == "small" else [500]):
+        # mostly http round trips, not corrected for the machine's drift
+        yield f"pipeline/api_stub/{n}", n, lambda n=n: run_api(cfg, n), False
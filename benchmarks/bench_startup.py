@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# cold start of a fresh interpreter up to a ready pipeline, the cost every api mode container pays
+# before its first request. part of python -m benchmarks.run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules api mode must get along without, they may not even be installed
+HEAVY = ("torch", "diffusers", "transformers", "accelerate", "cv2")
+
+API_STARTUP = f"""
+import os, sys
+import main
+from src.core.factory import build_backends
+from src.core.pipeline import DatasetPipeline
+
+cfg = main.load_config()
+cfg["project"].update({{"mode": "api", "output_dir": os.environ["SODA_BENCH_OUTPUT"]}})
+cfg["detection"]["prompt"] = "thread"
+gen, det = build_backends(cfg)
+DatasetPipeline(generator=gen, detector=det, config=cfg)
+heavy = [m for m in {HEAVY!r} if m in sys.modules]
+if heavy:
+    sys.exit("api mode imported " + ", ".join(heavy))
+"""
+
+def run_python(code):
+    # the pipeline makes its output dirs up front, they go to a throwaway dir
+    with tempfile.TemporaryDirectory(prefix="soda-bench-") as output_dir:
+        env = dict(os.environ, SODA_BENCH_OUTPUT=output_dir, REPLICATE_API_TOKEN=os.environ.get("REPLICATE_API_TOKEN", "stub"))
+        result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"startup failed: {result.stderr.strip()}")
+
+def cases(scale):
+    yield "startup/python", 1, lambda: run_python("pass")
+    yield "startup/import_main", 1, lambda: run_python("import main")
+    yield "startup/api_pipeline", 1, lambda: run_python(API_STARTUP)
@@ -0,0 +1,36 @@
+import random
+
+from src.utils.prompting import PromptTemplate, compile_template, process_wildcards
+from src.utils.seeding import derive_seed
+
+# wildcard parsing, expansion and scheduling. part of python -m benchmarks.run
+
+PROMPT = (
+    "Close up view of sewing essentials on a {fabric tablecloth|wooden table::2|{dark|light} marble counter}. "
+    "A {$color=red|blue::3|white|{pale|deep} green} spool of thread sits next to a {silver metal|ceramic} thimble "
+    "and a {$color} pin cushion. {Soft diffused light|Hard shadow from lamp|golden hour sun}, "
+    "{loose thread strand|neat}, {vintage|modern|rustic} vibe."
+)
+
+def cases(scale):
+    sizes = [1_000, 10_000] if scale == "small" else [1_000, 10_000, 100_000, 1_000_000]
+    template = compile_template(PROMPT)
+
+    # parsing, with a different text every time so nothing comes from the template cache
+    n = 1_000
+    yield f"wildcards/compile/{n}", n, lambda: [PromptTemplate(f"{PROMPT} #{i}") for i in range(n)]
+
+    for n in sizes:
+        def expand(n=n):
+            rng = random.Random(0)
+            for _ in range(n):
+                process_wildcards(PROMPT, rng)
+        yield f"wildcards/process_wildcards/{n}", n, expand
+
+        def seeded(n=n):
+            # what the pipeline does per sample in random sampling: an rng from the master seed and index
+            for i in range(n):
+                template.render(template.sample_index(random.Random(derive_seed(1234, i))))
+        yield f"wildcards/seeded_render/{n}", n, seeded
+
+        yield f"wildcards/stratified/{n}", n, lambda n=n: template.schedule("stratified", n, random.Random(0))
@@ -0,0 +1,86 @@
+import contextlib
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+# shared by the benchmark suites. a suite is a module with cases(scale) yielding (name, items, fn):
+# fn runs the measured work once over items samples, boxes or prompts. cases bound by io or sleeps
+# rather than the cpu yield (name, items, fn, False), they aren't corrected for the machine's drift
+
+SCALES = ("small", "full")
+
+def best_of(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_cases(cases, repeats):
+    results = {}
+    for name, items, fn, *cpu_bound in cases:
+        # the pipeline's progress logs would end up in the numbers and bury the table
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            # cases taking seconds run once, fast ones are repeated for about half a second, their
+            # best time is far less noisy than one run
+            seconds = best_of(fn, 1)
+            if seconds < 1.0:
+                seconds = min(seconds, best_of(fn, min(100, max(repeats - 1, int(0.5 / max(seconds, 1e-6))))))
+        results[name] = {
+            "items": items,
+            "seconds": seconds,
+            "us_per_item": 1e6 * seconds / items,
+            "cpu_bound": cpu_bound[0] if cpu_bound else True
+        }
+        print(f"{name:<40} {items:>9} {1e3 * seconds:>11.2f}ms {1e6 * seconds / items:>11.2f}us/item", flush=True)
+    return results
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_baseline(path, results):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    baseline = {
+        "machine": platform.platform(),
+        "python": platform.python_version(),
+        "results": {name: {"items": r["items"], "seconds": r["seconds"], "cpu_bound": r.get("cpu_bound", True)} for name, r in results.items()}
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    print(f"baseline with {len(results)} cases written to {path}")
+
+# cases that aren't cpu bound wait on the file system or sockets and can't be corrected for drift,
+# their tolerance is this many times the cpu bound one
+IO_TOLERANCE = 1.5
+
+def compare(results, baseline, tolerance):
+    # a case regressed when it got slower than the others by more than tolerance. the median change of
+    # every case is taken as the machine's drift since the baseline (load, clocks, another box), a real
+    # regression only moves a few cases. returns the names of the regressed cases
+    ratios = {name: r["seconds"] / baseline["results"][name]["seconds"] for name, r in results.items() if name in baseline["results"]}
+    cpu_ratios = [ratio for name, ratio in ratios.items() if results[name]["cpu_bound"]]
+    drift = float(np.median(cpu_ratios)) if len(cpu_ratios) >= 5 else 1.0
+    print(f"\nmachine drift since the baseline: {100 * (drift - 1):+.0f}%")
+    if drift > 1 + tolerance:
+        print("every case got slower. either the machine is busy or the regression is in code all of them share")
+
+    regressed = []
+    print(f"\n{'case':<40} {'baseline':>11} {'now':>11} {'change':>8}")
+    for name, r in results.items():
+        if name not in ratios:
+            print(f"{name:<40} {'-':>11} {1e3 * r['seconds']:>9.2f}ms      new")
+            continue
+        change = ratios[name] / (drift if r["cpu_bound"] else 1.0) - 1
+        flag = ""
+        if change > tolerance * (1 if r["cpu_bound"] else IO_TOLERANCE):
+            flag = "  REGRESSED"
+            regressed.append(name)
+        print(f"{name:<40} {1e3 * baseline['results'][name]['seconds']:>9.2f}ms {1e3 * r['seconds']:>9.2f}ms {100 * change:>+7.0f}%{flag}")
+    return regressed
@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+
+from benchmarks import bench_formats, bench_index, bench_nms, bench_pipeline, bench_startup, bench_wildcards
+from benchmarks.harness import SCALES, compare, load_baseline, run_cases, save_baseline
+
+# offline benchmark suite, no gpu, models or network needed. run from the repo root:
+#   python -m benchmarks.run                      # small scale, compared with benchmarks/baselines/small.json
+#   python -m benchmarks.run --scale full         # up to 1M samples, takes a while
+#   python -m benchmarks.run --suite nms formats
+#   python -m benchmarks.run --save-baseline --rounds 3    # after an intended change in performance
+# exits with 1 when a case got slower than its baseline by more than --tolerance
+
+SUITES = {
+    "pipeline": bench_pipeline,
+    "nms": bench_nms,
+    "wildcards": bench_wildcards,
+    "formats": bench_formats,
+    "startup": bench_startup,
+    "index": bench_index
+}
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks of the pipeline, nms, wildcards, output formats, startup and the dataset index")
+    parser.add_argument("--suite", nargs="+", choices=list(SUITES), default=list(SUITES))
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=1, help="passes over every suite, the median one counts. use 3 or more for a baseline")
+    parser.add_argument("--baseline", default=None, help="baseline file, defaults to benchmarks/baselines/<scale>.json")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown before a case counts as regressed")
+    args = parser.parse_args()
+
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f"{args.scale}.json")
+    print(f"scale: {args.scale}\n")
+
+    rounds = []
+    for round_ in range(max(1, args.rounds)):
+        if args.rounds > 1:
+            print(f"\nround {round_ + 1}/{args.rounds}")
+        results = {}
+        for name in args.suite:
+            results.update(run_cases(SUITES[name].cases(args.scale), args.repeats))
+        rounds.append(results)
+    # the median round of every case, a lucky fast run shouldn't become the baseline
+    results = {case: sorted((r[case] for r in rounds), key=lambda r: r["seconds"])[len(rounds) // 2] for case in rounds[0]}
+
+    if args.save_baseline:
+        # cases of suites that didn't run this time are kept
+        baseline = load_baseline(baseline_path)
+        kept = {name: r for name, r in (baseline or {}).get("results", {}).items() if name not in results}
+        save_baseline(baseline_path, {**kept, **results})
+        return
+
+    baseline = load_baseline(baseline_path)
+    if baseline is None:
+        print(f"\nno baseline in {baseline_path}. store one with --save-baseline")
+        return
+    print(f"baseline from {baseline['machine']}, python {baseline['python']}")
+    regressed = compare(results, baseline, args.tolerance)
+    if regressed:
+        print(f"\n{len(regressed)} cases regressed by more than {100 * args.tolerance:.0f}%: {', '.join(regressed)}")
+        sys.exit(1)
+    print("\nno regressions")
+
+if __name__ == "__main__":
+    main()
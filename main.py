@@ -1,20 +1,73 @@
+import argparse
 import yaml
 import os
 import sys
 
-from src.core.generators import LocalGenerator, ApiGenerator
-from src.core.detectors import LocalDetector, ApiDetector
+from src.core.factory import MODES, build_backends, build_detector
 from src.core.pipeline import DatasetPipeline
+from src.core.sharding import run_sharded, shard_devices
 
 
 def load_config(path="config.yaml"):
     with open(path, "r") as f:
         return yaml.safe_load(f)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="generate and auto-label a synthetic object detection dataset")
+    parser.add_argument("--config", default="config.yaml", help="path to the config file")
+    parser.add_argument("--resume", action="store_true", help="continue the run recorded in the output dir's manifest")
+    parser.add_argument("--relabel", action="store_true", help="rebuild labels of the run in the output dir from its raw detection cache, without loading any model")
+    parser.add_argument("--relabel-output", default=None, help="where relabeled output goes, defaults to <output_dir>_relabel")
+    parser.add_argument("--detect", default=None, metavar="SOURCE", help="only label existing images, from a directory or a glob pattern like 'photos/**/*.jpg'")
+    parser.add_argument("--stats", nargs="?", const="", default=None, metavar="DIR", help="index the labels of an output dir (the config's by default) and print class and box size stats")
+    parser.add_argument("--where", default=None, metavar="EXPR", help="with --stats, list the images matching e.g. 'class=helmet area<0.01' or 'empty'")
+    parser.add_argument("--serve", action="store_true", help="load the models once and run jobs submitted with --submit")
+    parser.add_argument("--submit", action="store_true", help="run this config as a job on the model server instead of loading the models here")
+    parser.add_argument("--jobs", default=None, metavar="SPEC", help="run every job of a job spec file (yaml or jsonl) against one load of the models")
+    parser.add_argument("--detach", action="store_true", help="with --submit, return once the job is queued instead of following it")
+    return parser.parse_args()
+
 def main():
-    cfg = load_config()
+    args = parse_args()
+    cfg = load_config(args.config)
     mode = cfg["project"]["mode"]
     
+    if args.relabel:
+        from src.core.relabel import relabel
+
+        try:
+            relabel(cfg, output_dir=args.relabel_output)
+        except ValueError as e:
+            print(f"error: {e}")
+            sys.exit(1)
+        return
+    
+    if args.stats is not None or args.where:
+        from src.core.dataset_index import run_stats
+
+        try:
+            run_stats(cfg, output_dir=args.stats or None, where=args.where)
+        except ValueError as e:
+            print(f"error: {e}")
+            sys.exit(1)
+        return
+    
+    if args.submit:
+        from src.core.client import ServerClient, job_from_config, server_url
+
+        client = ServerClient(server_url(cfg))
+        try:
+            job = client.submit(job_from_config(cfg, resume=args.resume))
+            print(f"job {job['id']} submitted to {client.url}")
+            if not args.detach:
+                job = client.follow(job["id"])
+        except (ValueError, ConnectionError) as e:
+            print(f"error: {e}")
+            sys.exit(1)
+        if job["status"] == "failed":
+            sys.exit(1)
+        return
+    
     if mode == "api":
         token = os.environ.get("REPLICATE_API_TOKEN")
         if not token:
@@ -24,31 +77,85 @@ def main():
     print(f"initializing prompt-to-dataset in '{mode}' mode...")
 
     if mode == "api":
-        gen = ApiGenerator(
-            model_id=cfg["generation"]["api_model_id"],
-            gen_params=cfg["generation"]["params"]
-        )
-        det = ApiDetector(
-            model_id=cfg["detection"]["api_model_id"],
-            box_threshold=cfg["detection"]["box_threshold"],
-            text_threshold=cfg["detection"]["text_threshold"]
-        )
-    elif mode == "local":
-        gen = LocalGenerator(
-            model_id=cfg["generation"]["local_model_id"],
-            device=cfg["project"]["device"],
-            optimize_gpu=cfg["system"]["optimize_gpu"],
-            gen_params=cfg["generation"]["params"]
-        )
-        det = LocalDetector(
-            model_id=cfg["detection"]["local_model_id"],
-            device=cfg["project"]["device"],
-            box_threshold=cfg["detection"]["box_threshold"],
-            text_threshold=cfg["detection"]["text_threshold"]
-        )
-    else:
+        from src.core.detectors import ApiDetector
+
+        try:
+            ApiDetector.parse_classes(cfg["detection"]["prompt"])
+        except ValueError as e:
+            print(f"\nERROR: {e}")
+            print("please use local mode for multi-class, or stick to a single class in api mode.")
+            sys.exit(1)
+            
+    if mode not in MODES:
         print(f"error: unknown mode '{mode}'")
         sys.exit(1)
+        
+    if args.serve:
+        from src.core.server import ModelServer
+
+        try:
+            ModelServer.from_config(cfg).load().serve_forever()
+        except ValueError as e:
+            print(f"error: {e}")
+            sys.exit(1)
+        return
+        
+    if args.jobs:
+        from src.core.multijob import job_configs, load_spec, run_jobs
+
+        try:
+            spec = load_spec(args.jobs)
+            # bad specs fail before any model is loaded
+            job_configs(cfg, spec)
+        except (OSError, ValueError) as e:
+            print(f"error: {e}")
+            sys.exit(1)
+        devices = shard_devices(cfg)
+        if len(devices) > 1:
+            print(f"jobs share one load of the models, using {devices[0]}")
+        gen, det = build_backends(
+            cfg,
+            device=devices[0] if devices else None,
+            detector_device=cfg["project"].get("detector_device")
+        )
+        jobs = run_jobs(gen, det, cfg, spec, resume=args.resume)
+        if any(job["status"] == "failed" for job in jobs):
+            sys.exit(1)
+        return
+        
+    if args.detect:
+        from src.core.detect_only import DetectOnlyRunner
+
+        devices = shard_devices(cfg)
+        # nothing else shares the card, the detector stays loaded between batches
+        det = build_detector(cfg, device=cfg["project"].get("detector_device") or (devices[0] if devices else None), keep_resident=True)
+        try:
+            DetectOnlyRunner(det, cfg).run(args.detect)
+        except ValueError as e:
+            print(f"error: {e}")
+            sys.exit(1)
+        return
+        
+    devices = shard_devices(cfg)
+    if cfg["generation"].get("target_saved") and len(devices) > 1:
+        # the yield schedule is shared state, shards would each chase the whole target
+        print(f"target_saved runs on a single device, using {devices[0]}")
+        devices = devices[:1]
+    if mode != "api" and len(devices) > 1:
+        run_sharded(
+            cfg,
+            gen_prompt=cfg["generation"]["prompt"],
+            det_prompt=cfg["detection"]["prompt"],
+            count=cfg["generation"]["count"],
+            resume=args.resume
+        )
+        return
+
+    gen, det = build_backends(
+        cfg,
+        device=devices[0] if devices else None,
+        detector_device=cfg["project"].get("detector_device")
+    )
 
     pipeline = DatasetPipeline(
         generator=gen,
@@ -59,7 +166,8 @@ def main():
     pipeline.run(
         gen_prompt=cfg["generation"]["prompt"],
         det_prompt=cfg["detection"]["prompt"],
-        count=cfg["generation"]["count"]
+        count=cfg["generation"]["count"],
+        resume=args.resume
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class ApiEngine:
+    def __init__(self, concurrency=4):
+        self.concurrency = max(1, int(concurrency))
+
+    def map(self, process, items):
+        # keeps up to `concurrency` items in flight and yields (item, result, error) as they finish
+        items = iter(items)
+        pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="api")
+        pending = {}
+        try:
+            while True:
+                while len(pending) < self.concurrency:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    pending[pool.submit(process, item)] = item
+                    
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    err = future.exception()
+                    yield item, (None if err else future.result()), err
+        finally:
+            # on errors or ctrl-c queued requests are dropped, running ones are allowed to finish
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -6,7 +6,15 @@ class BaseGenerator(ABC):
     def generate(self, prompt: str, seed: int = None) -> Image.Image:
         pass
 
+    def generate_batch(self, prompts: list, seeds: list) -> list:
+        # fallback for generators that can't batch, one call per image
+        return [self.generate(prompt, seed=seed) for prompt, seed in zip(prompts, seeds)]
+
 class BaseDetector(ABC):
     @abstractmethod
     def detect(self, image: Image.Image, text_prompt: str) -> dict:
-        pass
\ No newline at end of file
+        pass
+
+    def detect_batch(self, images: list, text_prompt: str) -> list:
+        # fallback for detectors that can't batch, one call per image
+        return [self.detect(image, text_prompt) for image in images]
@@ -0,0 +1,92 @@
+import getpass
+import json
+import os
+import urllib.error
+import urllib.request
+
+# thin client of the model server (server.py), only the standard library so submitting a job
+# doesn't need torch or the models
+
+# job fields and where they live in the config. everything else is the server's
+JOB_KEYS = {
+    "prompt": ("generation", "prompt"),
+    "detection_prompt": ("detection", "prompt"),
+    "count": ("generation", "count"),
+    "seed": ("generation", "seed"),
+    "target_saved": ("generation", "target_saved"),
+    "sampling": ("generation", "sampling"),
+    "batch_size": ("generation", "batch_size"),
+    "class_map": ("detection", "class_map"),
+    "output_dir": ("project", "output_dir"),
+    "format": ("output", "format"),
+    "layout": ("output", "layout"),
+    "image_format": ("output", "image_format")
+}
+
+def server_url(cfg):
+    server_cfg = cfg.get("server") or {}
+    return f"http://{server_cfg.get('host', '127.0.0.1')}:{server_cfg.get('port', 8760)}"
+
+def job_from_config(cfg, resume=False):
+    job = {key: cfg[section].get(name) for key, (section, name) in JOB_KEYS.items() if name in cfg.get(section, {})}
+    # the server may run somewhere else on disk
+    job["output_dir"] = os.path.abspath(job["output_dir"])
+    job["resume"] = resume
+    job["client"] = getpass.getuser()
+    return job
+
+class ServerClient:
+    def __init__(self, url, timeout=10.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def jobs(self):
+        return self._request("GET", "/jobs")
+
+    def job(self, job_id):
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def submit(self, job):
+        return self._request("POST", "/jobs", job)
+
+    def cancel(self, job_id):
+        return self._request("DELETE", f"/jobs/{job_id}")
+
+    def events(self, job_id, since=0):
+        # yields the job's events as they happen: log lines, progress after every batch and
+        # status changes. ends when the job has finished, failed or was cancelled
+        response = self._open("GET", f"/jobs/{job_id}/events?since={since}", timeout=None)
+        with response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+
+    def follow(self, job_id):
+        # prints the job's output like a local run would, returns its final state
+        for event in self.events(job_id):
+            if event["type"] == "log":
+                print(event["line"], flush=True)
+            elif event["type"] == "status":
+                print(f"job {job_id} {event['status']}" + (f": {event['error']}" if event.get("error") else ""), flush=True)
+        return self.job(job_id)
+
+    def _request(self, method, path, payload=None):
+        with self._open(method, path, payload) as response:
+            return json.loads(response.read())
+
+    def _open(self, method, path, payload=None, timeout=-1):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(f"{self.url}{path}", data=data, method=method, headers={"Content-Type": "application/json"})
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout if timeout == -1 else timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error")
+            except ValueError:
+                message = None
+            raise ValueError(message or f"server returned {e.code}") from e
+        except urllib.error.URLError as e:
+            raise ConnectionError(f"no model server at {self.url} ({e.reason}). start one with: python main.py --serve") from e
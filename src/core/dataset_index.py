@@ -0,0 +1,498 @@
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import tarfile
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.utils.formatting import LabelFormatter
+
+# columnar index of every label under an output dir, so class counts, box sizes and filters don't
+# walk millions of label files each time. <output_dir>/index holds one .npy per column, read
+# memory mapped:
+#   box_image.npy    int32    image id of every box
+#   box_class.npy    int32    class id, -1 for names the class_map doesn't know
+#   box_xywh.npy     float32  (boxes, 4) normalized cx, cy, w, h
+#   box_score.npy    float32  nan where the format keeps no scores (all but coco)
+#   image_boxes.npy  int32    boxes per image, 0 for empty images
+#   image_size.npy   int32    (images, 2) width, height, 0 where the format doesn't say (yolo)
+#   images.txt       image names, the line number is the image id
+#   sources.txt      every label file, coco annotations.json and tar shard that was parsed
+#   sources.npy      int64    (sources, 4) their mtime_ns, size, first image id and image count
+#   class_map.txt    hash of the class_map the names were resolved with
+# an update only parses sources that are new or changed, the rows of the others are carried over.
+# a different class_map parses everything again, voc, json and coco names resolve through it
+
+LABEL_FORMATS = {ext: fmt for fmt, ext in LabelFormatter.EXTENSIONS.items()}
+# dirs that never hold labels, skipped without listing them
+SKIP_DIRS = {"images", "debug", "raw", "metrics", "dedup", "index", "index.tmp", "index.old"}
+
+# box sizes as sqrt(area) relative to the image, coco's 32 and 96 px limits at 640 px
+SIZE_BUCKETS = (("small", 0.05), ("medium", 0.15), ("large", math.inf))
+
+WHERE_TERM = re.compile(r"^(\w+)\s*(<=|>=|!=|=|<|>)\s*(\S+)$")
+BOX_KEYS = ("class", "cx", "cy", "w", "h", "area", "score")
+OPS = {"=": np.equal, "!=": np.not_equal, "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal}
+
+def find_sources(root):
+    # {relative path: (kind, mtime_ns, size)}. kinds: label (one file per image, under a labels
+    # dir), coco (annotations.json) and tar (shards/*.tar)
+    sources = {}
+
+    def walk(path, rel, in_labels):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
+        for entry in entries:
+            entry_rel = f"{rel}{entry.name}"
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in SKIP_DIRS:
+                    walk(entry.path, f"{entry_rel}/", in_labels or entry.name == "labels")
+                continue
+            ext = entry.name.rsplit(".", 1)[-1].lower()
+            if in_labels and ext in LABEL_FORMATS:
+                kind = "label"
+            elif entry.name == "annotations.json" and not in_labels:
+                kind = "coco"
+            elif ext == "tar" and rel.endswith("shards/"):
+                kind = "tar"
+            else:
+                continue
+            stat = entry.stat()
+            sources[entry_rel] = (kind, stat.st_mtime_ns, stat.st_size)
+
+    walk(root, "", False)
+    return sources
+
+def _class_id(value, names):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return names.get(str(value).strip().lower(), -1)
+
+def _normalized(x1, y1, x2, y2, width, height):
+    if not width or not height:
+        return (math.nan,) * 4
+    return ((x1 + x2) / 2 / width, (y1 + y2) / 2 / height, (x2 - x1) / width, (y2 - y1) / height)
+
+def _parse_label(text, fmt, names):
+    # (width, height, [(class, cx, cy, w, h, score)]) of one label file in a LabelFormatter format
+    rows = []
+    if fmt == "yolo":
+        for line in text.splitlines():
+            parts = line.split()
+            if len(parts) < 5:
+                continue
+            # a sixth column is a confidence, as some tools write it
+            score = float(parts[5]) if len(parts) == 6 else math.nan
+            rows.append((_class_id(parts[0].split(".")[0], names), *map(float, parts[1:5]), score))
+        return 0, 0, rows
+
+    if fmt == "voc":
+        root = ET.fromstring(text)
+        width = int(float(root.findtext("size/width") or 0))
+        height = int(float(root.findtext("size/height") or 0))
+        for obj in root.iter("object"):
+            # written as bbox here, bndbox in pascal voc itself
+            box = obj.find("bbox") if obj.find("bbox") is not None else obj.find("bndbox")
+            coords = [float(box.findtext(k)) for k in ("xmin", "ymin", "xmax", "ymax")]
+            rows.append((_class_id(obj.findtext("name"), names), *_normalized(*coords, width, height), math.nan))
+        return width, height, rows
+
+    data = json.loads(text)
+    width, height = int(data.get("width") or 0), int(data.get("height") or 0)
+    for annotation in data.get("annotations", []):
+        rows.append((_class_id(annotation.get("label"), names), *_normalized(*annotation["bbox"], width, height), annotation.get("score", math.nan)))
+    return width, height, rows
+
+def _image_name(rel):
+    # labels/sub/a.txt -> sub/a, job/labels/a.txt -> job/a
+    stem = rel.rsplit(".", 1)[0]
+    return "/".join(part for part in stem.split("/") if part != "labels")
+
+def _parse_coco(path, prefix, names):
+    with open(path, "r") as f:
+        data = json.load(f)
+    rows_of = {}
+    for annotation in data.get("annotations", []):
+        rows_of.setdefault(annotation["image_id"], []).append(annotation)
+    for image in data.get("images", []):
+        width, height = int(image.get("width") or 0), int(image.get("height") or 0)
+        rows = []
+        for annotation in rows_of.get(image["id"], []):
+            x, y, w, h = annotation["bbox"]
+            rows.append((_class_id(annotation.get("category_id"), names), *_normalized(x, y, x + w, y + h, width, height), annotation.get("score", math.nan)))
+        yield f"{prefix}{os.path.splitext(image['file_name'])[0]}", width, height, rows
+
+def _parse_tar(path, prefix, names):
+    with tarfile.open(path, "r") as tar:
+        for member in tar:
+            stem, _, ext = member.name.rpartition(".")
+            if not member.isfile() or ext not in LABEL_FORMATS:
+                continue
+            text = tar.extractfile(member).read().decode("utf-8")
+            yield (f"{prefix}{stem}", *_parse_label(text, LABEL_FORMATS[ext], names))
+
+def _parse_sources(root, items, names):
+    # runs in the worker processes. items are (relative path, kind), the result is packed into
+    # arrays so little has to be pickled back
+    image_names, sizes, counts, per_source, rows, errors = [], [], [], [], [], []
+    for rel, kind in items:
+        path = os.path.join(root, rel)
+        before = len(image_names)
+        try:
+            if kind == "label":
+                with open(path, "r") as f:
+                    parsed = [(_image_name(rel), *_parse_label(f.read(), LABEL_FORMATS[rel.rsplit(".", 1)[-1].lower()], names))]
+            else:
+                # images of a coco file or a shard are named after the dirs above the run's dir
+                dirs = rel.split("/")[:-2 if kind == "tar" else -1]
+                prefix = "".join(f"{d}/" for d in dirs)
+                parsed = list((_parse_coco if kind == "coco" else _parse_tar)(path, prefix, names))
+        except (OSError, ValueError, KeyError, TypeError, ET.ParseError, tarfile.TarError) as e:
+            errors.append((rel, str(e)))
+            parsed = []
+        for name, width, height, image_rows in parsed:
+            image_names.append(name)
+            sizes.append((width, height))
+            counts.append(len(image_rows))
+            rows.extend(image_rows)
+        per_source.append(len(image_names) - before)
+
+    table = np.asarray(rows, dtype=np.float64).reshape(-1, 6)
+    return {
+        "names": image_names,
+        "size": np.asarray(sizes, dtype=np.int32).reshape(-1, 2),
+        "boxes": np.asarray(counts, dtype=np.int32),
+        "per_source": per_source,
+        "class": table[:, 0].astype(np.int32),
+        "xywh": table[:, 1:5].astype(np.float32),
+        "score": table[:, 5].astype(np.float32),
+        "errors": errors
+    }
+
+class DatasetIndex:
+    COLUMNS = ("box_image", "box_class", "box_xywh", "box_score", "image_boxes", "image_size")
+
+    def __init__(self, output_dir, workers=None, chunk_size=1000, class_map=None):
+        self.output_dir = output_dir
+        self.dir = os.path.join(output_dir, "index")
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = max(1, int(chunk_size))
+        self.class_map = class_map or {}
+        self._names = None
+        self._by_class = None
+        self.columns = None
+
+    @classmethod
+    def from_config(cls, output_dir, stats_cfg, class_map=None):
+        return cls(
+            output_dir,
+            workers=stats_cfg.get("workers"),
+            chunk_size=stats_cfg.get("chunk_size", 1000),
+            class_map=class_map
+        )
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.dir, "sources.npy"))
+
+    def load(self):
+        # the columns stay on disk, numpy pages in what a query touches
+        self.columns = {name: np.load(os.path.join(self.dir, f"{name}.npy"), mmap_mode="r") for name in self.COLUMNS}
+        self._names = None
+        self._by_class = None
+        return self
+
+    @property
+    def names(self):
+        if self._names is None:
+            with open(os.path.join(self.dir, "images.txt"), "r") as f:
+                self._names = f.read().splitlines()
+        return self._names
+
+    def update(self):
+        # scans output_dir and parses what changed since the last update. returns how many
+        # sources were parsed
+        if not os.path.isdir(self.output_dir):
+            raise ValueError(f"no output dir at {self.output_dir}")
+        start = time.time()
+        found = find_sources(self.output_dir)
+        old_sources, old_meta = self._load_sources()
+
+        current = np.asarray([found.get(rel, (None, -1, -1))[1:] for rel in old_sources], dtype=np.int64).reshape(-1, 2)
+        kept = np.flatnonzero((current == old_meta[:, :2]).all(axis=1)).tolist()
+        if old_sources and self._stored_class_map() != self._class_map_hash():
+            print(f"class_map changed since the index of {self.output_dir} was built, parsing every label source again")
+            kept = []
+        kept_rels = {old_sources[k] for k in kept}
+        # new images get their ids in path order
+        stale = sorted(rel for rel in found if rel not in kept_rels)
+        if not stale and len(kept) == len(old_sources):
+            print(f"index of {self.output_dir} is up to date ({len(found)} label sources)")
+            self.load()
+            return 0
+
+        tasks, parsed = self._parse(stale, found)
+        self._write(old_sources, old_meta, kept, found, tasks, parsed)
+        errors = [e for chunk in parsed for e in chunk["errors"]]
+        for rel, err in errors[:10]:
+            print(f"can't parse {rel}: {err}")
+        if len(errors) > 10:
+            print(f"... {len(errors) - 10} more label sources can't be parsed")
+        print(f"index of {self.output_dir} updated in {time.time() - start:.1f}s: {len(stale)} label sources parsed, "
+              f"{len(kept)} unchanged, {len(old_sources) - len(kept)} changed or gone")
+        self.load()
+        return len(stale)
+
+    def _load_sources(self):
+        if not self.exists():
+            return [], np.zeros((0, 4), dtype=np.int64)
+        with open(os.path.join(self.dir, "sources.txt"), "r") as f:
+            rels = f.read().splitlines()
+        return rels, np.load(os.path.join(self.dir, "sources.npy"))
+
+    def _class_map_hash(self):
+        names = sorted((str(k).strip().lower(), int(v)) for k, v in self.class_map.items())
+        return hashlib.sha1(json.dumps(names).encode()).hexdigest()
+
+    def _stored_class_map(self):
+        path = os.path.join(self.dir, "class_map.txt")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return f.read().strip()
+
+    def _parse(self, rels, found):
+        names = {str(k).strip().lower(): v for k, v in self.class_map.items()}
+        # label files go in chunks of chunk_size, every coco file and shard is a task of its own
+        files = [(rel, "label") for rel in rels if found[rel][0] == "label"]
+        tasks = [files[k:k + self.chunk_size] for k in range(0, len(files), self.chunk_size)]
+        tasks += [[(rel, found[rel][0])] for rel in rels if found[rel][0] != "label"]
+        if not tasks:
+            return [], []
+
+        workers = min(self.workers, len(tasks))
+        print(f"parsing {len(rels)} label sources" + (f" with {workers} processes..." if workers > 1 else "..."))
+        if workers == 1:
+            return tasks, [_parse_sources(self.output_dir, task, names) for task in tasks]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return tasks, list(pool.map(_parse_sources, [self.output_dir] * len(tasks), tasks, [names] * len(tasks)))
+
+    def _write(self, old_sources, old_meta, kept, found, tasks, parsed):
+        # rows of unchanged sources are carried over with their image ids renumbered, then the
+        # parsed ones are appended. the new index is written next to the old one and swapped in
+        old = self.load().columns if self.exists() else None
+        if old is not None and kept:
+            firsts, counts = old_meta[kept, 2], old_meta[kept, 3]
+            keep_image = np.zeros(len(old["image_boxes"]), dtype=bool)
+            # the image ids of every kept source, first to first + count
+            keep_image[np.repeat(firsts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())] = True
+            new_id = (np.cumsum(keep_image) - 1).astype(np.int32)
+            keep_box = keep_image[old["box_image"]]
+            names = [name for name, keep in zip(self.names, keep_image) if keep]
+            columns = {
+                "box_image": [new_id[old["box_image"][keep_box]]],
+                "box_class": [old["box_class"][keep_box]],
+                "box_xywh": [old["box_xywh"][keep_box]],
+                "box_score": [old["box_score"][keep_box]],
+                "image_boxes": [old["image_boxes"][keep_image]],
+                "image_size": [old["image_size"][keep_image]]
+            }
+            sources = [old_sources[k] for k in kept]
+            meta = old_meta[kept].copy()
+            # sources are stored in the order of their image ids, so are the kept ones
+            meta[:, 2] = np.cumsum(counts) - counts
+            meta = [meta]
+        else:
+            names, sources, meta = [], [], []
+            columns = {"box_image": [], "box_class": [], "box_xywh": [], "box_score": [], "image_boxes": [], "image_size": []}
+
+        for task, chunk in zip(tasks, parsed):
+            first = len(names)
+            columns["box_image"].append(np.repeat(np.arange(first, first + len(chunk["names"]), dtype=np.int32), chunk["boxes"]))
+            columns["box_class"].append(chunk["class"])
+            columns["box_xywh"].append(chunk["xywh"])
+            columns["box_score"].append(chunk["score"])
+            columns["image_boxes"].append(chunk["boxes"])
+            columns["image_size"].append(chunk["size"])
+            names.extend(chunk["names"])
+            rows = []
+            for (rel, _), count in zip(task, chunk["per_source"]):
+                sources.append(rel)
+                rows.append((found[rel][1], found[rel][2], first, count))
+                first += count
+            meta.append(np.asarray(rows, dtype=np.int64).reshape(-1, 4))
+
+        empty = {"box_image": (0,), "box_class": (0,), "box_xywh": (0, 4), "box_score": (0,), "image_boxes": (0,), "image_size": (0, 2)}
+        dtypes = {"box_image": np.int32, "box_class": np.int32, "box_xywh": np.float32, "box_score": np.float32, "image_boxes": np.int32, "image_size": np.int32}
+        tmp = f"{self.dir}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, parts in columns.items():
+            array = np.concatenate(parts) if parts else np.zeros(empty[name])
+            np.save(os.path.join(tmp, f"{name}.npy"), array.astype(dtypes[name], copy=False))
+        np.save(os.path.join(tmp, "sources.npy"), np.concatenate(meta) if meta else np.zeros((0, 4), dtype=np.int64))
+        for filename, lines in (("images.txt", names), ("sources.txt", sources), ("class_map.txt", [self._class_map_hash()])):
+            with open(os.path.join(tmp, filename), "w") as f:
+                f.write("".join(f"{line}\n" for line in lines))
+
+        # the old columns may still be mapped, they're only unlinked
+        self.columns = None
+        self._names = None
+        self._by_class = None
+        old_dir = f"{self.dir}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(self.dir):
+            os.replace(self.dir, old_dir)
+        os.replace(tmp, self.dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    # queries, all of them straight on the memory mapped columns
+
+    def class_histogram(self):
+        # {class id: (boxes, images with the class)}
+        ids, starts, ends, images = self._classes()
+        new_image = np.ones(len(images), dtype=bool)
+        new_image[1:] = images[1:] != images[:-1]
+        new_image[starts] = True
+        # box_image never decreases and the sort is stable, so within a class the images of its
+        # boxes are sorted too and every change is another image
+        with_class = np.add.reduceat(new_image, starts) if len(starts) else []
+        return {int(c): (int(e - b), int(n)) for c, b, e, n in zip(ids, starts, ends, with_class)}
+
+    def size_stats(self):
+        # {class id: {"w": p50, "h": p50, bucket: boxes}}, sizes relative to the image
+        ids, starts, ends, _ = self._classes()
+        wh = np.asarray(self.columns["box_xywh"])[self._by_class[0], 2:]
+        buckets = np.searchsorted([upper for _, upper in SIZE_BUCKETS], np.sqrt(wh[:, 0] * wh[:, 1]), side="right")
+        stats = {}
+        for class_id, start, end in zip(ids, starts, ends):
+            counts = np.bincount(buckets[start:end], minlength=len(SIZE_BUCKETS) + 1)
+            stats[int(class_id)] = {
+                "w": float(np.nanmedian(wh[start:end, 0])),
+                "h": float(np.nanmedian(wh[start:end, 1])),
+                **{bucket: int(n) for (bucket, _), n in zip(SIZE_BUCKETS, counts)}
+            }
+        return stats
+
+    def _classes(self):
+        # boxes sorted by class once per load: the order, and every class as a slice of it
+        if self._by_class is None:
+            classes = np.asarray(self.columns["box_class"])
+            order = np.argsort(classes, kind="stable")
+            ids, starts = np.unique(classes[order], return_index=True)
+            self._by_class = (order, ids, starts, np.append(starts[1:], len(order)), np.asarray(self.columns["box_image"])[order])
+        return self._by_class[1:]
+
+    def empty_images(self):
+        return np.flatnonzero(np.asarray(self.columns["image_boxes"]) == 0)
+
+    def where(self, expr):
+        # image ids matching every term of expr, e.g. "class=helmet area<0.01 score>=0.5". box terms
+        # (class, cx, cy, w, h, area, score) have to hold for one and the same box of the image,
+        # "boxes" compares the number of boxes and "empty" is boxes=0
+        box_mask = None
+        image_mask = np.ones(len(self.columns["image_boxes"]), dtype=bool)
+        for term in expr.split():
+            if term == "empty":
+                term = "boxes=0"
+            match = WHERE_TERM.match(term)
+            if match is None:
+                raise ValueError(f"can't read '{term}'. terms look like class=helmet, area<0.01 or boxes>=3")
+            key, op, value = match.groups()
+            if key == "boxes":
+                image_mask &= OPS[op](self.columns["image_boxes"], int(value))
+                continue
+            if key not in BOX_KEYS:
+                raise ValueError(f"unknown key '{key}'. options: {', '.join(BOX_KEYS + ('boxes', 'empty'))}")
+            if key == "class":
+                if op not in ("=", "!="):
+                    raise ValueError("class can only be compared with = or !=")
+                mask = np.isin(self.columns["box_class"], [self._class_value(v) for v in value.split(",")])
+                mask = mask if op == "=" else ~mask
+            else:
+                mask = OPS[op](self._box_column(key), float(value))
+            box_mask = mask if box_mask is None else box_mask & mask
+
+        if box_mask is not None:
+            with_box = np.zeros_like(image_mask)
+            with_box[np.asarray(self.columns["box_image"])[box_mask]] = True
+            image_mask &= with_box
+        return np.flatnonzero(image_mask)
+
+    def _box_column(self, key):
+        xywh = self.columns["box_xywh"]
+        if key == "score":
+            return self.columns["box_score"]
+        if key == "area":
+            return xywh[:, 2] * xywh[:, 3]
+        return xywh[:, ("cx", "cy", "w", "h").index(key)]
+
+    def _class_value(self, value):
+        lowered = {str(k).strip().lower(): v for k, v in self.class_map.items()}
+        if value.strip().lower() in lowered:
+            return lowered[value.strip().lower()]
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"unknown class '{value}', it's neither in the class_map nor an id") from None
+
+def class_names(class_map):
+    names = {}
+    for name, class_id in (class_map or {}).items():
+        names.setdefault(class_id, name)
+    return names
+
+def print_stats(index):
+    columns = index.columns
+    images, boxes = len(columns["image_boxes"]), len(columns["box_class"])
+    print(f"\n{images} images, {boxes} boxes in {index.output_dir}")
+    if not images:
+        return
+
+    names = class_names(index.class_map)
+    histogram = index.class_histogram()
+    sizes = index.size_stats()
+    print(f"{'class':<20} {'boxes':>9} {'images':>9}  {'p50 w':>6} {'p50 h':>6}  " + "  ".join(f"{b:>7}" for b, _ in SIZE_BUCKETS))
+    for class_id, (count, with_class) in sorted(histogram.items()):
+        label = f"{class_id} {names.get(class_id, '')}".strip() if class_id != -1 else "-1 unknown"
+        size = sizes[class_id]
+        print(f"{label[:20]:<20} {count:>9} {with_class:>9}  {size['w']:>6.3f} {size['h']:>6.3f}  " + "  ".join(f"{size[b]:>7}" for b, _ in SIZE_BUCKETS))
+
+    per_image = np.asarray(columns["image_boxes"])
+    empty = int(np.count_nonzero(per_image == 0))
+    print(f"boxes per image: mean {per_image.mean():.2f}, p50 {np.percentile(per_image, 50):.0f}, p95 {np.percentile(per_image, 95):.0f}, max {per_image.max()}")
+    print(f"empty images: {empty} ({100 * empty / images:.1f}%). list them with --where empty")
+
+def run_stats(cfg, output_dir=None, where=None):
+    output_dir = output_dir or cfg["project"]["output_dir"]
+    # a multi job root has the merged class_map next to the jobs
+    class_map = cfg["detection"].get("class_map") or {}
+    merged = os.path.join(output_dir, "class_map.yaml")
+    if os.path.exists(merged):
+        import yaml
+
+        with open(merged, "r") as f:
+            class_map = (yaml.safe_load(f) or {}).get("class_map") or class_map
+
+    index = DatasetIndex.from_config(output_dir, cfg.get("stats") or {}, class_map=class_map)
+    index.update()
+    if where is None:
+        print_stats(index)
+        return index
+
+    start = time.perf_counter()
+    ids = index.where(where)
+    elapsed = time.perf_counter() - start
+    names = index.names
+    for image_id in ids:
+        print(names[image_id])
+    print(f"{len(ids)} of {len(names)} images match '{where}' ({1e3 * elapsed:.1f}ms)")
+    return index
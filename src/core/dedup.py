@@ -0,0 +1,171 @@
+import copy
+import glob
+import json
+import os
+import tarfile
+import threading
+
+from src.core.sample import EncodedImage, Sample
+from src.utils.imagehash import HASHES, HammingIndex
+
+class DedupIndex:
+    # perceptual hashes of every image saved to the output dir, so near duplicates are dropped right
+    # after generation, before detection and before they take up disk. hashes are appended to
+    # dedup/<method>.jsonl as samples are saved and loaded again by every later or resumed run.
+    # samples in flight are indexed as well, so duplicates within a batch are caught; they leave the
+    # index again if they don't get saved
+    def __init__(self, output_dir, method="phash", max_distance=6, part=""):
+        if method not in HASHES:
+            raise ValueError(f"unknown dedup method '{method}'. options: {', '.join(HASHES)}")
+        self.output_dir = output_dir
+        self.dir = os.path.join(output_dir, "dedup")
+        self.method = method
+        self.hash = HASHES[method]
+        self.max_distance = int(max_distance)
+        # workers of a sharded run write their own parts, e.g. "w0"
+        self.part = part
+        self.index = HammingIndex(self.max_distance)
+        self.paths = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self._handle = None
+        self.load()
+
+    @classmethod
+    def from_config(cls, output_dir, dedup_cfg):
+        return cls(
+            output_dir,
+            method=dedup_cfg.get("method", "phash"),
+            max_distance=dedup_cfg.get("max_distance", 6)
+        )
+
+    def shard(self, shard_id):
+        # every worker loads what was saved before the run, duplicates between workers of the
+        # same run aren't caught
+        index = copy.copy(self)
+        index.part = f"w{shard_id}"
+        index.lock = threading.Lock()
+        index.pending = {}
+        index._handle = None
+        return index
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, f"{self.method}-{self.part}.jsonl" if self.part else f"{self.method}.jsonl")
+
+    def load(self):
+        for path in sorted(glob.glob(os.path.join(self.dir, f"{self.method}*.jsonl"))):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a crash can leave a half-written last line
+                        continue
+                    self.index.add(int(entry["hash"], 16), entry["key"])
+                    self.paths[entry["key"]] = entry["path"]
+        if len(self.index):
+            print(f"dedup index: {len(self.index)} {self.method} hashes loaded from {self.dir}")
+        return self
+
+    def open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        self._handle = open(self.path, "a")
+        return self
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def check(self, samples):
+        # marks the near duplicates among samples with the key of the image they repeat
+        hashes = [self.hash(sample.image) for sample in samples]
+        with self.lock:
+            for sample, value in zip(samples, hashes):
+                match = self._match(value, sample.filename)
+                if match is not None:
+                    sample.duplicate_of = match
+                    continue
+                self.index.add(value, sample.filename)
+                self.pending[sample.filename] = value
+
+    def saved(self, sample, paths):
+        path = paths.get("image") or paths.get("shard")
+        with self.lock:
+            value = self.pending.pop(sample.filename, None)
+            if value is None:
+                return
+            self.paths[sample.filename] = path
+            # one line and a flush per sample like the manifest, a crash loses at most that line
+            self._handle.write(json.dumps({"key": sample.filename, "hash": f"{value:016x}", "index": sample.index, "path": path}) + "\n")
+            self._handle.flush()
+
+    def release(self, sample):
+        # the sample wasn't saved, later images that look like it are kept
+        with self.lock:
+            if self.pending.pop(sample.filename, None) is not None:
+                self.index.remove(sample.filename)
+
+    def backfill(self, records, image_ext):
+        # samples a run saved while dedup was off are hashed once from their files
+        records = [r for r in records if r["status"] == "saved" and Sample(r["index"], r["seed"], r["prompt"]).filename not in self.index]
+        if not records:
+            return
+        print(f"hashing {len(records)} saved images for the dedup index...")
+        with self, _ShardReader(self.output_dir) as shards:
+            for record in records:
+                sample = Sample(record["index"], record["seed"], record["prompt"])
+                paths = record.get("paths") or {}
+                try:
+                    if paths.get("image"):
+                        with open(os.path.join(self.output_dir, paths["image"]), "rb") as f:
+                            data = f.read()
+                    else:
+                        data = shards.read(paths.get("shard"), f"{sample.filename}.{image_ext}")
+                    sample.image = EncodedImage(data)
+                    self.check([sample])
+                except (OSError, KeyError, ValueError) as e:
+                    print(f"sample {sample.index} can't be hashed for dedup: {e}")
+                    continue
+                if sample.duplicate_of is None:
+                    self.saved(sample, paths)
+
+    def _match(self, value, key):
+        # the closest indexed image other than the sample itself. images deleted from the output
+        # dir since they were indexed don't count and are dropped from the index
+        for _, other in self.index.query(value):
+            if other == key:
+                continue
+            path = self.paths.get(other)
+            if other not in self.pending and (path is None or not os.path.exists(os.path.join(self.output_dir, path))):
+                self.index.remove(other)
+                continue
+            return other
+        return None
+
+class _ShardReader:
+    # members of the tar shards of a run, each shard is opened once
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.tars = {}
+
+    def read(self, shard, name):
+        if shard is None:
+            raise KeyError("no image path in the manifest")
+        if shard not in self.tars:
+            self.tars[shard] = tarfile.open(os.path.join(self.output_dir, shard), "r")
+        return self.tars[shard].extractfile(name).read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for tar in self.tars.values():
+            tar.close()
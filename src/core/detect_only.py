@@ -0,0 +1,192 @@
+import glob
+import itertools
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from src.utils.formatting import LabelFormatter
+from src.utils.postprocessing import filter_detections
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+def find_images(source):
+    # a directory is walked recursively, anything else is a glob pattern. returns the root that
+    # label paths mirror the images from, and the image paths in a stable order
+    if os.path.isdir(source):
+        def walk():
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(dirpath, name)
+        return source, walk()
+
+    parts = []
+    for part in source.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    root = os.sep.join(parts) or "."
+    paths = (
+        p for p in sorted(glob.iglob(source, recursive=True))
+        if p.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(p)
+    )
+    return root, paths
+
+class DetectOnlyRunner:
+    # labels an existing folder of images with the configured detector, prompt, nms and class_map.
+    # worker threads decode and downscale images ahead of the detector, which gets them in batches
+    SETTINGS_FILE = "detect_only.json"
+
+    def __init__(self, detector, config: dict, output_dir=None):
+        self.detector = detector
+        self.output_dir = output_dir or config["project"]["output_dir"]
+        self.output_format = config["output"]["format"]
+        if self.output_format not in LabelFormatter.EXTENSIONS:
+            raise ValueError(f"detect-only mode writes one label per image, '{self.output_format}' isn't supported. "
+                             f"options: {', '.join(LabelFormatter.EXTENSIONS)}")
+
+        self.det_prompt = config["detection"]["prompt"]
+        self.class_map = config["detection"].get("class_map", {})
+        self.nms_cfg = config["detection"].get("nms") or {}
+
+        det_cfg = config.get("detect_only") or {}
+        self.batch_size = max(1, int(det_cfg.get("batch_size", 8)))
+        self.workers = max(1, int(det_cfg.get("workers", 4)))
+        self.prefetch = max(self.batch_size, int(det_cfg.get("prefetch", 32)))
+        self.max_side = int(det_cfg.get("max_side", 1333) or 0)
+
+        # everything that changes the labels. when it differs from the last run every label is stale
+        self.settings = {
+            "mode": config["project"]["mode"],
+            "model": config["detection"].get("local_model_id") if config["project"]["mode"] == "local" else config["detection"].get("api_model_id"),
+            "prompt": self.det_prompt,
+            "box_threshold": config["detection"]["box_threshold"],
+            "text_threshold": config["detection"]["text_threshold"],
+            "class_map": self.class_map,
+            "nms": self.nms_cfg,
+            "format": self.output_format,
+            "max_side": self.max_side
+        }
+
+    def run(self, source):
+        root, paths = find_images(source)
+        settings_mtime = self._sync_settings()
+        print(f"\nlabeling images in {source} with '{self.det_prompt}'. format: {self.output_format}. "
+              f"batch size: {self.batch_size}, {self.workers} decode workers. labels go to {os.path.join(self.output_dir, 'labels')}")
+
+        stats = {"labeled": 0, "skipped": 0, "failed": 0, "boxes": 0}
+        start = time.time()
+
+        def stale():
+            for path in paths:
+                if self._up_to_date(path, self._label_name(path, root), settings_mtime):
+                    stats["skipped"] += 1
+                else:
+                    yield path
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="decode") as pool:
+            for batch in self._prefetch(pool, stale(), stats):
+                self._detect(batch, root, stats)
+                print(f"{stats['labeled']} labeled, {stats['skipped']} up to date, {stats['failed']} failed "
+                      f"({stats['labeled'] / max(time.time() - start, 1e-9):.1f} img/s)")
+
+        print(f"detect-only finished in {time.time() - start:.1f}s. {stats['labeled']} labeled with {stats['boxes']} boxes, "
+              f"{stats['skipped']} already up to date, {stats['failed']} failed")
+        return stats
+
+    def _prefetch(self, pool, paths, stats):
+        # keeps up to prefetch images decoding in the pool while the detector works on a batch
+        paths = iter(paths)
+        pending = deque(pool.submit(self._load, p) for p in itertools.islice(paths, self.prefetch))
+        batch = []
+        while pending:
+            item = pending.popleft().result()
+            for path in itertools.islice(paths, 1):
+                pending.append(pool.submit(self._load, path))
+
+            if "error" in item:
+                print(f"skipping {item['path']}: {item['error']}")
+                stats["failed"] += 1
+                continue
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _load(self, path):
+        try:
+            with Image.open(path) as image:
+                size = image.size
+                if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                    # stored sideways, labels are for the image as it's displayed
+                    size = size[::-1]
+                if self.max_side and image.format == "JPEG":
+                    # libjpeg decodes straight at a reduced scale, much cheaper than a full decode and a resize
+                    image.draft("RGB", (self.max_side, self.max_side))
+                image = ImageOps.exif_transpose(image).convert("RGB")
+            if self.max_side and max(image.size) > self.max_side:
+                image.thumbnail((self.max_side, self.max_side), Image.BILINEAR)
+        except Exception as e:
+            return {"path": path, "error": e}
+        return {"path": path, "image": image, "size": size}
+
+    def _detect(self, batch, root, stats):
+        results = self.detector.detect_batch([item["image"] for item in batch], self.det_prompt)
+
+        for item, detections in zip(batch, filter_detections(results, self.nms_cfg)):
+            w, h = item["size"]
+            # boxes come back in the pixels of the downscaled image
+            scale_x, scale_y = w / item["image"].width, h / item["image"].height
+            boxes = detections["boxes"] * [scale_x, scale_y, scale_x, scale_y]
+
+            # images without detections get an empty label too, so they count as up to date next time
+            LabelFormatter.save(
+                self.output_format,
+                boxes,
+                detections["labels"],
+                self._label_name(item["path"], root),
+                self.output_dir,
+                w, h,
+                class_map=self.class_map,
+                image_ext=os.path.splitext(item["path"])[1][1:],
+                class_ids=detections["class_ids"]
+            )
+            stats["labeled"] += 1
+            stats["boxes"] += len(boxes)
+
+    def _label_name(self, path, root):
+        # labels mirror the folder structure below root, so equal file names in sub dirs don't clash
+        rel = os.path.relpath(path, root)
+        if rel.startswith(".."):
+            rel = os.path.basename(path)
+        return os.path.splitext(rel)[0]
+
+    def _up_to_date(self, path, name, settings_mtime):
+        label = os.path.join(self.output_dir, "labels", f"{name}.{LabelFormatter.EXTENSIONS[self.output_format]}")
+        try:
+            label_mtime = os.path.getmtime(label)
+        except OSError:
+            return False
+        return label_mtime >= max(os.path.getmtime(path), settings_mtime)
+
+    def _sync_settings(self):
+        # the settings file is only rewritten when they change, labels older than it are stale
+        path = os.path.join(self.output_dir, self.SETTINGS_FILE)
+        try:
+            with open(path, "r") as f:
+                if json.load(f) == json.loads(json.dumps(self.settings)):
+                    return os.path.getmtime(path)
+        except (OSError, ValueError):
+            pass
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.settings, f, indent=4)
+        return os.path.getmtime(path)
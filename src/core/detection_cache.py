@@ -0,0 +1,151 @@
+import copy
+import json
+import os
+import re
+
+import numpy as np
+
+from src.utils.grounding import PromptSpans, to_query_boxes
+
+class DetectionStore:
+    # raw detector outputs of every sample, before the box threshold, nms and class mapping, so labels
+    # can be rebuilt later without loading the detector. samples are buffered and written in chunks:
+    #   raw/part-00000.npz   columnar arrays for up to chunk_size samples
+    #   raw/prompt.json      tokens of the detection prompt and the token span of every class
+    # a chunk holds, per sample, the queries whose best class token scored at least min_score:
+    # their normalized cx, cy, w, h boxes and their probabilities over the prompt tokens
+    def __init__(self, output_dir, chunk_size=256, min_score=0.05, part=""):
+        self.output_dir = output_dir
+        self.dir = os.path.join(output_dir, "raw")
+        self.chunk_size = max(1, int(chunk_size))
+        self.min_score = float(min_score)
+        # workers of a sharded run write their own chunks, e.g. "w0"
+        self.part = part
+        self._stem = f"part-{part}" if part else "part"
+        self._buffer = []
+        self._chunk_name = None
+        self._next_chunk = 0
+        self._prompt_written = False
+        self._loaded = (None, None)
+
+    @classmethod
+    def from_config(cls, output_dir, cache_cfg):
+        return cls(
+            output_dir,
+            chunk_size=cache_cfg.get("chunk_size", 256),
+            min_score=cache_cfg.get("min_score", 0.05)
+        )
+
+    def shard(self, shard_id):
+        store = copy.copy(self)
+        store.part = f"w{shard_id}"
+        store._stem = f"part-{store.part}"
+        store._buffer = []
+        return store
+
+    def open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        # chunks are never rewritten, a resumed run continues after the highest existing number
+        pattern = re.compile(rf"^{re.escape(self._stem)}-(\d+)\.npz$")
+        numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.dir)) if m]
+        self._next_chunk = max(numbers) + 1 if numbers else 0
+        self._chunk_name = None
+        return self
+
+    def add(self, sample, raw):
+        # returns the chunk the sample goes into, relative to output_dir, for the manifest
+        if not self._prompt_written:
+            self._write_prompt(raw["spans"])
+        if self._chunk_name is None:
+            self._chunk_name = f"{self._stem}-{self._next_chunk:05d}.npz"
+            self._next_chunk += 1
+
+        path = os.path.join("raw", self._chunk_name)
+        self._buffer.append((sample.index, raw))
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+        return path
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        tokens = max(raw["token_probs"].shape[1] for _, raw in self._buffer)
+        counts = [len(raw["boxes"]) for _, raw in self._buffer]
+        token_probs = np.zeros((sum(counts), tokens), dtype=np.float32)
+        row = 0
+        for (_, raw), n in zip(self._buffer, counts):
+            token_probs[row:row + n, :raw["token_probs"].shape[1]] = raw["token_probs"]
+            row += n
+
+        path = os.path.join(self.dir, self._chunk_name)
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez_compressed(
+                f,
+                index=np.asarray([index for index, _ in self._buffer], dtype=np.int64),
+                width=np.asarray([raw["width"] for _, raw in self._buffer], dtype=np.int32),
+                height=np.asarray([raw["height"] for _, raw in self._buffer], dtype=np.int32),
+                offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                boxes=np.concatenate([raw["boxes"] for _, raw in self._buffer]).astype(np.float64).reshape(-1, 4),
+                token_probs=token_probs
+            )
+        os.replace(f"{path}.tmp", path)
+        self._buffer = []
+        self._chunk_name = None
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_prompt(self, spans):
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, "prompt.json")
+        with open(f"{path}.{self._stem}.tmp", "w") as f:
+            json.dump({"min_score": self.min_score, **spans.to_dict()}, f)
+        os.replace(f"{path}.{self._stem}.tmp", path)
+        self._prompt_written = True
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.dir, "prompt.json"))
+
+    def prompt_spans(self, class_map=None):
+        with open(os.path.join(self.dir, "prompt.json"), "r") as f:
+            return PromptSpans.from_dict(json.load(f), class_map)
+
+    def stored_min_score(self):
+        with open(os.path.join(self.dir, "prompt.json"), "r") as f:
+            return json.load(f).get("min_score", 0.0)
+
+    def read(self, chunk_path, index):
+        # the last chunk read stays loaded, reading samples in chunk order loads every chunk once
+        if self._loaded[0] != chunk_path:
+            with np.load(os.path.join(self.output_dir, chunk_path)) as data:
+                chunk = {key: data[key] for key in data.files}
+            chunk["rows"] = {int(i): k for k, i in enumerate(chunk["index"])}
+            self._loaded = (chunk_path, chunk)
+
+        chunk = self._loaded[1]
+        k = chunk["rows"][index]
+        start, end = chunk["offsets"][k], chunk["offsets"][k + 1]
+        return {
+            "boxes": chunk["boxes"][start:end],
+            "token_probs": chunk["token_probs"][start:end],
+            "width": int(chunk["width"][k]),
+            "height": int(chunk["height"][k])
+        }
+
+def raw_from_detections(results, width, height, spans):
+    # detectors without token outputs (api, fake) only have thresholded boxes. they are stored in
+    # the same layout, with every class as one "token" holding the box score
+    boxes = to_query_boxes(results["boxes"], width, height)
+    token_probs = np.zeros((len(boxes), len(spans.names)), dtype=np.float32)
+    positions = {name: k for k, name in enumerate(spans.names)}
+    for row, (label, score) in enumerate(zip(results["labels"], results["scores"])):
+        if str(label) in positions:
+            token_probs[row, positions[str(label)]] = score
+    return {"boxes": boxes, "token_probs": token_probs, "width": width, "height": height, "spans": spans}
@@ -1,57 +1,48 @@
 from io import BytesIO
+import numpy as np
 from src.core.base import BaseDetector
-import sys
+from src.core.sample import EncodedImage, to_pil
+from src.utils.grounding import PromptSpans, decode_detections, resolve_class_ids
+from src.utils.instrumentation import span
 
 class ApiDetector(BaseDetector):
-    def __init__(self, model_id, box_threshold, text_threshold):
+    def __init__(self, model_id, box_threshold, text_threshold, client=None, class_map=None):
+        from src.core.replicate_client import ReplicateClient
+
         self.model_id = model_id
         self.box_threshold = box_threshold
         self.text_threshold = text_threshold
+        self.client = client or ReplicateClient()
+        self.class_map = class_map or {}
 
-    def detect(self, image, text_prompt: str) -> dict:
+    @staticmethod
+    def parse_classes(text_prompt: str) -> list:
         classes = [c.strip() for c in text_prompt.split(".") if c.strip()]
-        
-        if len(classes) > 1:
-            print("\nERROR: api mode does not support multi-class detection")
-            print(f"you requested {len(classes)} classes: {classes}")
-            print("please use local mode for multi-class, or stick to a single class in api mode.")
-            sys.exit(0)
-            
-        single_class_name = classes[0]
+        if len(classes) != 1:
+            raise ValueError(f"api mode supports exactly one class, got {len(classes)}: {classes}")
+        return classes
 
-        buf = BytesIO()
-        image.save(buf, format="JPEG")
-        buf.seek(0)
+    def detect(self, image, text_prompt: str) -> dict:
+        single_class_name = self.parse_classes(text_prompt)[0]
+        class_id = resolve_class_ids([single_class_name], self.class_map)[0]
 
-        import replicate
-        from replicate.exceptions import ReplicateError
-        
-        succ = False
-        retry = 0
-        max_retries = 3
-        wait_sec = 4
-        output = None
-        while not succ:
-            try:
-                output = replicate.run(
-                    self.model_id,
-                    input={
-                        "image": buf,
-                        "query": text_prompt,
-                        "box_threshold": self.box_threshold,
-                        "text_threshold": self.text_threshold
-                    }
-                )
-                succ = True
-
-            except ReplicateError as e:
-                print(f"got rate limited by replicate. waiting for {wait_sec} seconds before retrying...")
-                import time
-                time.sleep(wait_sec)
-                retry += 1
-                if retry > max_retries:
-                    print(f"couldn't handle replicate exception after {max_retries} retries. error: {e}")
-                    sys.exit(0)
+        # encoded originals are uploaded as they are, only decoded images need encoding
+        if isinstance(image, EncodedImage) and image.format in ("JPEG", "PNG", "WEBP"):
+            buf = BytesIO(image.data)
+        else:
+            buf = BytesIO()
+            image.save(buf, format="JPEG")
+            buf.seek(0)
+
+        output = self.client.run(
+            self.model_id,
+            {
+                "image": buf,
+                "query": text_prompt,
+                "box_threshold": self.box_threshold,
+                "text_threshold": self.text_threshold
+            }
+        )
         
         boxes, scores, labels = [], [], []
         detections = output.get('detections', []) if isinstance(output, dict) else output
@@ -64,11 +55,11 @@ class ApiDetector(BaseDetector):
             scores.append(item.get('confidence') or item.get('score'))
             labels.append(single_class_name)
             
-        return {"boxes": boxes, "scores": scores, "labels": labels}
+        return {"boxes": boxes, "scores": scores, "labels": labels, "class_ids": [class_id] * len(boxes)}
     
 
 class LocalDetector(BaseDetector):
-    def __init__(self, model_id, device, box_threshold, text_threshold):
+    def __init__(self, model_id, device, box_threshold, text_threshold, keep_resident=False, class_map=None, raw_min_score=None):
         print(f"loading local detection model: {model_id}")
 
         from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
@@ -76,6 +67,15 @@ class LocalDetector(BaseDetector):
         self.device = device
         self.box_threshold = box_threshold
         self.text_threshold = text_threshold
+        # when false the model goes back to cpu after every detect call
+        self.keep_resident = keep_resident
+        self.on_device = False
+        self.class_map = class_map or {}
+        # when set, queries scoring at least this much are also returned unthresholded for the raw cache
+        self.raw_min_score = raw_min_score
+        # (detection prompt, class_map) -> class token spans, the prompt is only decoded once per run.
+        # jobs sharing the detector can swap class_map between calls, the ids come from the map
+        self._prompt_spans = {}
         
         try:
             self.processor = AutoProcessor.from_pretrained(model_id, local_files_only=True)
@@ -85,63 +85,104 @@ class LocalDetector(BaseDetector):
             self.processor = AutoProcessor.from_pretrained(model_id, local_files_only=False)
             self.model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id, local_files_only=False)
 
+        if keep_resident:
+            self.to_device()
+
+    def footprint(self):
+        from src.core.residency import module_bytes
+        return module_bytes(self.model)
+
+    def to_device(self):
+        if not self.on_device:
+            with span("transfer"):
+                self.model.to(self.device)
+            self.on_device = True
+
+    def offload(self):
+        if self.on_device:
+            import torch
+            with span("transfer"):
+                self.model.to("cpu")
+                torch.cuda.empty_cache()
+            self.on_device = False
+
     def detect(self, image, text_prompt: str) -> dict:
+        return self.detect_batch([image], text_prompt)[0]
+
+    def detect_batch(self, images: list, text_prompt: str) -> list:
         import torch
         clean_prompt = text_prompt.strip()
         if clean_prompt.endswith("."):
             clean_prompt = clean_prompt[:-1].strip()
+        
+        images = [to_pil(image) for image in images]
+        if not images:
+            return []
             
-        self.model.to(self.device)
-        inputs = self.processor(images=image, text=clean_prompt, return_tensors="pt").to(self.device)
+        self.to_device()
+        # the processor resizes every image and pads them to a common size with a pixel mask
+        inputs = self.processor(
+            images=images,
+            text=[clean_prompt] * len(images),
+            padding=True,
+            return_tensors="pt"
+        ).to(self.device)
         
         with torch.no_grad():
             outputs = self.model(**inputs)
 
-        target_sizes = [image.size[::-1]]
-        
-        results = self.processor.post_process_grounded_object_detection(
-            outputs,
-            inputs.input_ids,
-            threshold=self.box_threshold,
-            text_threshold=self.text_threshold,
-            target_sizes=target_sizes
-        )[0]
-
-        final_labels = self._label_decoding(outputs, inputs, self.box_threshold)
-
-        self.model.to("cpu")
-        torch.cuda.empty_cache()
-        
-        return {
-            "boxes": results["boxes"].cpu().numpy().tolist(),
-            "scores": results["scores"].cpu().numpy().tolist(),
-            "labels": final_labels
-        }
-
-    def _label_decoding(self, outputs, inputs, threshold):
-        logits = outputs.logits.sigmoid()[0]
-        
-        # values: confidence scores, indices: token indices in input_ids
-        max_scores, token_indices = logits.max(dim=1) 
-        
-        keep = max_scores > threshold
-        keep_token_indices = token_indices[keep]
-        
-        decoded_labels = []
-        input_ids = inputs.input_ids[0]
-        
-        for token_idx in keep_token_indices:
-            if token_idx >= len(input_ids):
-                decoded_labels.append("unknown")
-                continue
-                
-            predicted_token_id = input_ids[token_idx]
-            word = self.processor.tokenizer.decode([predicted_token_id], skip_special_tokens=True)
-            clean_word = word.strip().replace(".", "")
+        # best token probability inside every class span, (batch, queries, classes). this is the
+        # only work over the text tokens, everything after it runs on the small per-class scores
+        spans = self._spans(clean_prompt, inputs.input_ids[0])
+        probs = outputs.logits.sigmoid()
+        if spans.spans:
+            span_scores = torch.stack([probs[..., start:end].amax(dim=-1) for start, end in spans.spans], dim=-1)
+            span_scores = span_scores.float().cpu().numpy()
+        else:
+            span_scores = np.zeros(tuple(probs.shape[:2]) + (0,))
+        pred_boxes = outputs.pred_boxes.float().cpu().numpy()
 
-            if not clean_word:
-                decoded_labels.append("unknown")
-            else:
-                decoded_labels.append(clean_word)
+        detections = []
+        for b, image in enumerate(images):
+            w, h = image.size
+            # boxes, scores and classes come out of the same keep mask
+            boxes, scores, classes = decode_detections(pred_boxes[b], span_scores[b], self.box_threshold, w, h, self.text_threshold)
+            labels, class_ids = spans.labels(classes)
+            detections.append({
+                "boxes": boxes.tolist(),
+                "scores": scores.tolist(),
+                "labels": labels,
+                "class_ids": class_ids.tolist()
+            })
+            
+            if self.raw_min_score is not None:
+                best = span_scores[b].max(axis=-1) if span_scores.shape[-1] else np.zeros(len(span_scores[b]))
+                selected = best >= self.raw_min_score
+                detections[-1]["raw"] = {
+                    "boxes": pred_boxes[b][selected],
+                    "token_probs": probs[b][torch.from_numpy(selected).to(probs.device), :inputs.input_ids.shape[1]].float().cpu().numpy(),
+                    "width": w,
+                    "height": h,
+                    "spans": spans
+                }
+
+        if not self.keep_resident:
+            self.offload()
+        
+        return detections
 
-        return decoded_labels
\ No newline at end of file
+    def _spans(self, prompt, input_ids):
+        key = (prompt, tuple(sorted((str(name), class_id) for name, class_id in self.class_map.items())))
+        spans = self._prompt_spans.get(key)
+        if spans is None:
+            tokenizer = self.processor.tokenizer
+            ids = input_ids.tolist()
+            special = set(tokenizer.all_special_ids)
+            spans = PromptSpans.from_tokens(
+                [None if t in special else tokenizer.decode([t]) for t in ids],
+                lambda start, end: tokenizer.decode(ids[start:end]),
+                self.class_map
+            )
+            print(f"detection classes: {', '.join(f'{n} -> {c}' for n, c in zip(spans.names, spans.class_ids))}")
+            self._prompt_spans[key] = spans
+        return spans
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+class EmbeddingCache:
+    # lru cache of text encoder outputs keyed on the expanded prompt and the encoder settings.
+    # entries are tuples of tensors, optionally mirrored to a directory shared between runs
+    def __init__(self, max_entries=512, max_bytes=None, cache_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cache_cfg):
+        cache_cfg = cache_cfg or {}
+        max_mb = cache_cfg.get("max_mb")
+        return cls(
+            max_entries=cache_cfg.get("max_entries", 512),
+            max_bytes=int(max_mb * 1024 * 1024) if max_mb else None,
+            cache_dir=cache_cfg.get("dir")
+        )
+
+    @staticmethod
+    def make_key(prompt, **settings):
+        payload = json.dumps([prompt, settings], sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def get(self, key, device=None):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            
+        value = self._load(key, device)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._insert(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._insert(key, value)
+        self._store(key, value)
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+        return bool(self.cache_dir) and os.path.exists(self._path(key))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _insert(self, key, value):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = value
+        self.nbytes += _nbytes(value)
+        
+        while len(self.entries) > 1 and (
+            (self.max_entries and len(self.entries) > self.max_entries)
+            or (self.max_bytes and self.nbytes > self.max_bytes)
+        ):
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _load(self, key, device):
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return None
+        import torch
+        try:
+            value = torch.load(self._path(key), map_location="cpu", weights_only=True)
+        except Exception as e:
+            print(f"warning: couldn't read cached embedding {key}: {e}")
+            return None
+        return tuple(t.to(device) for t in value) if device is not None else tuple(value)
+
+    def _store(self, key, value):
+        if not self.cache_dir or os.path.exists(self._path(key)):
+            return
+        import torch
+        # written to a temp file first so a concurrent run never reads half a tensor
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        torch.save(tuple(t.detach().cpu() for t in value), tmp_path)
+        os.replace(tmp_path, self._path(key))
+
+def _nbytes(value):
+    return sum(t.numel() * t.element_size() for t in value)
@@ -0,0 +1,122 @@
+# backends are registered by their config name (project.mode). builders import their module when they
+# are called, so api mode never loads torch, diffusers or transformers and doesn't need them installed
+GENERATORS = {}
+DETECTORS = {}
+
+def register_generator(mode):
+    def register(builder):
+        GENERATORS[mode] = builder
+        return builder
+    return register
+
+def register_detector(mode):
+    def register(builder):
+        DETECTORS[mode] = builder
+        return builder
+    return register
+
+def build_backends(cfg, device=None, detector_device=None):
+    # device overrides project.device, detector_device puts the detector on a card of its own
+    device = device or cfg["project"]["device"]
+    # generation and detection share one rate limiter and connection pool in api mode
+    client = _api_client(cfg) if cfg["project"]["mode"] == "api" else None
+
+    gen = build_generator(cfg, device, client=client)
+    det = build_detector(cfg, detector_device or device, client=client)
+    return gen, det
+
+def build_generator(cfg, device=None, client=None):
+    mode = cfg["project"]["mode"]
+    if mode not in GENERATORS:
+        raise ValueError(f"unknown mode '{mode}'")
+    return GENERATORS[mode](cfg, device or cfg["project"]["device"], client)
+
+def build_detector(cfg, device=None, client=None, keep_resident=None):
+    mode = cfg["project"]["mode"]
+    if mode not in DETECTORS:
+        raise ValueError(f"unknown mode '{mode}'")
+    return DETECTORS[mode](cfg, device or cfg["project"]["device"], client, keep_resident)
+
+def _api_client(cfg):
+    from src.core.replicate_client import ReplicateClient
+
+    return ReplicateClient.from_config(cfg)
+
+@register_generator("api")
+def _api_generator(cfg, device, client):
+    from src.core.generators import ApiGenerator
+
+    return ApiGenerator(
+        model_id=cfg["generation"]["api_model_id"],
+        gen_params=cfg["generation"]["params"],
+        client=client or _api_client(cfg)
+    )
+
+@register_generator("local")
+def _local_generator(cfg, device, client):
+    from src.core.generators import LocalGenerator
+    from src.core.embedding_cache import EmbeddingCache
+
+    cache_cfg = cfg["generation"].get("embedding_cache") or {}
+    return LocalGenerator(
+        model_id=cfg["generation"]["local_model_id"],
+        device=device,
+        optimize_gpu=cfg["system"]["optimize_gpu"],
+        gen_params=cfg["generation"]["params"],
+        embedding_cache=EmbeddingCache.from_config(cache_cfg) if cache_cfg.get("enabled", True) else None
+    )
+
+@register_generator("fake")
+def _fake_generator(cfg, device, client):
+    from src.testing.fakes import FakeGenerator
+
+    fake_cfg = cfg.get("fake") or {}
+    return FakeGenerator(
+        width=cfg["generation"]["params"].get("width") or 512,
+        height=cfg["generation"]["params"].get("height") or 512,
+        latency_sec=fake_cfg.get("generation_latency", 0.0)
+    )
+
+@register_detector("api")
+def _api_detector(cfg, device, client, keep_resident):
+    from src.core.detectors import ApiDetector
+
+    return ApiDetector(
+        model_id=cfg["detection"]["api_model_id"],
+        box_threshold=cfg["detection"]["box_threshold"],
+        text_threshold=cfg["detection"]["text_threshold"],
+        client=client or _api_client(cfg),
+        class_map=cfg["detection"].get("class_map")
+    )
+
+@register_detector("local")
+def _local_detector(cfg, device, client, keep_resident):
+    from src.core.detectors import LocalDetector
+
+    raw_cfg = cfg["detection"].get("raw_cache") or {}
+    if keep_resident is None:
+        # low vram cards can't hold both models, so the detector is offloaded between calls
+        keep_resident = not cfg["system"]["optimize_gpu"]
+    return LocalDetector(
+        model_id=cfg["detection"]["local_model_id"],
+        device=device,
+        box_threshold=cfg["detection"]["box_threshold"],
+        text_threshold=cfg["detection"]["text_threshold"],
+        keep_resident=keep_resident,
+        class_map=cfg["detection"].get("class_map"),
+        raw_min_score=raw_cfg.get("min_score", 0.05) if raw_cfg.get("enabled") else None
+    )
+
+@register_detector("fake")
+def _fake_detector(cfg, device, client, keep_resident):
+    from src.testing.fakes import FakeDetector
+
+    fake_cfg = cfg.get("fake") or {}
+    return FakeDetector(
+        max_boxes=fake_cfg.get("max_boxes", 3),
+        min_boxes=fake_cfg.get("min_boxes", 0),
+        latency_sec=fake_cfg.get("detection_latency", 0.0),
+        class_map=cfg["detection"].get("class_map")
+    )
+
+MODES = tuple(GENERATORS)
@@ -1,16 +1,20 @@
-import requests
 import random
-from io import BytesIO
 from PIL import Image
 
 from src.core.base import BaseGenerator
+from src.core.sample import EncodedImage
+from src.utils.instrumentation import span
 
 class ApiGenerator(BaseGenerator):
-    def __init__(self, model_id, gen_params=None):
+    def __init__(self, model_id, gen_params=None, client=None):
+        from src.core.replicate_client import ReplicateClient
+
         self.model_id = model_id
         self.params = gen_params or {}
+        # the client is shared with the detector so both use the same rate limit and connection pool
+        self.client = client or ReplicateClient()
 
-    def generate(self, prompt: str, seed: int = None) -> Image.Image:
+    def generate(self, prompt: str, seed: int = None) -> EncodedImage:
         if seed is None:
             seed = random.randint(0, 2**32 - 1)
             
@@ -25,41 +29,24 @@ class ApiGenerator(BaseGenerator):
             "guidance_scale": self.params.get("guidance_scale")
         }
 
-        import replicate
-        from replicate.exceptions import ReplicateError
-        succ = False
-        retry = 0
-        max_retries = 3
-        wait_sec = 4
-        output = None
-        while not succ:
-            try:
-                output = replicate.run(self.model_id, input=input_args)
-                succ = True
-            except ReplicateError as e:
-                print(f"got rate limited by replicate. waiting for {wait_sec} seconds before retrying...")
-                import time
-                time.sleep(wait_sec)
-                retry += 1
-                if retry > max_retries:
-                    import sys
-                    print(f"couldn't handle replicate exception. please check explicitly: {e}")
-                    sys.exit(0)
+        output = self.client.run(self.model_id, input_args)
 
         image_url = output[0] if isinstance(output, list) else output
-        response = requests.get(image_url)
-        response.raise_for_status()
-        return Image.open(BytesIO(response.content))
+        # the downloaded jpeg is kept encoded, it is decoded only if something needs the pixels
+        return EncodedImage(self.client.download(image_url), "jpg")
 
 class LocalGenerator(BaseGenerator):
-    def __init__(self, model_id, device="cuda", optimize_gpu=True, gen_params=None):
+    def __init__(self, model_id, device="cuda", optimize_gpu=True, gen_params=None, embedding_cache=None):
         print(f"loading local generation model: {model_id}")
         
         import torch
         from diffusers import FluxPipeline
         
+        self.model_id = model_id
         self.device = device
         self.params = gen_params or {}
+        # optional EmbeddingCache, wildcard prompts repeat so their text embeddings are reused
+        self.embedding_cache = embedding_cache
         
         try:
             self.pipe = FluxPipeline.from_pretrained(
@@ -75,36 +62,126 @@ class LocalGenerator(BaseGenerator):
                 local_files_only=False
             )
         
-        # gpu optimization
+        # the pipeline moves the model to the card once it knows whether the detector has to share it
+        self.on_device = False
+        self.sequential_offload = False
         if optimize_gpu:
-            print("\nvram optimization enabled (sequential offload). expect much slower generation with much lower vram usage.\n")
-            self.pipe.enable_sequential_cpu_offload()
-            self.pipe.enable_attention_slicing()
-            self.pipe.vae.enable_slicing()
-            self.pipe.vae.enable_tiling()
-        else:
-            self.pipe.to(device)
+            self.enable_sequential_offload()
+        
+    def footprint(self):
+        from src.core.residency import module_bytes
+        return module_bytes(*self.pipe.components.values())
+
+    def to_device(self):
+        # under sequential offload accelerate moves every layer on its own
+        if not self.on_device and not self.sequential_offload:
+            with span("transfer"):
+                self.pipe.to(self.device)
+            self.on_device = True
+
+    def offload(self):
+        if self.on_device:
+            import torch
+            with span("transfer"):
+                self.pipe.to("cpu")
+                torch.cuda.empty_cache()
+            self.on_device = False
+
+    def enable_sequential_offload(self):
+        if self.sequential_offload:
+            return
+        print("\nvram optimization enabled (sequential offload). expect much slower generation with much lower vram usage.\n")
+        self.offload()
+        self.pipe.enable_sequential_cpu_offload()
+        self.pipe.enable_attention_slicing()
+        self.pipe.vae.enable_slicing()
+        self.pipe.vae.enable_tiling()
+        self.sequential_offload = True
         
     def generate(self, prompt: str, seed: int = None) -> Image.Image:
+        return self.generate_batch([prompt], [seed])[0]
+
+    def generate_batch(self, prompts: list, seeds: list) -> list:
         import torch
-        
-        if seed is None:
-            seed = random.randint(0, 2**32 - 1)
+
+        seeds = [random.randint(0, 2**32 - 1) if seed is None else seed for seed in seeds]
         
         height = self.params.get("height")
         width = self.params.get("width")
         steps = self.params.get("num_inference_steps")
         guidance = self.params.get("guidance_scale")
         max_seq = self.params.get("max_sequence_length")
+
+        self.to_device()
+        # one generator per image so every image stays reproducible from its own seed
+        generators = [torch.Generator("cpu").manual_seed(seed) for seed in seeds]
+        
+        if self.embedding_cache is not None:
+            prompt_embeds, pooled_prompt_embeds = self.encode_prompts(prompts)
+            prompt_args = {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds}
+        else:
+            prompt_args = {"prompt": list(prompts)}
             
-        image = self.pipe(
-            prompt,
+        images = self.pipe(
+            **prompt_args,
             height=height,
             width=width,
             num_inference_steps=steps,
             guidance_scale=guidance,
             max_sequence_length=max_seq,
-            generator=torch.Generator("cpu").manual_seed(seed)
-        ).images[0]
+            generator=generators
+        ).images
+        
+        return images
+
+    def encode_prompts(self, prompts):
+        import torch
+
+        max_seq = self.params.get("max_sequence_length")
+        self.to_device()
+        device = self.pipe._execution_device
+        keys = [self.embedding_cache.make_key(p, model=self.model_id, max_sequence_length=max_seq) for p in prompts]
         
-        return image
\ No newline at end of file
+        cached = {key: self.embedding_cache.get(key, device) for key in set(keys)}
+        missing = list(dict.fromkeys(p for p, key in zip(prompts, keys) if cached[key] is None))
+        
+        if missing:
+            # only prompts that were never seen go through clip and t5, in one call
+            with torch.no_grad():
+                prompt_embeds, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+                    prompt=missing,
+                    prompt_2=None,
+                    device=device,
+                    max_sequence_length=max_seq
+                )
+            for k, prompt in enumerate(missing):
+                key = self.embedding_cache.make_key(prompt, model=self.model_id, max_sequence_length=max_seq)
+                # copies, a slice would keep the storage of the whole encoded batch alive
+                cached[key] = (prompt_embeds[k:k+1].clone(), pooled_prompt_embeds[k:k+1].clone())
+                self.embedding_cache.put(key, cached[key])
+        
+        return (
+            torch.cat([cached[key][0].to(device) for key in keys]),
+            torch.cat([cached[key][1].to(device) for key in keys])
+        )
+
+    def warm_prompt_cache(self, prompts, release_encoders=False):
+        # encodes every prompt up front. once all of them are cached the text encoders are never
+        # called again, so they can stay offloaded or be dropped altogether
+        if self.embedding_cache is None:
+            return False
+        
+        prompts = list(dict.fromkeys(prompts))
+        for start in range(0, len(prompts), 16):
+            self.encode_prompts(prompts[start:start + 16])
+            
+        max_seq = self.params.get("max_sequence_length")
+        complete = all(
+            self.embedding_cache.make_key(p, model=self.model_id, max_sequence_length=max_seq) in self.embedding_cache
+            for p in prompts
+        )
+        if complete and release_encoders:
+            print(f"all {len(prompts)} prompt embeddings cached. releasing text encoders.")
+            self.pipe.text_encoder = None
+            self.pipe.text_encoder_2 = None
+        return complete
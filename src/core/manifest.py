@@ -0,0 +1,113 @@
+import glob
+import json
+import os
+import threading
+import time
+
+# statuses that mean a sample doesn't need to run again
+FINISHED = ("saved", "empty", "duplicate")
+
+class RunManifest:
+    # append-only jsonl log of a run in its output dir. the first line describes the run,
+    # every following line is the latest known state of one sample
+    def __init__(self, output_dir, filename="manifest.jsonl"):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, filename)
+        self.lock = threading.Lock()
+        self.header = None
+        self.samples = {}
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def load(self):
+        self.header = None
+        self.samples = {}
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a crash can leave a half-written last line
+                    continue
+                if record.get("type") == "run":
+                    self.header = self.header or record
+                elif record.get("type") == "sample":
+                    self.samples[record["index"]] = record
+        return self
+
+    def start(self, **run_info):
+        # a fresh run never appends to an older manifest, the old one is kept next to it
+        if self.exists():
+            rotated = f"{self.path}.{int(time.time())}"
+            os.replace(self.path, rotated)
+            print(f"previous manifest moved to {rotated}")
+        self.header = {"type": "run", "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), **run_info}
+        self.samples = {}
+        self._append(self.header)
+
+    def record(self, sample, status, paths=None, error=None):
+        record = {
+            "type": "sample",
+            "index": sample.index,
+            "seed": sample.seed,
+            "prompt": sample.prompt,
+            "combination": sample.combination,
+            "status": status,
+            "boxes": len(sample.boxes),
+            "paths": paths or {}
+        }
+        if error is not None:
+            record["error"] = str(error)
+        if sample.duplicate_of is not None:
+            record["duplicate_of"] = sample.duplicate_of
+        with self.lock:
+            self.samples[sample.index] = record
+            self._append(record)
+
+    def is_finished(self, index):
+        record = self.samples.get(index)
+        if record is None or record["status"] not in FINISHED:
+            return False
+        # a sample only counts as done if every file it wrote is still there
+        return all(os.path.exists(os.path.join(self.output_dir, p)) for p in record["paths"].values())
+
+    def saved_count(self):
+        return sum(1 for r in self.samples.values() if r["status"] == "saved")
+
+    def status_counts(self):
+        counts = {}
+        for record in self.samples.values():
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+        return counts
+
+    def shard(self, shard_id):
+        # workers of a sharded run log to their own file, merged back with merge_shards
+        return RunManifest(self.output_dir, filename=f"manifest.shard{shard_id}.jsonl")
+
+    def merge_shards(self):
+        base, ext = os.path.splitext(self.path)
+        merged = 0
+        for shard_path in sorted(glob.glob(f"{base}.shard*{ext}")):
+            with open(shard_path, "r") as src, self.lock, open(self.path, "a") as dst:
+                for line in src:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get("type") == "sample":
+                        self.samples[record["index"]] = record
+                        dst.write(json.dumps(record) + "\n")
+                        merged += 1
+            os.remove(shard_path)
+        return merged
+
+    def _append(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
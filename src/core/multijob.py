@@ -0,0 +1,449 @@
+import copy
+import json
+import os
+import re
+import time
+from collections import deque
+from contextlib import ExitStack, nullcontext
+
+import yaml
+
+from src.core.client import JOB_KEYS
+from src.core.pipeline import DatasetPipeline
+from src.core.residency import ResidencyManager
+from src.utils.instrumentation import Instrumentation, span
+
+# many dataset jobs against one load of the models. a job spec file lists the jobs, each with its own
+# prompt, detection prompt, class_map, count and output dir. their samples are interleaved into the
+# same generation batches, so small jobs and the tails of big ones still fill a batch. every job
+# keeps its own output, manifest and progress, and a job that fails stops alone
+
+# settings the shared models were built with, a job can't change them
+SHARED_KEYS = {
+    "project": ("mode", "device", "devices", "detector_device"),
+    "generation": ("local_model_id", "api_model_id", "params", "embedding_cache", "batch_size"),
+    # raw_cache decides whether the loaded detector returns raw outputs, and from which min_score
+    "detection": ("local_model_id", "api_model_id", "box_threshold", "text_threshold", "raw_cache"),
+    "system": ("optimize_gpu", "residency", "phase_size", "vram_headroom_gb")
+}
+
+def load_spec(path):
+    # yaml: a list of jobs, or a dict with jobs and optionally defaults, output_root and
+    # merge_class_maps. jsonl: one job per line
+    with open(path, "r") as f:
+        if path.endswith(".jsonl"):
+            spec = [json.loads(line) for line in f if line.strip()]
+        else:
+            spec = yaml.safe_load(f)
+    if isinstance(spec, list):
+        spec = {"jobs": spec}
+    if not isinstance(spec, dict) or not spec.get("jobs"):
+        raise ValueError(f"no jobs in {path}")
+    return spec
+
+def _merge(base, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = copy.deepcopy(value)
+    return base
+
+def job_configs(cfg, spec):
+    # one full config per job: the base config, the spec's defaults, then the job's own fields.
+    # "config" holds overrides of any other section, e.g. {"detection": {"nms": {...}}}
+    root = spec.get("output_root") or cfg["project"]["output_dir"]
+    defaults = spec.get("defaults") or {}
+    jobs = []
+    for k, job in enumerate(spec["jobs"]):
+        job = {**defaults, **job, "config": _merge(copy.deepcopy(defaults.get("config") or {}), job.get("config") or {})}
+        name = str(job.get("name") or f"job{k + 1}")
+        if not re.fullmatch(r"[\w.-]+", name):
+            raise ValueError(f"job name '{name}' can only have letters, digits, '_', '-' and '.'")
+        unknown = set(job) - set(JOB_KEYS) - {"name", "config"}
+        if unknown:
+            raise ValueError(f"job '{name}' has unknown fields: {', '.join(sorted(unknown))}")
+        if not isinstance(job.get("count", 1), int) or job.get("count", 1) < 1:
+            raise ValueError(f"job '{name}': count has to be a positive integer")
+
+        job_cfg = _merge(copy.deepcopy(cfg), job["config"])
+        for key, (section, field) in JOB_KEYS.items():
+            if key in job:
+                job_cfg[section][field] = job[key]
+        if "detection_prompt" in job and "class_map" not in job and "class_map" not in job["config"].get("detection", {}):
+            # the base class_map goes with the base detection prompt
+            job_cfg["detection"]["class_map"] = {}
+        job_cfg["project"]["output_dir"] = job.get("output_dir") or os.path.join(root, name)
+        for section, keys in SHARED_KEYS.items():
+            for key in keys:
+                if job_cfg.get(section, {}).get(key) != cfg.get(section, {}).get(key):
+                    raise ValueError(f"job '{name}' changes {section}.{key}, which every job shares")
+        jobs.append((name, job_cfg))
+
+    for label, values in (("name", [n for n, _ in jobs]), ("output dir", [os.path.abspath(c["project"]["output_dir"]) for _, c in jobs])):
+        repeated = sorted({v for v in values if values.count(v) > 1})
+        if repeated:
+            raise ValueError(f"more than one job with the {label} {repeated[0]}")
+    return root, jobs
+
+def merge_class_maps(configs):
+    # one id space for the combined dataset. names keep the id they first got, in job order, and
+    # names sharing an id within a job (synonyms) share it globally too. a job without a class_map
+    # gets one from the classes of its detection prompt. every job's map is rewritten in place
+    merged = {}
+    lowered = {}
+    for cfg in configs:
+        job_map = cfg["detection"].get("class_map") or {}
+        if not job_map:
+            names = [c.strip() for c in cfg["detection"]["prompt"].split(".") if c.strip()]
+            job_map = {name: i for i, name in enumerate(names)}
+        groups = {}
+        for name, class_id in job_map.items():
+            groups.setdefault(class_id, []).append(str(name))
+
+        remapped = {}
+        for class_id in sorted(groups):
+            names = groups[class_id]
+            known = [lowered[n.strip().lower()] for n in names if n.strip().lower() in lowered]
+            global_id = known[0] if known else len(set(merged.values()))
+            for name in names:
+                # the first spelling of a name is the one kept
+                if name.strip().lower() not in lowered:
+                    merged[name] = global_id
+                    lowered[name.strip().lower()] = global_id
+                remapped[name] = global_id
+        cfg["detection"]["class_map"] = remapped
+    return merged
+
+class _Job:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.pipeline = None
+        self.status = "pending"
+        self.error = None
+        self.pending = None
+        self.done = 0
+        self.saved = 0
+        self.started = None
+        self.finished = None
+        self.stack = ExitStack()
+
+    @property
+    def count(self):
+        return self.config["generation"]["count"]
+
+    @property
+    def prompt(self):
+        return self.config["generation"]["prompt"]
+
+    @property
+    def det_prompt(self):
+        return self.config["detection"]["prompt"]
+
+    @property
+    def class_map(self):
+        return self.config["detection"].get("class_map") or {}
+
+    @property
+    def output_dir(self):
+        return self.config["project"]["output_dir"]
+
+    @property
+    def target(self):
+        return self.config["generation"].get("target_saved") or self.count
+
+    def take(self):
+        # the next sample of the job, or None when it has nothing to hand out right now
+        if self.pending is not None:
+            index = self.pending.popleft() if self.pending else None
+        else:
+            # a fresh generator every time, the scheduler only hands out what the target still needs
+            index = next(self.pipeline.yields.indices(), None)
+        if index is None:
+            return None
+        return next(self.pipeline._plan_batches(self.prompt, [index], self.count))[0]
+
+    def exhausted(self):
+        # called between phases, when nothing of the job is in flight
+        if self.pending is not None:
+            return not self.pending
+        return self.pipeline.yields.done()
+
+    @property
+    def progress(self):
+        if self.pipeline is not None and self.pipeline.yields is not None:
+            return self.pipeline.yields.found
+        return self.saved
+
+    def persisted(self, samples, saved):
+        self.done += len(samples)
+        self.saved += saved
+
+    def info(self):
+        return {
+            "name": self.name,
+            "status": self.status,
+            "error": self.error,
+            "count": self.count,
+            "target_saved": self.config["generation"].get("target_saved"),
+            "done": self.done,
+            "saved": self.saved,
+            "output_dir": self.output_dir,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+class MultiJobRunner:
+    def __init__(self, generator, detector, config, jobs, output_root, class_map=None, resume=False):
+        self.generator = generator
+        self.detector = detector
+        self.config = config
+        self.jobs = [_Job(name, job_cfg) for name, job_cfg in jobs]
+        self.output_root = output_root
+        self.class_map = class_map
+        self.resume = resume
+        self.batch_size = max(1, int(config["generation"].get("batch_size", 1)))
+        self.residency = ResidencyManager.from_config(generator, detector, config)
+        # one recorder for the whole run in <output_root>/metrics, spans of every job end up there
+        metrics_cfg = config.get("instrumentation") or {}
+        self.metrics = Instrumentation.from_config(output_root, metrics_cfg) if metrics_cfg.get("enabled", True) else None
+        self.report_every = float(metrics_cfg.get("report_every", 30) or 0)
+        self._last_report = 0.0
+        self._turn = 0
+
+    @property
+    def status_path(self):
+        return os.path.join(self.output_root, "jobs.json")
+
+    def run(self):
+        os.makedirs(self.output_root, exist_ok=True)
+        if self.class_map is not None:
+            self._write_class_map()
+        print(f"\nstarting {len(self.jobs)} jobs. batch size: {self.batch_size}. residency: {self.residency.strategy}")
+
+        if self.config["project"]["mode"] == "api":
+            # nothing is loaded to share in api mode, the jobs simply run one after another
+            for job in self.jobs:
+                self._run_alone(job)
+            return self._summary()
+
+        self.residency.generation_phase()
+        for job in self.jobs:
+            self._start(job)
+
+        with (self.metrics or nullcontext()):
+            active = [job for job in self.jobs if job.status == "running"]
+            while active:
+                phase = self._plan_phase(active)
+                if phase:
+                    self._run_phase(phase)
+                for job in active:
+                    if job.status == "running" and (job.exhausted() or not phase):
+                        self._finish(job)
+                active = [job for job in active if job.status == "running"]
+                self._report(force=not active)
+
+        if self.metrics is not None and self.metrics.summary():
+            print(f"\n{self.metrics.summary()}\n")
+        if self.residency.summary():
+            print(f"residency: {self.residency.summary()}")
+        return self._summary()
+
+    def _start(self, job):
+        job.started = time.time()
+        try:
+            pipeline = DatasetPipeline(generator=self.generator, detector=self.detector, config=job.config)
+            # stage timings go to the run's recorder, the encoders stay for the jobs after this one
+            pipeline.metrics = self.metrics
+            pipeline.optimize_gpu = False
+            pipeline.on_persist = job.persisted
+            job.pipeline = pipeline
+
+            pending = pipeline.prepare(job.prompt, job.det_prompt, job.count, resume=self.resume)
+            job.pending = deque(pending) if pending is not None else None
+            pipeline._warm_prompt_cache(job.prompt, pending if pending is not None else range(job.count), job.count)
+            for context in (pipeline.writer, pipeline.raw_store, pipeline.dedup):
+                if context is not None:
+                    job.stack.enter_context(context)
+            job.saved = pipeline.manifest.saved_count()
+        except Exception as e:
+            self._fail(job, e)
+            return
+        job.status = "running"
+        print(f"job {job.name}: {job.count} samples to {job.output_dir}")
+
+    def _run_alone(self, job):
+        job.started = time.time()
+        try:
+            pipeline = DatasetPipeline(generator=self.generator, detector=self.detector, config=job.config)
+            pipeline.on_persist = job.persisted
+            job.pipeline = pipeline
+            job.status = "running"
+            print(f"\njob {job.name}:")
+            pipeline.run(job.prompt, job.det_prompt, job.count, resume=self.resume)
+            job.saved = pipeline.manifest.saved_count()
+        except Exception as e:
+            self._fail(job, e)
+            return
+        job.status = "finished"
+        job.finished = time.time()
+        self._report(force=True)
+
+    def _plan_phase(self, active):
+        # batches are filled round robin across the jobs, starting one job further every batch so
+        # none of them is always last in line
+        batches_per_phase = max(1, -(-self.residency.phase_size // self.batch_size)) if self.residency.uses_phases else 1
+        phase = []
+        for _ in range(batches_per_phase):
+            batch = []
+            order = active[self._turn % len(active):] + active[:self._turn % len(active)]
+            self._turn += 1
+            while len(batch) < self.batch_size:
+                progressed = False
+                for job in order:
+                    if len(batch) >= self.batch_size:
+                        break
+                    sample = job.take()
+                    if sample is not None:
+                        batch.append((job, sample))
+                        progressed = True
+                if not progressed:
+                    break
+            if not batch:
+                break
+            phase.append(batch)
+        return phase
+
+    def _run_phase(self, phase):
+        self.residency.generation_phase()
+        for batch in phase:
+            self._isolated(batch, self._generate)
+
+        self.residency.detection_phase()
+        for batch in phase:
+            live = [(job, sample) for job, sample in batch if job.status == "running"]
+            groups = {}
+            for job, sample in live:
+                # jobs asking for the same classes share a detection call
+                key = (job.det_prompt, json.dumps(job.class_map, sort_keys=True))
+                groups.setdefault(key, []).append((job, sample))
+            for items in groups.values():
+                self._isolated(items, self._detect)
+
+            for job, samples in _by_job(live):
+                if job.status != "running":
+                    continue
+                try:
+                    job.pipeline._persist(samples)
+                except Exception as e:
+                    self._fail(job, e)
+
+    def _generate(self, items):
+        samples = [sample for _, sample in items]
+        with span("generate", samples):
+            images = self.generator.generate_batch([s.prompt for s in samples], [s.seed for s in samples])
+        images = iter(images)
+        for job, job_samples in _by_job(items):
+            job.pipeline._attach_images(job_samples, [next(images) for _ in job_samples])
+
+    def _detect(self, items):
+        job = items[0][0]
+        unique = [(j, sample) for j, sample in items if sample.duplicate_of is None]
+        if not unique:
+            return
+        samples = [sample for _, sample in unique]
+        # the detector labels with the class_map of the job it runs for, its prompt spans are cached
+        # per prompt and class_map, so jobs sharing a prompt with different maps keep their own ids
+        self.detector.class_map = job.class_map
+        with span("detect", samples):
+            results = iter(self.detector.detect_batch([s.image for s in samples], job.det_prompt))
+        for j, job_samples in _by_job(unique):
+            j.pipeline._attach_detections(job_samples, [next(results) for _ in job_samples], j.det_prompt)
+
+    def _isolated(self, items, step):
+        # a failing batch is retried job by job, only the jobs that fail on their own are stopped
+        try:
+            step(items)
+            return
+        except Exception as e:
+            grouped = _by_job(items)
+            if len(grouped) == 1:
+                self._fail(grouped[0][0], e)
+                return
+            print(f"a batch of {len(grouped)} jobs failed ({e}), retrying job by job")
+        for job, samples in _by_job(items):
+            try:
+                step([(job, sample) for sample in samples])
+            except Exception as e:
+                self._fail(job, e)
+
+    def _finish(self, job):
+        try:
+            job.stack.close()
+            job.pipeline.writer.finalize()
+        except Exception as e:
+            self._fail(job, e)
+            return
+        job.status = "finished"
+        job.finished = time.time()
+        if job.pipeline.yields is not None:
+            print("\n".join(job.pipeline.yields.report()))
+        print(f"job {job.name} finished. {job.progress}/{job.target} images saved to {job.output_dir}")
+
+    def _fail(self, job, err):
+        job.status = "failed"
+        job.error = str(err)
+        job.finished = time.time()
+        print(f"job {job.name} failed: {err}")
+        try:
+            # what the job saved so far stays usable, --resume picks it up
+            job.stack.close()
+            if job.pipeline is not None:
+                job.pipeline.writer.finalize()
+        except Exception as e:
+            print(f"job {job.name}: output not finalized: {e}")
+
+    def _report(self, force=False):
+        # progress of every job goes to <output_root>/jobs.json after every phase, and to the
+        # console every report_every seconds
+        tmp = f"{self.status_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump([job.info() for job in self.jobs], f, indent=2)
+        os.replace(tmp, self.status_path)
+
+        now = time.time()
+        if not force and (not self.report_every or now - self._last_report < self.report_every):
+            return
+        self._last_report = now
+        print("jobs: " + " | ".join(f"{job.name} {job.progress}/{job.target}" + ("" if job.status == "running" else f" {job.status}") for job in self.jobs))
+
+    def _write_class_map(self):
+        path = os.path.join(self.output_root, "class_map.yaml")
+        names = {}
+        for name, class_id in self.class_map.items():
+            names.setdefault(class_id, name)
+        with open(path, "w") as f:
+            f.write(f"# merged over {len(self.jobs)} jobs, every job's labels use these ids\n")
+            yaml.safe_dump({"class_map": self.class_map, "names": dict(sorted(names.items()))}, f, sort_keys=False)
+        print(f"merged class_map of {len(names)} classes written to {path}")
+
+    def _summary(self):
+        width = max([3] + [len(job.name) for job in self.jobs])
+        print(f"\n{'job'.ljust(width + 2)}status    saved     output")
+        for job in self.jobs:
+            saved = f"{job.progress}/{job.target}"
+            print(f"{job.name.ljust(width + 2)}{job.status.ljust(10)}{saved.ljust(10)}{job.output_dir}" + (f"  ({job.error})" if job.error else ""))
+        return [job.info() for job in self.jobs]
+
+def _by_job(items):
+    # (job, [samples]) in the order the jobs first appear
+    grouped = {}
+    for job, sample in items:
+        grouped.setdefault(id(job), (job, []))[1].append(sample)
+    return list(grouped.values())
+
+def run_jobs(generator, detector, cfg, spec, resume=False):
+    root, jobs = job_configs(cfg, spec)
+    class_map = merge_class_maps([job_cfg for _, job_cfg in jobs]) if spec.get("merge_class_maps", True) else None
+    return MultiJobRunner(generator, detector, cfg, jobs, root, class_map=class_map, resume=resume).run()
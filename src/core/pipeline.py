@@ -1,14 +1,23 @@
 import os
-import cv2
 import random
-import gc
-import torch
-import numpy as np
+import itertools
+from contextlib import nullcontext
 
-from src.utils.postprocessing import nms
-from src.utils.prompting import process_wildcards
-from src.utils.formatting import LabelFormatter
+from src.utils.postprocessing import filter_detections
+from src.utils.prompting import compile_template
+from src.utils.grounding import PromptSpans
+from src.utils.seeding import derive_seed, new_master_seed
+from src.utils.instrumentation import Instrumentation, span
 from src.core.base import BaseGenerator, BaseDetector
+from src.core.sample import Sample, normalize_format, to_pil
+from src.core.staging import StagedRunner
+from src.core.api_engine import ApiEngine
+from src.core.manifest import RunManifest
+from src.core.writers import build_writer
+from src.core.detection_cache import DetectionStore, raw_from_detections
+from src.core.dedup import DedupIndex
+from src.core.residency import ResidencyManager
+from src.core.yield_scheduler import YieldScheduler
 
 class DatasetPipeline:
     def __init__(self, generator: BaseGenerator, detector: BaseDetector, config: dict):
@@ -17,68 +26,411 @@ class DatasetPipeline:
         
         self.output_dir = config["project"]["output_dir"]
         self.output_format = config["output"]["format"]
+        self.output_layout = config["output"].get("layout", "files")
+        self.image_ext = str(config["output"].get("image_format", "jpg")).lower().lstrip(".")
+        self.image_format = normalize_format(self.image_ext)
+        self.image_quality = int(config["output"].get("image_quality", 95))
         self.save_empty = config["system"].get("save_empty_images", False)
         self.class_map = config["detection"].get("class_map", {})
+        self.nms_cfg = config["detection"].get("nms") or {}
+        self.batch_size = max(1, int(config["generation"].get("batch_size", 1)))
+        self.master_seed = config["generation"].get("seed")
+        self.prompt_sampling = config["generation"].get("sampling", "random")
+        # when set, count is the most samples tried to get target_saved samples with detections
+        self.target_saved = config["generation"].get("target_saved")
+        if self.target_saved:
+            self.prompt_sampling = "adaptive"
+        self.yields = None
+        self.group_by_prompt = config["generation"].get("group_by_prompt", False)
+        self.optimize_gpu = config["system"].get("optimize_gpu", False)
+        self._schedule = None
+        self.pipelined = config["system"].get("pipelined", False)
+        self.queue_size = max(1, int(config["system"].get("queue_size", 2)))
+        
+        api_cfg = config.get("api") or {}
+        self.mode = config["project"].get("mode", "local")
+        self.api_concurrency = max(1, int(api_cfg.get("concurrency", 1)))
+        self.max_consecutive_failures = api_cfg.get("max_consecutive_failures", 10)
         
         self.paths = {
-            "images": os.path.join(self.output_dir, "images"),
             "debug": os.path.join(self.output_dir, "debug")
         }
         for path in self.paths.values():
             os.makedirs(path, exist_ok=True)
+        self._debug_font = None
+            
+        self.manifest = RunManifest(self.output_dir)
+        # images and labels go through one writer, it keeps its files open for the whole run
+        self.writer = build_writer(config)
+        
+        # unthresholded detector outputs, labels can be rebuilt from them with --relabel
+        raw_cfg = config["detection"].get("raw_cache") or {}
+        self.raw_store = DetectionStore.from_config(self.output_dir, raw_cfg) if raw_cfg.get("enabled") else None
+        self._raw_spans = {}
+        
+        # near duplicate images are dropped after generation, against everything saved to output_dir
+        dedup_cfg = config.get("dedup") or {}
+        self.dedup = DedupIndex.from_config(self.output_dir, dedup_cfg) if dedup_cfg.get("enabled") else None
+        
+        # stage timings, throughput and vram, exported to <output_dir>/metrics
+        metrics_cfg = config.get("instrumentation") or {}
+        self.metrics = Instrumentation.from_config(self.output_dir, metrics_cfg) if metrics_cfg.get("enabled", True) else None
+        
+        # where the models live during a local run, see ResidencyManager
+        self.residency = ResidencyManager.from_config(generator, detector, config)
+        # called with the samples of every persisted batch and how many of them were saved
+        self.on_persist = None
 
-    def run(self, gen_prompt: str, det_prompt: str, count: int):
-        print(f"\nstarting pipeline. target: {count} samples. format: {self.output_format}")
+    def run(self, gen_prompt: str, det_prompt: str, count: int, resume: bool = False):
+        pending = self.prepare(gen_prompt, det_prompt, count, resume)
         
-        saved_count = 0
+        if self.mode == "api":
+            mode = f"api, {self.api_concurrency} in flight"
+        else:
+            mode = "pipelined" if self.pipelined else "serial"
+        target = f"{self.target_saved} samples with detections within {count} attempts" if self.target_saved else f"{count} samples"
+        print(f"\nstarting pipeline. target: {target}. format: {self.output_format} ({self.output_layout}). batch size: {self.batch_size}. mode: {mode}. master seed: {self.master_seed}")
+        print(f"prompt template: {compile_template(gen_prompt).count()} combinations, {self.prompt_sampling} sampling")
+        
+        self.execute(gen_prompt, det_prompt, pending, count)
+        self.writer.finalize()
+        
+        if self.metrics is not None and self.metrics.summary():
+            print(f"\n{self.metrics.summary()}\n")
+        if self.residency.summary():
+            print(f"residency: {self.residency.summary()}")
+        if self.yields is not None:
+            print("\n".join(self.yields.report()))
+            # saved empty images don't count toward the target
+            print(f"pipeline finished. {self.yields.found}/{self.target_saved} samples with detections, {self.manifest.saved_count()} images saved to {self.output_dir}")
+        else:
+            print(f"pipeline finished. {self.manifest.saved_count()}/{count} images saved to {self.output_dir}")
+
+    def execute(self, gen_prompt, det_prompt, pending, count):
+        # pending can be any iterable of sample indices, it is consumed lazily
+        if self.mode != "api":
+            self.residency.generation_phase()
+        self._warm_prompt_cache(gen_prompt, pending if isinstance(pending, list) else range(count), count)
+        
+        with self.writer, (self.raw_store or nullcontext()), (self.dedup or nullcontext()), (self.metrics or nullcontext()):
+            if self.yields is None:
+                self._dispatch(gen_prompt, det_prompt, pending, count)
+                return
+            
+            # a round ends once every sample handed out is persisted. the next one asks for as many
+            # samples as the rest of the target needs at the yield measured so far
+            while not self.yields.done():
+                self._dispatch(gen_prompt, det_prompt, self.yields.indices(), count)
+
+    def _dispatch(self, gen_prompt, det_prompt, pending, count):
+        if self.mode == "api":
+            self._run_api(gen_prompt, det_prompt, pending, count)
+        elif self.pipelined and self.residency.uses_phases:
+            print(f"pipelined mode needs both models on the card, running {self.residency.strategy} instead")
+            self._run_serial(gen_prompt, det_prompt, pending, count)
+        elif self.pipelined:
+            self._run_pipelined(gen_prompt, det_prompt, pending, count)
+        else:
+            self._run_serial(gen_prompt, det_prompt, pending, count)
+
+    def prepare(self, gen_prompt, det_prompt, count, resume=False):
+        run_info = {
+            "prompt": gen_prompt,
+            "detection_prompt": det_prompt,
+            "format": self.output_format,
+            "layout": self.output_layout,
+            "image_format": self.image_ext,
+            "sampling": self.prompt_sampling,
+            "target_saved": self.target_saved
+        }
+        
+        if resume and not self.manifest.exists():
+            print(f"no manifest to resume from in {self.output_dir}. starting a new run.")
+            resume = False
+        
+        if self.dedup is not None and self.manifest.exists():
+            # images saved before dedup was turned on are hashed once, from the latest manifest
+            previous = RunManifest(self.output_dir).load()
+            self.dedup.backfill(previous.samples.values(), (previous.header or {}).get("image_format", self.image_ext))
+            
+        if resume:
+            # shard manifests left behind by an interrupted sharded run are folded in first
+            self.manifest.merge_shards()
+            header = self.manifest.load().header or {}
+            for key, value in run_info.items():
+                # a target can be raised for a run that already reached it
+                if key != "target_saved" and header.get(key) != value:
+                    raise ValueError(f"can't resume: '{key}' differs from the manifest in {self.output_dir}")
+            if self.master_seed is not None and self.master_seed != header.get("master_seed"):
+                raise ValueError(f"can't resume: master seed {self.master_seed} differs from the manifest ({header.get('master_seed')})")
+            
+            self.master_seed = header["master_seed"]
+            # failed, missing and samples whose files are gone run again
+            pending = [i for i in range(count) if not self.manifest.is_finished(i)]
+            if not self.target_saved:
+                print(f"resuming run. {count - len(pending)} samples already finished, {len(pending)} to go.")
+        else:
+            if self.master_seed is None:
+                self.master_seed = new_master_seed()
+            self.manifest.start(master_seed=self.master_seed, count=count, **run_info)
+            pending = list(range(count))
+            
+        if self.target_saved:
+            # indices are handed out by the scheduler as the run goes, see execute
+            self.yields = YieldScheduler(compile_template(gen_prompt), self.master_seed, self.target_saved, count)
+            if resume:
+                self.yields.load(self.manifest.samples.values())
+                print(f"resuming run. {self.yields.found}/{self.target_saved} samples with detections after {self.yields.next_index} attempts.")
+            return None
+            
+        if self.group_by_prompt:
+            # samples sharing a prompt end up in the same batches, which keeps embedding reuse high
+            template = compile_template(gen_prompt)
+            pending.sort(key=lambda i: (self.combination(template, i, count), i))
+        return pending
+
+    def combination(self, template, index, count):
+        # which combination of the prompt template a sample gets, from the master seed and its index only
+        if self.prompt_sampling == "adaptive":
+            # also from the yields measured so far
+            return self.yields.choose(index)
+        if self.prompt_sampling == "random":
+            return template.sample_index(random.Random(derive_seed(self.master_seed, index)))
+        if self.prompt_sampling == "round_robin":
+            return index % template.count()
+        
+        key = (template.text, count, self.master_seed, self.prompt_sampling)
+        if self._schedule is None or self._schedule[0] != key:
+            self._schedule = (key, template.schedule(self.prompt_sampling, count, random.Random(self.master_seed)))
+        return self._schedule[1][index]
+
+    def _warm_prompt_cache(self, gen_prompt, indices, count):
+        cache = getattr(self.generator, "embedding_cache", None)
+        if cache is None or not hasattr(self.generator, "warm_prompt_cache"):
+            return
+        
+        template = compile_template(gen_prompt)
+        if self.yields is not None:
+            # combinations are only picked as the run goes, every one of them may come up
+            combinations = set(range(template.count())) if template.count() <= (cache.max_entries or template.count()) else set()
+        else:
+            combinations = {self.combination(template, i, count) for i in indices}
+        if not combinations or len(combinations) > (cache.max_entries or len(combinations)):
+            return
+        
+        # with every prompt encoded up front the text encoders are never needed during the run.
+        # under sequential offload they are dropped altogether
+        print(f"encoding {len(combinations)} distinct prompts up front...")
+        self.generator.warm_prompt_cache(
+            [template.render(c) for c in sorted(combinations)],
+            release_encoders=self.optimize_gpu
+        )
+
+    def _run_serial(self, gen_prompt, det_prompt, pending, count):
+        if not self.residency.uses_phases:
+            for samples in self._plan_batches(gen_prompt, pending, count):
+                self._generate(samples)
+                self._detect(samples, det_prompt)
+                self._persist(samples)
+            return
         
-        for i in range(count):
-            gc.collect()
-            torch.cuda.empty_cache()
+        # a phase generates phase_size samples with the detector offloaded, then detects all of them
+        # with the generator offloaded. every model is moved once per phase instead of once per batch
+        batches = self._plan_batches(gen_prompt, pending, count)
+        batches_per_phase = max(1, -(-self.residency.phase_size // self.batch_size))
+        while True:
+            phase = list(itertools.islice(batches, batches_per_phase))
+            if not phase:
+                break
             
-            current_seed = random.randint(0, 2**32 - 1)
-            current_prompt = process_wildcards(gen_prompt)
-            print(f"[{i+1}/{count}] generating... seed: {current_seed}")
-            print(f"prompt: {current_prompt}")
+            self.residency.generation_phase()
+            for samples in phase:
+                self._generate(samples)
             
-            image = self.generator.generate(current_prompt, seed=current_seed)
-            w, h = image.size
+            self.residency.detection_phase()
+            for samples in phase:
+                self._detect(samples, det_prompt)
+                self._persist(samples)
+
+    def _run_pipelined(self, gen_prompt, det_prompt, pending, count):
+        # generation, detection and disk writes run in their own workers with bounded queues in between.
+        # seeds and prompts come from the same schedule, so output matches the serial mode
+        def generate_stage():
+            for samples in self._plan_batches(gen_prompt, pending, count):
+                yield self._generate(samples)
+                
+        def detect_stage(samples):
+            return self._detect(samples, det_prompt)
+        
+        def persist_stage(samples):
+            self._persist(samples)
             
-            results = self.detector.detect(image, det_prompt)
+        StagedRunner(queue_size=self.queue_size).run(generate_stage, detect_stage, persist_stage)
+
+    def _run_api(self, gen_prompt, det_prompt, pending, count):
+        # remote generation and detection are io bound, several samples are kept in flight at once.
+        # a failed sample is recorded in the manifest and skipped instead of stopping the run
+        consecutive_failures = 0
+        
+        def process(sample):
+            self._generate([sample])
+            self._detect([sample], det_prompt)
+            return sample
+        
+        samples = (sample for batch in self._plan_batches(gen_prompt, pending, count) for sample in batch)
+        for sample, _, err in ApiEngine(self.api_concurrency).map(process, samples):
+            if err is not None:
+                self._record_failure(sample, err)
+                consecutive_failures += 1
+                if self.max_consecutive_failures and consecutive_failures >= self.max_consecutive_failures:
+                    raise RuntimeError(f"{consecutive_failures} samples failed in a row, stopping. last error: {err}") from err
+                continue
             
-            keep_indices = nms(results["boxes"], results["scores"])
-            final_boxes = [results["boxes"][k] for k in keep_indices]
-            final_scores = [results["scores"][k] for k in keep_indices]
-            final_labels = [results["labels"][k] for k in keep_indices]
+            consecutive_failures = 0
+            self._persist([sample])
+
+    def _record_failure(self, sample, err):
+        print(f"sample {sample.index} failed: {err}")
+        if self.yields is not None:
+            self.yields.release(sample.index)
+        self._release_hash(sample)
+        self.manifest.record(sample, "failed", error=err)
+
+    def _plan_batches(self, gen_prompt, pending, count):
+        pending = iter(pending)
+        while True:
+            indices = list(itertools.islice(pending, self.batch_size))
+            if not indices:
+                break
             
-            if not self.save_empty and len(final_boxes) == 0:
-                print(f"samle {i} skipped: no objects detected.")
+            # every image in the batch gets its own seed and its own wildcard expansion,
+            # both derived from the master seed and the sample index only
+            template = compile_template(gen_prompt)
+            samples = []
+            for i in indices:
+                current_seed = derive_seed(self.master_seed, i)
+                combination = self.combination(template, i, count)
+                current_prompt = template.render(combination)
+                print(f"[{i+1}/{count}] generating... seed: {current_seed}")
+                print(f"prompt: {current_prompt}")
+                samples.append(Sample(index=i, seed=current_seed, prompt=current_prompt, combination=combination))
+            yield samples
+
+    def _generate(self, samples):
+        with span("generate", samples):
+            images = self.generator.generate_batch([s.prompt for s in samples], [s.seed for s in samples])
+        return self._attach_images(samples, images)
+
+    def _attach_images(self, samples, images):
+        for sample, image in zip(samples, images):
+            sample.image = image
+        if self.dedup is not None:
+            with span("dedup", samples):
+                self.dedup.check(samples)
+        return samples
+
+    def _detect(self, samples, det_prompt):
+        unique = [s for s in samples if s.duplicate_of is None]
+        if len(unique) < len(samples):
+            # near duplicates aren't detected, they won't be saved
+            if unique:
+                self._detect(unique, det_prompt)
+            return samples
+        
+        with span("detect", samples):
+            batch_results = self.detector.detect_batch([s.image for s in samples], det_prompt)
+        return self._attach_detections(samples, batch_results, det_prompt)
+
+    def _attach_detections(self, samples, batch_results, det_prompt):
+        if self.raw_store is not None:
+            for sample, results in zip(samples, batch_results):
+                sample.raw = results.get("raw") or self._raw_from_results(sample, results, det_prompt)
+        
+        return self._assign_detections(samples, batch_results)
+
+    def _raw_from_results(self, sample, results, det_prompt):
+        # detectors without token outputs only give thresholded boxes, those are cached instead
+        if det_prompt not in self._raw_spans:
+            names = [c.strip() for c in det_prompt.split(".") if c.strip()]
+            self._raw_spans[det_prompt] = PromptSpans.from_names(names, self.class_map)
+        w, h = sample.image.size
+        return raw_from_detections(results, w, h, self._raw_spans[det_prompt])
+
+    def _assign_detections(self, samples, batch_results):
+        # nms runs once over the whole batch, grouped by image and class
+        with span("nms", samples):
+            filtered = filter_detections(batch_results, self.nms_cfg)
+        for sample, results in zip(samples, filtered):
+            sample.boxes = results["boxes"]
+            sample.scores = results["scores"]
+            sample.labels = results["labels"]
+            sample.class_ids = results["class_ids"]
+        return samples
+
+    def _persist(self, samples):
+        saved_count = 0
+        
+        for sample in samples:
+            if sample.duplicate_of is not None:
+                print(f"sample {sample.index} skipped: near duplicate of {sample.duplicate_of}.")
+                self.manifest.record(sample, "duplicate")
+                # never detected, says nothing about the yield of its prompt
+                if self.yields is not None:
+                    self.yields.release(sample.index)
                 continue
             
-            filename = f"sample_{i:04d}_{current_seed}"
+            if self.yields is not None and not self.yields.accept(sample):
+                print(f"sample {sample.index} skipped: target of {self.target_saved} samples reached.")
+                self.manifest.record(sample, "surplus")
+                self._release_hash(sample)
+                continue
             
-            image.save(os.path.join(self.paths["images"], f"{filename}.jpg"))
+            if not self.save_empty and len(sample.boxes) == 0:
+                print(f"samle {sample.index} skipped: no objects detected.")
+                self.manifest.record(sample, "empty", self._store_raw(sample))
+                self._release_hash(sample)
+                continue
             
-            LabelFormatter.save(
-                self.output_format, 
-                final_boxes, 
-                final_labels, 
-                filename, 
-                self.output_dir, 
-                w, h,
-                class_map=self.class_map
-            )
+            filename = sample.filename
+            w, h = sample.image.size
+            paths = self.writer.write(sample, w, h)
             
-            self._save_debug(image, final_boxes, final_scores, final_labels, filename)
+            with span("debug", [sample]):
+                self._save_debug(sample.image, sample.boxes, sample.scores, sample.labels, filename)
+            paths["debug"] = os.path.join("debug", f"{filename}_debug.{self.image_ext}")
+            paths.update(self._store_raw(sample))
+            if self.dedup is not None:
+                self.dedup.saved(sample, paths)
+            self.manifest.record(sample, "saved", paths)
             saved_count += 1
             
-        print(f"pipeline finished. {saved_count}/{count} images saved to {self.output_dir}")
+        if self.metrics is not None:
+            self.metrics.sample_finished(len(samples))
+        if self.on_persist is not None:
+            self.on_persist(samples, saved_count)
+        return saved_count
+
+    def _release_hash(self, sample):
+        if self.dedup is not None:
+            self.dedup.release(sample)
+
+    def _store_raw(self, sample):
+        if self.raw_store is None or sample.raw is None:
+            return {}
+        return {"raw": self.raw_store.add(sample, sample.raw)}
 
     def _save_debug(self, image, boxes, scores, labels, filename):
-        cv_img = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+        from PIL import ImageDraw, ImageFont
+
+        if self._debug_font is None:
+            # the bitmap font, pillow's truetype default takes milliseconds per label
+            self._debug_font = ImageFont.load_default_imagefont()
+        debug_img = to_pil(image).convert("RGB")
+        draw = ImageDraw.Draw(debug_img)
         for box, score, label in zip(boxes, scores, labels):
             x1, y1, x2, y2 = map(int, box)
-            cv2.rectangle(cv_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(cv_img, f"{label} {score:.2f}", (x1, y1-10), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-        cv2.imwrite(os.path.join(self.paths["debug"], f"{filename}_debug.jpg"), cv_img)
\ No newline at end of file
+            draw.rectangle((x1, y1, x2, y2), outline=(0, 255, 0), width=2)
+            draw.text((x1, max(0, y1 - 12)), f"{label} {score:.2f}", fill=(0, 255, 0), font=self._debug_font)
+        
+        params = {"quality": self.image_quality} if self.image_format in ("JPEG", "WEBP") else {}
+        debug_img.save(os.path.join(self.paths["debug"], f"{filename}_debug.{self.image_ext}"), format=self.image_format, **params)
\ No newline at end of file
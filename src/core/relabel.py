@@ -0,0 +1,126 @@
+import copy
+import json
+import os
+import time
+
+from src.core.detection_cache import DetectionStore
+from src.core.manifest import RunManifest, FINISHED
+from src.core.pipeline import DatasetPipeline
+from src.core.sample import Sample, EncodedImage
+from src.utils.grounding import decode_detections
+
+def relabel(cfg, output_dir=None, batch_size=64):
+    # rebuilds labels, debug overlays and exports of a finished run from its raw detection cache,
+    # using the detection and output settings of the current config. no model is loaded
+    source_dir = cfg["project"]["output_dir"]
+    output_dir = output_dir or f"{source_dir.rstrip(os.sep)}_relabel"
+    if os.path.abspath(output_dir) == os.path.abspath(source_dir):
+        raise ValueError("relabel writes into a new output dir, not into the run it reads from")
+
+    manifest = RunManifest(source_dir)
+    if not manifest.exists():
+        raise ValueError(f"no manifest in {source_dir}, nothing to relabel")
+    manifest.merge_shards()
+    header = manifest.load().header or {}
+
+    store = DetectionStore(source_dir)
+    if not store.exists():
+        raise ValueError(f"no raw detection cache in {source_dir}. enable detection.raw_cache for the run first")
+    spans = store.prompt_spans(cfg["detection"].get("class_map"))
+    box_threshold = cfg["detection"]["box_threshold"]
+    text_threshold = cfg["detection"]["text_threshold"]
+    if box_threshold < store.stored_min_score():
+        print(f"warning: box_threshold {box_threshold} is below the cache's min_score {store.stored_min_score()}, "
+              f"boxes in between weren't stored")
+
+    target_cfg = copy.deepcopy(cfg)
+    target_cfg["project"]["output_dir"] = output_dir
+    target_cfg["detection"]["raw_cache"] = {"enabled": False}
+    # the relabeled run covers the samples of the source run, nothing is scheduled
+    target_cfg["generation"]["target_saved"] = None
+    target_cfg["generation"]["group_by_prompt"] = False
+    # the source run's images were deduplicated already
+    target_cfg["dedup"] = {"enabled": False}
+    pipeline = DatasetPipeline(generator=None, detector=None, config=target_cfg)
+    pipeline.master_seed = header["master_seed"]
+    pipeline.prompt_sampling = header.get("sampling", pipeline.prompt_sampling)
+    pipeline.prepare(header["prompt"], header["detection_prompt"], header["count"])
+
+    records = [r for r in manifest.samples.values() if r["status"] in FINISHED and "raw" in r["paths"]]
+    # chunk order, every chunk is loaded once
+    records.sort(key=lambda r: (r["paths"]["raw"], r["index"]))
+    print(f"\nrelabeling {len(records)} samples from {source_dir} into {output_dir}. "
+          f"classes: {', '.join(f'{n} -> {c}' for n, c in zip(spans.names, spans.class_ids))}")
+
+    images = _ImageSource(source_dir, header.get("image_format", "jpg"))
+    start = time.time()
+    missing = 0
+    with pipeline.writer:
+        for i in range(0, len(records), batch_size):
+            samples, batch_results = [], []
+            for record in records[i:i + batch_size]:
+                image = images.read(record)
+                if image is None:
+                    # empty samples of a run without save_empty_images have no image to label
+                    missing += 1
+                    continue
+
+                sample = Sample(index=record["index"], seed=record["seed"], prompt=record["prompt"], combination=record.get("combination"))
+                sample.image = image
+                raw = store.read(record["paths"]["raw"], sample.index)
+                boxes, scores, classes = decode_detections(
+                    raw["boxes"], spans.span_scores(raw["token_probs"]), box_threshold, raw["width"], raw["height"], text_threshold
+                )
+                labels, class_ids = spans.labels(classes)
+                samples.append(sample)
+                batch_results.append({
+                    "boxes": boxes,
+                    "scores": scores,
+                    "labels": labels,
+                    "class_ids": class_ids
+                })
+
+            pipeline._assign_detections(samples, batch_results)
+            pipeline._persist(samples)
+    pipeline.writer.finalize()
+
+    counts = pipeline.manifest.status_counts()
+    print(f"relabel finished in {time.time() - start:.1f}s. {counts.get('saved', 0)} saved, {counts.get('empty', 0)} empty, "
+          f"{missing} without an image in {source_dir}")
+
+class _ImageSource:
+    # reads the encoded images of a run back, from images/ or from its tar shards
+    def __init__(self, source_dir, image_ext):
+        self.source_dir = source_dir
+        self.image_ext = image_ext
+        self._tar_index = None
+
+    def read(self, record):
+        paths = record["paths"]
+        if "image" in paths:
+            path = os.path.join(self.source_dir, paths["image"])
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                return EncodedImage(f.read(), self.image_ext)
+
+        if "shard" in paths:
+            entry = self._index().get(record["index"])
+            if entry is None or self.image_ext not in entry["members"]:
+                return None
+            offset, size = entry["members"][self.image_ext]
+            with open(os.path.join(self.source_dir, "shards", entry["shard"]), "rb") as f:
+                f.seek(offset)
+                return EncodedImage(f.read(size), self.image_ext)
+        return None
+
+    def _index(self):
+        if self._tar_index is None:
+            self._tar_index = {}
+            path = os.path.join(self.source_dir, "shards", "index.jsonl")
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        self._tar_index[entry["index"]] = entry
+        return self._tar_index
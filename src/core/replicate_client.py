@@ -0,0 +1,104 @@
+import threading
+import time
+
+from src.utils.ratelimit import TokenBucket, backoff_delay
+
+class ApiRequestError(Exception):
+    pass
+
+class ReplicateClient:
+    def __init__(self, api_token=None, base_url=None, requests_per_second=0, burst=None,
+                 max_retries=5, backoff_base=1.0, backoff_max=30.0, pool_size=16, timeout=120):
+        import replicate
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # one client for every request, it keeps its own keep-alive connection pool
+        client_args = {"api_token": api_token, "timeout": timeout}
+        if base_url:
+            client_args["base_url"] = base_url
+        self.client = replicate.Client(**client_args)
+
+        # pooled keep-alive session for output downloads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.limiter = TokenBucket(requests_per_second, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.versions = {}
+        self.versions_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        api_cfg = cfg.get("api", {}) or {}
+        return cls(
+            base_url=api_cfg.get("base_url"),
+            requests_per_second=api_cfg.get("requests_per_second", 0),
+            burst=api_cfg.get("burst"),
+            max_retries=api_cfg.get("max_retries", 5),
+            backoff_base=api_cfg.get("backoff_base", 1.0),
+            backoff_max=api_cfg.get("backoff_max", 30.0),
+            pool_size=max(16, 2 * api_cfg.get("concurrency", 1))
+        )
+
+    def run(self, model_id, input_args):
+        from replicate.exceptions import ReplicateError
+        import httpx
+
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                return self.client.run(self._resolve_ref(model_id), input=input_args)
+            except (ReplicateError, httpx.TransportError) as e:
+                status = getattr(e, "status", None)
+                # client errors other than rate limiting won't get better by retrying
+                if status is not None and status != 429 and status < 500:
+                    raise ApiRequestError(f"replicate rejected the request ({status}): {e}") from e
+                if attempt == self.max_retries:
+                    raise ApiRequestError(f"replicate request failed after {self.max_retries} retries: {e}") from e
+                
+                wait_sec = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                print(f"replicate request failed ({status or type(e).__name__}). retrying in {wait_sec:.1f} seconds...")
+                
+                # rewind file inputs so the retry uploads them again
+                for value in input_args.values():
+                    if hasattr(value, "seek"):
+                        value.seek(0)
+                time.sleep(wait_sec)
+
+    def _resolve_ref(self, model_id):
+        # replicate.run looks a pinned version up on every call, it only needs to be fetched once
+        if ":" not in model_id:
+            return model_id
+        with self.versions_lock:
+            if model_id not in self.versions:
+                from replicate.version import Versions
+                model, version_id = model_id.split(":", 1)
+                owner, name = model.split("/", 1)
+                self.versions[model_id] = Versions(self.client, model=(owner, name)).get(version_id)
+            return self.versions[model_id]
+
+    def download(self, url):
+        import requests
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(str(url), timeout=self.timeout)
+                response.raise_for_status()
+                return response.content
+            except requests.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                # an expired or missing output url (404, 410) won't come back, only connection
+                # errors, timeouts, rate limiting and server errors are retried
+                if status is not None and status != 429 and status < 500:
+                    raise ApiRequestError(f"couldn't download {url} ({status}): {e}") from e
+                if status is None and not isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+                    raise ApiRequestError(f"couldn't download {url}: {e}") from e
+                if attempt == self.max_retries:
+                    raise ApiRequestError(f"couldn't download {url}: {e}") from e
+                time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
@@ -0,0 +1,144 @@
+STRATEGIES = ("auto", "resident", "phased", "sequential")
+
+GB = 1024 ** 3
+
+def module_bytes(*modules):
+    # parameter and buffer bytes of torch modules, what they take on the card before activations
+    total = 0
+    for module in modules:
+        if module is None or not hasattr(module, "parameters"):
+            continue
+        total += sum(p.numel() * p.element_size() for p in module.parameters())
+        total += sum(b.numel() * b.element_size() for b in module.buffers())
+    return total
+
+class ResidencyManager:
+    # decides where the generator and detector live while a local run goes on:
+    #   resident    both models stay on the card, nothing is moved
+    #   phased      phase_size samples are generated with the detector offloaded, then all of them
+    #               are detected with the generator offloaded. 2 swaps per phase instead of per image
+    #   sequential  the generator runs with sequential cpu offload, the detector is swapped per phase
+    # auto picks the first one that fits into the free vram of the card
+    def __init__(self, generator, detector, strategy="auto", phase_size=32, headroom_gb=4.0):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"unknown residency strategy '{strategy}'. options: {', '.join(STRATEGIES)}")
+        self.generator = generator
+        self.detector = detector
+        self.requested = strategy
+        self.strategy = None
+        self.phase_size = max(1, int(phase_size))
+        # activations, latents and the vae decode need room on top of the weights
+        self.headroom = float(headroom_gb) * GB
+        self.swaps = 0
+        self.phases = 0
+
+    @classmethod
+    def from_config(cls, generator, detector, config):
+        system = config["system"]
+        strategy = system.get("residency", "auto")
+        if system.get("optimize_gpu") and strategy == "auto":
+            # the old switch, the generator was already put into sequential offload when it was loaded
+            strategy = "sequential"
+        return cls(
+            generator,
+            detector,
+            strategy=strategy,
+            phase_size=system.get("phase_size", 32),
+            headroom_gb=system.get("vram_headroom_gb", 4.0)
+        )
+
+    @property
+    def uses_phases(self):
+        return self.strategy in ("phased", "sequential")
+
+    def plan(self):
+        if self.strategy is not None:
+            return self.strategy
+
+        if not (self._movable(self.generator) or self._movable(self.detector)):
+            # api and fake backends, nothing lives on a card
+            self.strategy = "resident"
+            return self.strategy
+
+        gen_bytes = self._footprint(self.generator)
+        det_bytes = self._footprint(self.detector)
+        available = self._available()
+        if self.requested != "auto":
+            self.strategy, reason = self.requested, "set in config"
+        elif available is None:
+            self.strategy, reason = "resident", "no cuda device to measure"
+        elif self._device(self.generator) != self._device(self.detector):
+            self.strategy, reason = "resident", "models are on separate devices"
+        elif gen_bytes + det_bytes + self.headroom <= available:
+            self.strategy, reason = "resident", "both models fit"
+        elif max(gen_bytes, det_bytes) + self.headroom <= available:
+            self.strategy, reason = "phased", "one model fits at a time"
+        else:
+            self.strategy, reason = "sequential", "the generator doesn't fit on its own"
+
+        if self.strategy == "sequential" and hasattr(self.generator, "enable_sequential_offload"):
+            self.generator.enable_sequential_offload()
+        if hasattr(self.detector, "keep_resident"):
+            # placement is handled per phase from here on, not after every detect call
+            self.detector.keep_resident = True
+
+        free = f"{available / GB:.1f}GB" if available is not None else "unknown"
+        phase = f", {self.phase_size} samples per phase" if self.uses_phases else ""
+        print(f"residency plan: {self.strategy} ({reason}). free vram: {free}, generator: {gen_bytes / GB:.1f}GB, "
+              f"detector: {det_bytes / GB:.1f}GB, headroom: {self.headroom / GB:.1f}GB{phase}")
+        return self.strategy
+
+    def generation_phase(self):
+        self.plan()
+        if self.uses_phases:
+            self._offload(self.detector)
+        self._to_device(self.generator)
+
+    def detection_phase(self):
+        self.plan()
+        if self.strategy == "phased":
+            self._offload(self.generator)
+        self._to_device(self.detector)
+        self.phases += 1
+
+    def summary(self):
+        if not self.uses_phases:
+            return None
+        return f"{self.swaps} model swaps over {self.phases} phases"
+
+    def _to_device(self, model):
+        if self._movable(model) and not getattr(model, "on_device", True):
+            model.to_device()
+            # a generator under sequential offload stays where it is
+            self.swaps += int(getattr(model, "on_device", False))
+
+    def _offload(self, model):
+        if self._movable(model) and getattr(model, "on_device", False):
+            model.offload()
+
+    def _available(self):
+        # free memory of the card, plus whatever our own models already hold on it
+        device = self._device(self.generator) or self._device(self.detector)
+        try:
+            import torch
+            if device is None or not torch.cuda.is_available() or torch.device(device).type != "cuda":
+                return None
+            free, _ = torch.cuda.mem_get_info(torch.device(device))
+        except (ImportError, RuntimeError):
+            return None
+        for model in (self.generator, self.detector):
+            if getattr(model, "on_device", False):
+                free += self._footprint(model)
+        return free
+
+    @staticmethod
+    def _movable(model):
+        return hasattr(model, "to_device") and hasattr(model, "offload")
+
+    @staticmethod
+    def _footprint(model):
+        return model.footprint() if hasattr(model, "footprint") else 0
+
+    @staticmethod
+    def _device(model):
+        return str(model.device) if getattr(model, "device", None) is not None else None
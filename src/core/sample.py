@@ -0,0 +1,92 @@
+from dataclasses import dataclass, field
+
+@dataclass
+class Sample:
+    index: int
+    seed: int
+    prompt: str
+    combination: int = None
+    image: object = None
+    boxes: list = field(default_factory=list)
+    scores: list = field(default_factory=list)
+    labels: list = field(default_factory=list)
+    # resolved by the detector, None when it only returns label strings
+    class_ids: list = None
+    # unthresholded detector outputs, only kept when the raw detection cache is on
+    raw: dict = None
+    # key of the saved image this one is a near duplicate of, see DedupIndex
+    duplicate_of: str = None
+
+    @property
+    def filename(self):
+        return f"sample_{self.index:04d}_{self.seed}"
+
+
+# pillow format names for the extensions used in config
+IMAGE_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}
+
+def normalize_format(fmt):
+    if fmt is None:
+        return None
+    return IMAGE_FORMATS.get(str(fmt).lower().lstrip("."), str(fmt).upper())
+
+class EncodedImage:
+    # keeps the encoded bytes a backend returned and decodes them only when pixels are needed.
+    # exposes size and save like a pillow image so it can be passed around in place of one
+    def __init__(self, data: bytes, fmt: str = None):
+        self.data = data
+        self.format = normalize_format(fmt) or self._sniff_format(data)
+        self._image = None
+        self._size = None
+
+    @staticmethod
+    def _sniff_format(data):
+        if data[:3] == b"\xff\xd8\xff":
+            return "JPEG"
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return "PNG"
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return "WEBP"
+        return None
+
+    @property
+    def image(self):
+        if self._image is None:
+            from io import BytesIO
+            from PIL import Image
+            self._image = Image.open(BytesIO(self.data))
+            self._image.load()
+        return self._image
+
+    @property
+    def is_decoded(self):
+        return self._image is not None
+
+    @property
+    def size(self):
+        if self._image is not None:
+            return self._image.size
+        if self._size is None:
+            from io import BytesIO
+            from PIL import Image
+            # only the header is parsed here, pixels stay encoded
+            with Image.open(BytesIO(self.data)) as header:
+                self._size = header.size
+                self.format = self.format or header.format
+        return self._size
+
+    def save(self, fp, format=None, **params):
+        # same format means the original bytes are written as they are, without generation loss
+        if format is None and isinstance(fp, str):
+            format = fp.rsplit(".", 1)[-1]
+        if normalize_format(format) == self.format:
+            if isinstance(fp, str):
+                with open(fp, "wb") as f:
+                    f.write(self.data)
+            else:
+                fp.write(self.data)
+            return
+        self.image.save(fp, format=normalize_format(format), **params)
+
+def to_pil(image):
+    return image.image if isinstance(image, EncodedImage) else image
@@ -0,0 +1,465 @@
+import copy
+import itertools
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from src.core.client import JOB_KEYS
+from src.core.factory import build_backends
+from src.core.pipeline import DatasetPipeline
+from src.core.residency import ResidencyManager
+from src.core.sharding import shard_devices
+
+# a long lived process that loads the models once and runs dataset jobs against them. jobs come in
+# over localhost http (see client.py) and queue up, clients take turns in the queue. when both models
+# stay on the card, up to max_active_jobs run at once and their batches take turns on the models
+
+# events a job keeps for clients that connect late, older ones are dropped
+MAX_EVENTS = 5000
+TERMINAL = ("finished", "failed", "cancelled")
+
+class Job:
+    def __init__(self, job_id, client, config, resume=False):
+        self.id = job_id
+        self.client = client
+        self.config = config
+        self.resume = resume
+        self.status = "queued"
+        self.error = None
+        self.done = 0
+        self.saved = 0
+        # samples with detections, for target_saved jobs. saved also counts saved empty images
+        self.found = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._events = deque(maxlen=MAX_EVENTS)
+        self._next_seq = 0
+        self._partial = ""
+        self._cond = threading.Condition()
+
+    @property
+    def output_dir(self):
+        return self.config["project"]["output_dir"]
+
+    def info(self):
+        generation = self.config["generation"]
+        return {
+            "id": self.id,
+            "client": self.client,
+            "status": self.status,
+            "error": self.error,
+            "prompt": generation["prompt"],
+            "count": generation["count"],
+            "target_saved": generation.get("target_saved"),
+            "done": self.done,
+            "saved": self.saved,
+            "found": self.found,
+            "output_dir": self.output_dir,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+    def set_status(self, status, error=None):
+        self.status = status
+        self.error = error
+        if status == "running":
+            self.started = time.time()
+        elif status in TERMINAL:
+            self.finished = time.time()
+        self.emit("status", status=status, error=error)
+
+    def persisted(self, samples, saved, found=None):
+        self.done += len(samples)
+        self.saved += saved
+        self.found = found
+        self.emit("progress", done=self.done, saved=self.saved, found=self.found, count=self.config["generation"]["count"],
+                  target_saved=self.config["generation"].get("target_saved"))
+
+    def log(self, text):
+        # print() writes the text and the newline separately, lines are put together here
+        with self._cond:
+            lines = (self._partial + text).split("\n")
+            self._partial = lines.pop()
+        for line in lines:
+            self.emit("log", line=line)
+
+    def emit(self, kind, **fields):
+        with self._cond:
+            self._events.append({"seq": self._next_seq, "type": kind, **fields})
+            self._next_seq += 1
+            self._cond.notify_all()
+
+    def wait_events(self, since, timeout=1.0):
+        # events from seq since on, waits for new ones up to timeout. the bool is whether more can come
+        with self._cond:
+            if self._next_seq <= since and self.status not in TERMINAL:
+                self._cond.wait(timeout)
+            first = self._next_seq - len(self._events)
+            events = list(itertools.islice(self._events, max(0, since - first), None))
+            return events, self.status not in TERMINAL or self._next_seq > since + len(events)
+
+class FairGate:
+    # turns on the shared models for the running jobs. whoever waits and had its last turn longest
+    # ago goes next, so a job with big batches can't starve the others. threads of the job holding
+    # the turn (the stages of pipelined mode) join it as long as no other job is waiting
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._owner = None
+        self._depth = 0
+        self._waiting = {}
+        self._last_turn = {}
+        self._turns = itertools.count(1)
+
+    @contextmanager
+    def turn(self, key):
+        with self._cond:
+            if not (self._owner == key and not self._waiting):
+                self._waiting[key] = self._waiting.get(key, 0) + 1
+                while self._owner is not None or self._next() != key:
+                    self._cond.wait()
+                self._waiting[key] -= 1
+                if not self._waiting[key]:
+                    del self._waiting[key]
+                self._owner = key
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._depth -= 1
+                if not self._depth:
+                    self._owner = None
+                    self._last_turn[key] = next(self._turns)
+                    self._cond.notify_all()
+
+    def forget(self, key):
+        with self._cond:
+            self._last_turn.pop(key, None)
+
+    def _next(self):
+        return min(self._waiting, key=lambda k: self._last_turn.get(k, 0))
+
+class _JobBackend:
+    # what a job's pipeline sees of the shared generator or detector: every model call waits for
+    # the job's turn, and the detector gets the job's class map for it
+    def __init__(self, backend, gate, job):
+        self._backend = backend
+        self._gate = gate
+        self._job = job
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def _turn(self):
+        return self._gate.turn(self._job.id) if self._gate is not None else nullcontext()
+
+    def generate(self, prompt, seed=None):
+        with self._turn():
+            return self._backend.generate(prompt, seed)
+
+    def generate_batch(self, prompts, seeds):
+        with self._turn():
+            return self._backend.generate_batch(prompts, seeds)
+
+    def encode_prompts(self, prompts):
+        with self._turn():
+            return self._backend.encode_prompts(prompts)
+
+    def warm_prompt_cache(self, prompts, release_encoders=False):
+        # the text encoders are shared with every later job, they are never released here
+        with self._turn():
+            return self._backend.warm_prompt_cache(prompts)
+
+    def detect(self, image, text_prompt):
+        with self._turn():
+            self._backend.class_map = self._job.config["detection"].get("class_map") or {}
+            return self._backend.detect(image, text_prompt)
+
+    def detect_batch(self, images, text_prompt):
+        with self._turn():
+            self._backend.class_map = self._job.config["detection"].get("class_map") or {}
+            return self._backend.detect_batch(images, text_prompt)
+
+class _JobOutput:
+    # stands in for stdout while the server runs. everything still reaches the terminal, lines
+    # printed by a job's thread also go to that job's event stream. threads the pipeline starts
+    # itself (the stages of pipelined mode) are only matched when a single job is running
+    def __init__(self, stream, server):
+        self.stream = stream
+        self.server = server
+
+    def write(self, text):
+        self.stream.write(text)
+        job = self.server.job_of_thread()
+        if job is not None:
+            job.log(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class ModelServer:
+    def __init__(self, config, host="127.0.0.1", port=8760, max_active_jobs=2):
+        self.config = config
+        self.host = host
+        self.port = port
+        self.max_active_jobs = max(1, int(max_active_jobs))
+        self.generator = None
+        self.detector = None
+        self.gate = None
+        self.strategy = None
+        self.jobs = {}
+        self.queue = []
+        self.active = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._client_turns = {}
+        self._starts = itertools.count(1)
+        self._threads = {}
+
+    @classmethod
+    def from_config(cls, config):
+        server_cfg = config.get("server") or {}
+        return cls(
+            config,
+            host=server_cfg.get("host", "127.0.0.1"),
+            port=server_cfg.get("port", 8760),
+            max_active_jobs=server_cfg.get("max_active_jobs", 2)
+        )
+
+    def load(self):
+        if self.config["project"]["mode"] == "api":
+            raise ValueError("the model server keeps local models loaded, it doesn't run in api mode")
+
+        devices = shard_devices(self.config)
+        if len(devices) > 1:
+            print(f"the model server runs on a single device, using {devices[0]}")
+        self.generator, self.detector = build_backends(
+            self.config,
+            device=devices[0] if devices else None,
+            detector_device=self.config["project"].get("detector_device")
+        )
+
+        # placement is decided once for every job
+        residency = ResidencyManager.from_config(self.generator, self.detector, self.config)
+        residency.generation_phase()
+        if residency.strategy == "resident":
+            residency.detection_phase()
+            self.gate = FairGate()
+        else:
+            # models are moved within a run, two jobs at once would move them under each other
+            print(f"models don't stay on the card together ({residency.strategy}), jobs run one at a time")
+            self.max_active_jobs = 1
+        self.strategy = residency.strategy
+        return self
+
+    def submit(self, spec):
+        unknown = set(spec) - set(JOB_KEYS) - {"resume", "client"}
+        if unknown:
+            raise ValueError(f"unknown job fields: {', '.join(sorted(unknown))}")
+        if not spec.get("output_dir"):
+            raise ValueError("a job needs an output_dir")
+        if not isinstance(spec.get("count", 1), int) or spec.get("count", 1) < 1:
+            raise ValueError("count has to be a positive integer")
+
+        config = copy.deepcopy(self.config)
+        for key, (section, name) in JOB_KEYS.items():
+            if key in spec:
+                config[section][name] = spec[key]
+        config["system"]["residency"] = self.strategy
+        # the recorder of the stage timings is process wide, it can't tell concurrent jobs apart
+        config["instrumentation"] = {**(config.get("instrumentation") or {}), "enabled": False}
+
+        with self.lock:
+            busy = [j for j in self.jobs.values() if j.status in ("queued", "running") and j.output_dir == config["project"]["output_dir"]]
+            if busy:
+                raise ValueError(f"job {busy[0].id} already writes to {busy[0].output_dir}")
+            job = Job(str(next(self._ids)), spec.get("client") or "anonymous", config, resume=bool(spec.get("resume")))
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            print(f"job {job.id} from {job.client} queued: {config['generation']['count']} samples to {job.output_dir}")
+            job.emit("status", status="queued", error=None)
+            self._start_jobs()
+        return job
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job.status != "queued":
+                raise ValueError(f"job {job_id} is {job.status}, only queued jobs can be cancelled")
+            self.queue.remove(job)
+            job.set_status("cancelled")
+        return job
+
+    def info(self):
+        with self.lock:
+            return {
+                "mode": self.config["project"]["mode"],
+                "residency": self.strategy,
+                "max_active_jobs": self.max_active_jobs,
+                "running": list(self.active),
+                "queued": [job.id for job in self.queue]
+            }
+
+    def job_of_thread(self):
+        job = self._threads.get(threading.get_ident())
+        if job is None and len(self.active) == 1:
+            job = next(iter(self.active.values()), None)
+        return job
+
+    def _start_jobs(self):
+        # called with the lock held. the client whose last job started longest ago goes first,
+        # its jobs in the order they came in
+        while self.queue and len(self.active) < self.max_active_jobs:
+            job = min(self.queue, key=lambda j: (self._client_turns.get(j.client, 0), int(j.id)))
+            self.queue.remove(job)
+            self._client_turns[job.client] = next(self._starts)
+            self.active[job.id] = job
+            job.set_status("running")
+            threading.Thread(target=self._run, args=(job,), name=f"job-{job.id}", daemon=True).start()
+
+    def _run(self, job):
+        self._threads[threading.get_ident()] = job
+        try:
+            pipeline = DatasetPipeline(
+                generator=_JobBackend(self.generator, self.gate, job),
+                detector=_JobBackend(self.detector, self.gate, job),
+                config=job.config
+            )
+            pipeline.on_persist = lambda samples, saved: job.persisted(
+                samples, saved, pipeline.yields.found if pipeline.yields is not None else None
+            )
+            generation = job.config["generation"]
+            pipeline.run(generation["prompt"], job.config["detection"]["prompt"], generation["count"], resume=job.resume)
+            job.saved = pipeline.manifest.saved_count()
+            if pipeline.yields is not None:
+                job.found = pipeline.yields.found
+            status, error = "finished", None
+        except Exception as e:
+            print(f"job {job.id} failed: {e}")
+            status, error = "failed", str(e)
+        finally:
+            self._threads.pop(threading.get_ident(), None)
+            if self.gate is not None:
+                self.gate.forget(job.id)
+
+        with self.lock:
+            self.active.pop(job.id, None)
+            job.set_status(status, error)
+            found = f"{job.found}/{job.config['generation']['target_saved']} samples with detections, " if job.found is not None else ""
+            print(f"job {job.id} {status}. {found}{job.saved} samples saved to {job.output_dir}")
+            self._start_jobs()
+
+    def serve_forever(self):
+        server = self
+
+        class Handler(_ServerHandler):
+            pass
+        Handler.model_server = server
+
+        httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        stdout = sys.stdout
+        sys.stdout = _JobOutput(stdout, self)
+        print(f"model server listening on http://{self.host}:{self.port}. up to {self.max_active_jobs} jobs at once")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nstopping the model server. interrupted jobs can be continued with --submit --resume")
+        finally:
+            httpd.server_close()
+            sys.stdout = stdout
+
+class _ServerHandler(BaseHTTPRequestHandler):
+    model_server = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job(self, parts):
+        job = self.model_server.jobs.get(parts[1]) if len(parts) >= 2 else None
+        if job is None:
+            self._send_json(404, {"error": f"no job '{parts[1] if len(parts) >= 2 else ''}'"})
+        return job
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+
+        if parts == ["health"]:
+            self._send_json(200, self.model_server.info())
+        elif parts == ["jobs"]:
+            self._send_json(200, [job.info() for job in list(self.model_server.jobs.values())])
+        elif parts[0] == "jobs" and len(parts) == 2:
+            job = self._job(parts)
+            if job is not None:
+                self._send_json(200, job.info())
+        elif parts[0] == "jobs" and len(parts) == 3 and parts[2] == "events":
+            job = self._job(parts)
+            if job is not None:
+                self._stream(job, int(parse_qs(url.query).get("since", ["0"])[0]))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            spec = json.loads(self.rfile.read(length) or b"{}")
+            job = self.model_server.submit(spec)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        self._send_json(201, job.info())
+
+    def do_DELETE(self):
+        parts = self.path.strip("/").split("/")
+        if parts[0] != "jobs" or len(parts) != 2:
+            self._send_json(404, {"error": "not found"})
+            return
+        job = self._job(parts)
+        if job is None:
+            return
+        try:
+            self._send_json(200, self.model_server.cancel(job.id).info())
+        except ValueError as e:
+            self._send_json(409, {"error": str(e)})
+
+    def _stream(self, job, since):
+        # one json event per line until the job is over, the connection closes after it
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        more = True
+        try:
+            while more:
+                events, more = job.wait_events(since)
+                for event in events:
+                    self.wfile.write((json.dumps(event) + "\n").encode())
+                    since = event["seq"] + 1
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, the job goes on
+            pass
@@ -0,0 +1,97 @@
+import multiprocessing as mp
+import queue
+import time
+
+from src.core.pipeline import DatasetPipeline
+
+def shard_devices(cfg):
+    devices = cfg["project"].get("devices") or []
+    return [devices] if isinstance(devices, str) else list(devices)
+
+def run_sharded(cfg, gen_prompt, det_prompt, count, resume=False):
+    devices = shard_devices(cfg)
+    detector_device = cfg["project"].get("detector_device")
+
+    # the coordinator owns the manifest and the seed schedule, it never loads a model
+    coordinator = DatasetPipeline(generator=None, detector=None, config=cfg)
+    pending = coordinator.prepare(gen_prompt, det_prompt, count, resume)
+    print(f"\nstarting sharded pipeline on {len(devices)} workers: {', '.join(devices)}"
+          f"{f'. detector device: {detector_device}' if detector_device else ''}. master seed: {coordinator.master_seed}")
+
+    # cuda can't be re-initialized in a forked child
+    ctx = mp.get_context("spawn")
+    work = ctx.Queue()
+    results = ctx.Queue()
+    for i in pending:
+        work.put(i)
+    for _ in devices:
+        work.put(None)
+
+    workers = [
+        ctx.Process(
+            target=_shard_worker,
+            args=(shard_id, device, detector_device, cfg, coordinator.master_seed, gen_prompt, det_prompt, count, work, results),
+            name=f"shard-{shard_id}"
+        )
+        for shard_id, device in enumerate(devices)
+    ]
+    for w in workers:
+        w.start()
+
+    stats = []
+    try:
+        while any(w.is_alive() for w in workers) or not results.empty():
+            try:
+                stats.append(results.get(timeout=0.5))
+            except queue.Empty:
+                continue
+    except KeyboardInterrupt:
+        print("\ninterrupted. stopping shard workers...")
+        for w in workers:
+            w.terminate()
+        raise
+    finally:
+        for w in workers:
+            w.join()
+        # shard manifests go into the run manifest even if a worker died, so --resume sees their work
+        coordinator.manifest.merge_shards()
+        coordinator.writer.finalize()
+
+    for w in workers:
+        if w.exitcode != 0:
+            print(f"warning: {w.name} exited with code {w.exitcode}. its unfinished samples can be rerun with --resume")
+
+    for stat in sorted(stats, key=lambda s: s["shard"]):
+        print(f"shard {stat['shard']} ({stat['device']}): {stat['saved']} saved, {stat['empty']} empty, {stat['failed']} failed in {stat['elapsed']:.1f}s")
+
+    counts = coordinator.manifest.load().status_counts()
+    print(f"pipeline finished. {counts.get('saved', 0)}/{count} images saved to {coordinator.output_dir}")
+
+def _shard_worker(shard_id, device, detector_device, cfg, master_seed, gen_prompt, det_prompt, count, work, results):
+    from src.core.factory import build_backends
+
+    start = time.time()
+    gen, det = build_backends(cfg, device=device, detector_device=detector_device)
+    pipeline = DatasetPipeline(generator=gen, detector=det, config=cfg)
+    pipeline.master_seed = master_seed
+    pipeline.manifest = pipeline.manifest.shard(shard_id)
+    pipeline.writer = pipeline.writer.shard(shard_id)
+    if pipeline.raw_store is not None:
+        pipeline.raw_store = pipeline.raw_store.shard(shard_id)
+    if pipeline.metrics is not None:
+        pipeline.metrics = pipeline.metrics.shard(shard_id)
+    if pipeline.dedup is not None:
+        pipeline.dedup = pipeline.dedup.shard(shard_id)
+
+    # indices are pulled from the shared queue as the worker gets free, so faster cards take more of them
+    pipeline.execute(gen_prompt, det_prompt, iter(work.get, None), count)
+
+    counts = pipeline.manifest.status_counts()
+    results.put({
+        "shard": shard_id,
+        "device": device,
+        "saved": counts.get("saved", 0),
+        "empty": counts.get("empty", 0),
+        "failed": counts.get("failed", 0),
+        "elapsed": time.time() - start
+    })
@@ -0,0 +1,85 @@
+import queue
+import threading
+
+# marks the end of a stage's output
+_DONE = object()
+
+class StagedRunner:
+    def __init__(self, queue_size=2, poll_sec=0.1):
+        self.queue_size = queue_size
+        self.poll_sec = poll_sec
+        self.stop = threading.Event()
+        self.errors = []
+
+    def run(self, producer, *stages):
+        # producer is a generator function, every stage takes one item and returns the next one.
+        # stages are chained with bounded queues, so a slow stage blocks the ones before it
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+        threads = [threading.Thread(target=self._produce, args=(producer, queues[0]), name=producer.__name__, daemon=True)]
+        for k, stage in enumerate(stages):
+            q_out = queues[k + 1] if k + 1 < len(stages) else None
+            threads.append(threading.Thread(target=self._consume, args=(stage, queues[k], q_out), name=stage.__name__, daemon=True))
+
+        for t in threads:
+            t.start()
+
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(timeout=self.poll_sec)
+        except KeyboardInterrupt:
+            print("\ninterrupted. stopping pipeline stages...")
+            self.stop.set()
+            for t in threads:
+                t.join()
+            raise
+
+        if self.errors:
+            name, err = self.errors[0]
+            raise RuntimeError(f"pipeline stage '{name}' failed: {err}") from err
+
+    def _fail(self, err):
+        self.errors.append((threading.current_thread().name, err))
+        self.stop.set()
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=self.poll_sec)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=self.poll_sec)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _produce(self, producer, q_out):
+        try:
+            for item in producer():
+                if not self._put(q_out, item):
+                    return
+        except Exception as e:
+            self._fail(e)
+            return
+        self._put(q_out, _DONE)
+
+    def _consume(self, stage, q_in, q_out):
+        try:
+            while True:
+                item = self._get(q_in)
+                if item is _DONE:
+                    break
+                result = stage(item)
+                if q_out is not None and not self._put(q_out, result):
+                    return
+        except Exception as e:
+            self._fail(e)
+            return
+        if q_out is not None:
+            self._put(q_out, _DONE)
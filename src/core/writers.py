@@ -0,0 +1,354 @@
+import copy
+import glob
+import io
+import json
+import os
+import re
+import tarfile
+import time
+from abc import ABC, abstractmethod
+
+from src.core.sample import normalize_format
+from src.utils.formatting import LabelFormatter
+from src.utils.instrumentation import span
+
+# writers are registered by their output.layout, like the backends in factory.py
+WRITERS = {}
+
+def register_writer(layout):
+    def register(builder):
+        WRITERS[layout] = builder
+        return builder
+    return register
+
+class DatasetWriter(ABC):
+    # one writer per process and run: open() before the first sample, close() after the last one.
+    # files and handles stay open in between. finalize() runs once, in the process that owns the run,
+    # and merges whatever the writers of every shard left behind
+    def __init__(self, output_dir, label_format, class_map=None, image_ext="jpg", image_quality=95, part=""):
+        self.output_dir = output_dir
+        self.label_format = label_format
+        self.class_map = class_map or {}
+        self.image_ext = str(image_ext).lower().lstrip(".")
+        self.image_format = normalize_format(self.image_ext)
+        self.image_quality = image_quality
+        # workers of a sharded run write their own parts, e.g. "w0"
+        self.part = part
+
+    def shard(self, shard_id):
+        writer = copy.copy(self)
+        writer.part = f"w{shard_id}"
+        return writer
+
+    def open(self):
+        return self
+
+    @abstractmethod
+    def write(self, sample, width, height) -> dict:
+        # writes one sample, returns the written paths relative to output_dir for the manifest
+        pass
+
+    def close(self):
+        pass
+
+    def finalize(self):
+        pass
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _part_name(self, stem, ext):
+        return f"{stem}-{self.part}.{ext}" if self.part else f"{stem}.{ext}"
+
+    def _image_params(self):
+        return {"quality": self.image_quality} if self.image_format in ("JPEG", "WEBP") else {}
+
+    def _encode_image(self, image):
+        # encoded originals in the output format come back as they are, anything else is encoded once here
+        with span("encode"):
+            buf = io.BytesIO()
+            image.save(buf, format=self.image_format, **self._image_params())
+            return buf.getvalue()
+
+    def _label_text(self, sample, width, height, label_format=None):
+        with span("label", [sample]):
+            return LabelFormatter.render(
+                label_format or self.label_format,
+                sample.boxes,
+                sample.labels,
+                sample.filename,
+                width, height,
+                class_map=self.class_map,
+                image_ext=self.image_ext,
+                class_ids=sample.class_ids
+            )
+
+class FileWriter(DatasetWriter):
+    # the classic layout, images/<name>.<ext> next to labels/<name>.<txt|xml|json>
+    def open(self):
+        os.makedirs(os.path.join(self.output_dir, "images"), exist_ok=True)
+        os.makedirs(os.path.join(self.output_dir, "labels"), exist_ok=True)
+        return self
+
+    def write(self, sample, width, height):
+        paths = {"image": self._write_image(sample)}
+
+        label_path = os.path.join("labels", f"{sample.filename}.{LabelFormatter.EXTENSIONS[self.label_format]}")
+        with open(os.path.join(self.output_dir, label_path), "w") as f:
+            f.write(self._label_text(sample, width, height))
+        paths["label"] = label_path
+        return paths
+
+    def _write_image(self, sample):
+        image_path = os.path.join("images", f"{sample.filename}.{self.image_ext}")
+        with span("encode", [sample]):
+            sample.image.save(
+                os.path.join(self.output_dir, image_path),
+                format=self.image_format,
+                **self._image_params()
+            )
+        return image_path
+
+class CocoWriter(FileWriter):
+    # one coco annotations.json for the whole run. while running, every sample is appended as one
+    # line to labels/coco.part*.jsonl, finalize() streams the parts into annotations.json. the parts
+    # are kept, so a resumed run appends to them and annotations.json is rebuilt at its end
+    ANNOTATIONS = "annotations.json"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._handle = None
+
+    def open(self):
+        super().open()
+        self.part_path = os.path.join("labels", self._part_name("coco.part", "jsonl"))
+        self._handle = open(os.path.join(self.output_dir, self.part_path), "a")
+        return self
+
+    def write(self, sample, width, height):
+        paths = {"image": self._write_image(sample)}
+
+        with span("label", [sample]):
+            annotations = []
+            class_ids = LabelFormatter.class_ids(sample.labels, self.class_map, sample.class_ids)
+            for box, class_id, score in zip(sample.boxes, class_ids, sample.scores):
+                if class_id == -1:
+                    continue
+                x1, y1, x2, y2 = (float(v) for v in box)
+                annotations.append({
+                    "category_id": class_id,
+                    "bbox": [round(x1, 2), round(y1, 2), round(x2 - x1, 2), round(y2 - y1, 2)],
+                    "area": round((x2 - x1) * (y2 - y1), 2),
+                    "iscrowd": 0,
+                    "score": round(float(score), 4)
+                })
+
+            record = {
+                "image": {"id": sample.index + 1, "file_name": f"{sample.filename}.{self.image_ext}", "width": width, "height": height},
+                "annotations": annotations
+            }
+            # one write and a flush per sample, a crash loses at most the line being written
+            self._handle.write(json.dumps(record) + "\n")
+        self._handle.flush()
+        paths["label"] = self.part_path
+        return paths
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def finalize(self):
+        parts = sorted(glob.glob(os.path.join(self.output_dir, "labels", "coco.part*.jsonl")))
+        if not parts:
+            return None
+
+        # first pass only remembers where the latest line of every image is, a sample that ran
+        # again after a resume replaces its older line
+        latest = {}
+        for part in parts:
+            with open(part, "rb") as f:
+                offset = f.tell()
+                for line in iter(f.readline, b""):
+                    try:
+                        image_id = json.loads(line)["image"]["id"]
+                    except (ValueError, KeyError):
+                        # a crash can leave a half-written last line
+                        offset = f.tell()
+                        continue
+                    latest[image_id] = (part, offset)
+                    offset = f.tell()
+
+        categories = {}
+        for name, class_id in self.class_map.items():
+            categories.setdefault(class_id, name)
+
+        out_path = os.path.join(self.output_dir, self.ANNOTATIONS)
+        tmp_path = f"{out_path}.tmp"
+        handles = {part: open(part, "rb") for part in parts}
+        try:
+            def records():
+                for image_id in sorted(latest):
+                    part, offset = latest[image_id]
+                    handles[part].seek(offset)
+                    yield json.loads(handles[part].readline())
+
+            with open(tmp_path, "w") as out:
+                out.write('{"info": ' + json.dumps({"description": "soda", "date_created": time.strftime("%Y-%m-%dT%H:%M:%S")}))
+                out.write(', "categories": ' + json.dumps([{"id": i, "name": n} for i, n in sorted(categories.items())]))
+                out.write(', "images": [')
+                for n, record in enumerate(records()):
+                    out.write((", " if n else "") + json.dumps(record["image"]))
+                out.write('], "annotations": [')
+                annotation_id = 0
+                for record in records():
+                    for annotation in record["annotations"]:
+                        annotation_id += 1
+                        annotation = {"id": annotation_id, "image_id": record["image"]["id"], **annotation}
+                        out.write((", " if annotation_id > 1 else "") + json.dumps(annotation))
+                out.write("]}\n")
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+        os.replace(tmp_path, out_path)
+        print(f"coco annotations for {len(latest)} images written to {out_path}")
+        return out_path
+
+class TarShardWriter(DatasetWriter):
+    # webdataset style shards: shards/shard-00000.tar holds <name>.<image ext> and <name>.<label ext>
+    # pairs, a new shard starts after shard_size samples or shard_max_bytes. every sample gets a
+    # line in shards/index.part*.jsonl with the byte offset and size of its members, so single
+    # samples can be read back without scanning the tar. finalize() merges them into index.jsonl
+    def __init__(self, *args, shard_size=1000, shard_max_bytes=1 << 30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_size = max(1, int(shard_size))
+        self.shard_max_bytes = int(shard_max_bytes)
+        # coco only exists for the whole run, inside a shard every sample gets the per image json
+        self.member_format = self.label_format if self.label_format in LabelFormatter.EXTENSIONS else "json"
+        self.shard_dir = os.path.join(self.output_dir, "shards")
+        self._tar = None
+        self._index = None
+        self._shard_name = None
+        self._shard_samples = 0
+        self._next_shard = 0
+
+    def open(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        # shards are never appended to, a resumed run starts after the highest existing number
+        self._stem = f"shard-{self.part}" if self.part else "shard"
+        pattern = re.compile(rf"^{re.escape(self._stem)}-(\d+)\.tar$")
+        numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.shard_dir)) if m]
+        self._next_shard = max(numbers) + 1 if numbers else 0
+        self._index = open(os.path.join(self.shard_dir, self._part_name("index.part", "jsonl")), "a")
+        return self
+
+    def write(self, sample, width, height):
+        if self._tar is None or self._shard_samples >= self.shard_size or self._tar.offset >= self.shard_max_bytes:
+            self._roll()
+
+        members = {}
+        label_ext = LabelFormatter.EXTENSIONS[self.member_format]
+        for ext, data in (
+            (self.image_ext, self._encode_image(sample.image)),
+            (label_ext, self._label_text(sample, width, height, self.member_format).encode("utf-8"))
+        ):
+            info = tarfile.TarInfo(f"{sample.filename}.{ext}")
+            info.size = len(data)
+            info.mtime = time.time()
+            self._tar.addfile(info, io.BytesIO(data))
+            # the tar offset sits right after the member's data, which is padded to whole blocks
+            padded = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            members[ext] = [self._tar.offset - padded, len(data)]
+
+        self._tar.fileobj.flush()
+        self._shard_samples += 1
+        self._index.write(json.dumps({
+            "key": sample.filename,
+            "index": sample.index,
+            "shard": self._shard_name,
+            "width": width,
+            "height": height,
+            "members": members
+        }) + "\n")
+        self._index.flush()
+        return {"shard": os.path.join("shards", self._shard_name)}
+
+    def _roll(self):
+        self._close_tar()
+        self._shard_name = f"{self._stem}-{self._next_shard:05d}.tar"
+        self._next_shard += 1
+        self._shard_samples = 0
+        self._tar = tarfile.open(os.path.join(self.shard_dir, self._shard_name), "w", format=tarfile.USTAR_FORMAT)
+
+    def _close_tar(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def close(self):
+        self._close_tar()
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def finalize(self):
+        parts = sorted(glob.glob(os.path.join(self.shard_dir, "index.part*.jsonl")))
+        if not parts:
+            return None
+
+        # the latest entry of a sample wins, older copies stay in their shards but aren't indexed
+        latest = {}
+        for part in parts:
+            with open(part, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    latest[entry["key"]] = entry
+
+        out_path = os.path.join(self.shard_dir, "index.jsonl")
+        with open(f"{out_path}.tmp", "w") as out:
+            for entry in sorted(latest.values(), key=lambda e: e["index"]):
+                out.write(json.dumps(entry) + "\n")
+        os.replace(f"{out_path}.tmp", out_path)
+        print(f"{len(latest)} samples indexed in {out_path}")
+        return out_path
+
+def build_writer(config, part=""):
+    output = config["output"]
+    layout = output.get("layout", "files")
+    kwargs = {
+        "output_dir": config["project"]["output_dir"],
+        "label_format": output["format"],
+        "class_map": config["detection"].get("class_map", {}),
+        "image_ext": output.get("image_format", "jpg"),
+        "image_quality": int(output.get("image_quality", 95)),
+        "part": part
+    }
+
+    if output["format"] not in LabelFormatter.EXTENSIONS and output["format"] != "coco":
+        raise ValueError(f"unsupported format: {output['format']}")
+    if layout not in WRITERS:
+        raise ValueError(f"unknown output layout: {layout}. options: {', '.join(WRITERS)}")
+    return WRITERS[layout](output, **kwargs)
+
+@register_writer("files")
+def _file_writer(output, **kwargs):
+    if output["format"] == "coco":
+        return CocoWriter(**kwargs)
+    return FileWriter(**kwargs)
+
+@register_writer("tar")
+def _tar_writer(output, **kwargs):
+    return TarShardWriter(
+        shard_size=output.get("shard_size", 1000),
+        shard_max_bytes=int(float(output.get("shard_max_mb", 1024)) * (1 << 20)),
+        **kwargs
+    )
+
+LAYOUTS = tuple(WRITERS)
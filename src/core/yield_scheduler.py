@@ -0,0 +1,117 @@
+import math
+import random
+import threading
+
+from src.core.manifest import FINISHED
+from src.utils.seeding import derive_seed
+
+class YieldScheduler:
+    # runs until target samples with detections are saved, within max_attempts samples. the share of
+    # samples with detections (the yield) is tracked per prompt combination, and combinations are drawn
+    # by their template weight times their expected yield, so ones that rarely produce detections
+    # get fewer attempts. they are never cut off completely, min_share of the overall yield is kept
+    def __init__(self, template, master_seed, target, max_attempts, prior_strength=4.0, min_share=0.1):
+        self.template = template
+        self.master_seed = master_seed
+        self.target = int(target)
+        self.max_attempts = int(max_attempts)
+        # a combination's yield is pulled towards the overall one until it has a few attempts of its own
+        self.prior_strength = float(prior_strength)
+        self.min_share = float(min_share)
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.hits = {}
+        self.total_attempts = 0
+        self.total_hits = 0
+        self.found = 0
+        self.next_index = 0
+        # index -> combination, a sample keeps its combination once it got one
+        self.assigned = {}
+        self.outstanding = set()
+
+    def load(self, records):
+        # state of a resumed run from its manifest records. new samples continue after the last index
+        for record in records:
+            self.next_index = max(self.next_index, record["index"] + 1)
+            # duplicates were never detected, they don't count as attempts
+            if record["status"] not in FINISHED or record["status"] == "duplicate":
+                continue
+            hit = record["status"] == "saved" and record.get("boxes", 1) > 0
+            self._observe(record.get("combination"), hit)
+            self.found += int(hit)
+        return self
+
+    def done(self):
+        return self.found >= self.target or self.next_index >= self.max_attempts
+
+    def indices(self):
+        # hands out sample indices while the samples in flight are expected to fall short of the target.
+        # ends once they are enough, the caller finishes them and asks again if they weren't
+        while True:
+            with self.lock:
+                if self.done():
+                    return
+                needed = math.ceil((self.target - self.found) / self.overall_yield())
+                if len(self.outstanding) >= needed:
+                    return
+                index = self.next_index
+                self.next_index += 1
+                self.outstanding.add(index)
+            yield index
+
+    def choose(self, index):
+        with self.lock:
+            if index not in self.assigned:
+                # rejection sampling: a draw from the template weights is kept with the probability of its
+                # expected yield. the random state only depends on the master seed and the index
+                rng = random.Random(derive_seed(self.master_seed, index))
+                floor = self.min_share * self.overall_yield()
+                for _ in range(256):
+                    combination = self.template.sample_index(rng)
+                    if rng.random() <= max(self.expected_yield(combination), floor):
+                        break
+                self.assigned[index] = combination
+            return self.assigned[index]
+
+    def accept(self, sample):
+        # called once a sample is detected. false when the target was already reached, the sample is
+        # surplus of the last samples in flight and isn't saved
+        hit = len(sample.boxes) > 0
+        with self.lock:
+            self.outstanding.discard(sample.index)
+            self._observe(sample.combination, hit)
+            if self.found >= self.target:
+                return False
+            self.found += int(hit)
+            return True
+
+    def release(self, index):
+        # a failed sample doesn't say anything about its prompt
+        with self.lock:
+            self.outstanding.discard(index)
+
+    def overall_yield(self):
+        # optimistic before the first results, so the first round doesn't overshoot
+        return (self.total_hits + 1) / (self.total_attempts + 1)
+
+    def expected_yield(self, combination):
+        k = self.prior_strength
+        return (self.hits.get(combination, 0) + k * self.overall_yield()) / (self.attempts.get(combination, 0) + k)
+
+    def report(self, limit=3):
+        lines = [f"yield: {self.found}/{self.target} samples with detections after {self.total_attempts} attempts "
+                 f"({100 * self.total_hits / max(self.total_attempts, 1):.1f}% overall)"]
+        tried = sorted(self.attempts, key=lambda c: (self.hits[c] / self.attempts[c], -self.attempts[c]))
+        if len(tried) > 1:
+            for title, combinations in (("lowest", tried[:limit]), ("highest", tried[::-1][:limit])):
+                lines.append(f"{title} yield prompts:")
+                for c in combinations:
+                    lines.append(f"  {self.hits[c]}/{self.attempts[c]}  {self.template.render(c)}")
+        return lines
+
+    def _observe(self, combination, hit):
+        self.total_attempts += 1
+        self.total_hits += int(hit)
+        if combination is not None:
+            self.attempts[combination] = self.attempts.get(combination, 0) + 1
+            self.hits[combination] = self.hits.get(combination, 0) + int(hit)
@@ -0,0 +1,56 @@
+import hashlib
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+from src.core.base import BaseGenerator, BaseDetector
+from src.core.sample import to_pil
+from src.utils.grounding import resolve_class_ids
+
+# deterministic stand-ins for the models so the pipeline can run on a cpu-only machine
+
+class FakeGenerator(BaseGenerator):
+    def __init__(self, width=512, height=512, latency_sec=0.0):
+        self.width = width
+        self.height = height
+        self.latency_sec = latency_sec
+
+    def generate(self, prompt: str, seed: int = None) -> Image.Image:
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+            
+        rng = random.Random(f"{seed}:{prompt}")
+        image = Image.new("RGB", (self.width, self.height), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(rng.randint(1, 4)):
+            x1, y1 = rng.randrange(self.width // 2), rng.randrange(self.height // 2)
+            x2, y2 = x1 + rng.randrange(16, self.width // 2), y1 + rng.randrange(16, self.height // 2)
+            draw.rectangle((x1, y1, x2, y2), fill=tuple(rng.randrange(256) for _ in range(3)))
+        return image
+
+class FakeDetector(BaseDetector):
+    def __init__(self, max_boxes=3, latency_sec=0.0, class_map=None, min_boxes=0):
+        self.max_boxes = max_boxes
+        # min_boxes == max_boxes gives every image the same number of boxes, e.g. for benchmarks
+        self.min_boxes = min(min_boxes, max_boxes)
+        self.latency_sec = latency_sec
+        self.class_map = class_map or {}
+
+    def detect(self, image, text_prompt: str) -> dict:
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+            
+        image = to_pil(image)
+        w, h = image.size
+        classes = [c.strip() for c in text_prompt.split(".") if c.strip()] or ["object"]
+        
+        # boxes depend only on the pixels, the same image always gets the same labels
+        rng = random.Random(hashlib.md5(image.tobytes()).hexdigest())
+        boxes, scores, labels = [], [], []
+        for _ in range(rng.randint(self.min_boxes, self.max_boxes)):
+            x1, y1 = rng.uniform(0, w * 0.7), rng.uniform(0, h * 0.7)
+            boxes.append([x1, y1, rng.uniform(x1 + 8, w), rng.uniform(y1 + 8, h)])
+            scores.append(rng.uniform(0.3, 0.99))
+            labels.append(rng.choice(classes))
+        return {"boxes": boxes, "scores": scores, "labels": labels, "class_ids": resolve_class_ids(labels, self.class_map)}
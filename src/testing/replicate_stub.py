@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+# local stand-in for the parts of the replicate http api the pipeline uses:
+# model and version predictions, file uploads and output downloads
+class ReplicateStub:
+    def __init__(self, host="127.0.0.1", port=0, latency_sec=0.0, rate_limit_prob=0.0, error_prob=0.0,
+                 image_size=(512, 512), max_boxes=3, seed=0):
+        self.latency_sec = latency_sec
+        self.rate_limit_prob = rate_limit_prob
+        self.error_prob = error_prob
+        self.image_size = image_size
+        self.max_boxes = max_boxes
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.files = {}
+        self.predictions = {}
+        self.request_count = 0
+
+        stub = self
+        class Handler(_StubHandler):
+            pass
+        Handler.stub = stub
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="replicate-stub", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _next_id(self, prefix):
+        with self.lock:
+            return f"{prefix}{next(self.ids):08d}"
+
+    def _roll(self):
+        with self.lock:
+            self.request_count += 1
+            return self.rng.random()
+
+    def store_file(self, data, content_type):
+        file_id = self._next_id("file")
+        self.files[file_id] = (data, content_type)
+        return file_id
+
+    def create_prediction(self, model, version, input_args):
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+
+        if "query" in input_args:
+            output = {"detections": self._detect(input_args)}
+        else:
+            output = [f"{self.base_url}/files/{self._generate(input_args)}"]
+
+        now = datetime.now(timezone.utc).isoformat()
+        prediction_id = self._next_id("pred")
+        prediction = {
+            "id": prediction_id,
+            "model": model or "stub/detector",
+            "version": version or "stub",
+            "status": "succeeded",
+            "input": input_args,
+            "output": output,
+            "error": None,
+            "logs": "",
+            "metrics": {"predict_time": self.latency_sec},
+            "created_at": now,
+            "started_at": now,
+            "completed_at": now,
+            "urls": {
+                "get": f"{self.base_url}/v1/predictions/{prediction_id}",
+                "cancel": f"{self.base_url}/v1/predictions/{prediction_id}/cancel"
+            }
+        }
+        self.predictions[prediction_id] = prediction
+        return prediction
+
+    def _generate(self, input_args):
+        seed = input_args.get("seed") or 0
+        rng = random.Random(f"{seed}:{input_args.get('prompt', '')}")
+        color = tuple(rng.randrange(256) for _ in range(3))
+        buf = BytesIO()
+        Image.new("RGB", self.image_size, color).save(buf, format="JPEG")
+        return self.store_file(buf.getvalue(), "image/jpeg")
+
+    def _detect(self, input_args):
+        image_ref = str(input_args.get("image", ""))
+        data = self._resolve_image(image_ref)
+        w, h = Image.open(BytesIO(data)).size if data else self.image_size
+
+        # boxes are derived from the image content so the same image always gets the same labels
+        rng = random.Random(hashlib.sha1(data or image_ref.encode()).hexdigest())
+        detections = []
+        for _ in range(rng.randint(0, self.max_boxes)):
+            x1, y1 = rng.uniform(0, w * 0.7), rng.uniform(0, h * 0.7)
+            x2, y2 = rng.uniform(x1 + 8, w), rng.uniform(y1 + 8, h)
+            detections.append({
+                "bbox": [round(x1, 2), round(y1, 2), round(x2, 2), round(y2, 2)],
+                "label": input_args.get("query", ""),
+                "confidence": round(rng.uniform(0.3, 0.99), 4)
+            })
+        return detections
+
+    def _resolve_image(self, image_ref):
+        if image_ref.startswith("data:"):
+            import base64
+            return base64.b64decode(image_ref.split(",", 1)[1])
+        file_id = image_ref.rstrip("/").rsplit("/", 1)[-1]
+        entry = self.files.get(file_id)
+        return entry[0] if entry else None
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _injected_failure(self):
+        roll = self.stub._roll()
+        if roll < self.stub.rate_limit_prob:
+            self._send_json(429, {"title": "Too Many Requests", "detail": "request was throttled", "status": 429})
+            return True
+        if roll < self.stub.rate_limit_prob + self.stub.error_prob:
+            self._send_json(500, {"title": "Internal Server Error", "detail": "stub failure", "status": 500})
+            return True
+        return False
+
+    def do_POST(self):
+        body = self._read_body()
+        parts = self.path.strip("/").split("/")
+
+        if parts == ["v1", "files"]:
+            data, content_type = self._parse_upload(body)
+            file_id = self.stub.store_file(data, content_type)
+            self._send_json(201, {
+                "id": file_id,
+                "name": file_id,
+                "content_type": content_type,
+                "size": len(data),
+                "etag": hashlib.md5(data).hexdigest(),
+                "checksums": {},
+                "metadata": {},
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "expires_at": None,
+                "urls": {"get": f"{self.stub.base_url}/files/{file_id}"}
+            })
+            return
+
+        if self._injected_failure():
+            return
+
+        payload = json.loads(body or b"{}")
+        if parts == ["v1", "predictions"]:
+            prediction = self.stub.create_prediction(None, payload.get("version"), payload.get("input", {}))
+        elif len(parts) == 5 and parts[:2] == ["v1", "models"] and parts[4] == "predictions":
+            prediction = self.stub.create_prediction(f"{parts[2]}/{parts[3]}", None, payload.get("input", {}))
+        else:
+            self._send_json(404, {"detail": "not found", "status": 404})
+            return
+        self._send_json(201, prediction)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+
+        if len(parts) == 2 and parts[0] == "files" and parts[1] in self.stub.files:
+            data, content_type = self.stub.files[parts[1]]
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        if len(parts) == 6 and parts[:2] == ["v1", "models"] and parts[4] == "versions":
+            self._send_json(200, {
+                "id": parts[5],
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "cog_version": "stub",
+                "openapi_schema": {}
+            })
+            return
+
+        if len(parts) == 3 and parts[:2] == ["v1", "predictions"] and parts[2] in self.stub.predictions:
+            self._send_json(200, self.stub.predictions[parts[2]])
+            return
+
+        self._send_json(404, {"detail": "not found", "status": 404})
+
+    def _parse_upload(self, body):
+        content_type = self.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/"):
+            return body, content_type or "application/octet-stream"
+
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "content":
+                return part.get_payload(decode=True), part.get_content_type()
+        return b"", "application/octet-stream"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local stub of the replicate api")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every prediction")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="share of predictions answered with 429")
+    parser.add_argument("--error-prob", type=float, default=0.0, help="share of predictions answered with 500")
+    args = parser.parse_args()
+
+    stub = ReplicateStub(args.host, args.port, args.latency, args.rate_limit_prob, args.error_prob)
+    print(f"replicate stub listening on {stub.base_url}. set api.base_url to this address.")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,50 @@
 import os
 import json
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import escape
+
+# label dirs already created in this process, so makedirs doesn't run once per sample
+_created_dirs = set()
+
+def _makedirs_once(path):
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
 
 class LabelFormatter:
+    EXTENSIONS = {"yolo": "txt", "voc": "xml", "json": "json"}
     
     @staticmethod
-    def save(format_type, boxes, labels, filename, output_dir, img_w, img_h, class_map=None):
-        save_path = os.path.join(output_dir, "labels")
-        os.makedirs(save_path, exist_ok=True)
+    def save(format_type, boxes, labels, filename, output_dir, img_w, img_h, class_map=None, image_ext="jpg", class_ids=None):
+        # filename can hold sub dirs, e.g. when labeling a folder tree
+        path = os.path.join(output_dir, "labels", f"{filename}.{LabelFormatter.EXTENSIONS[format_type]}")
+        _makedirs_once(os.path.dirname(path))
+
+        text = LabelFormatter.render(format_type, boxes, labels, filename, img_w, img_h, class_map, image_ext, class_ids)
+        with open(path, "w") as f:
+            f.write(text)
 
-        mapping = class_map or {}
+    @staticmethod
+    def render(format_type, boxes, labels, filename, img_w, img_h, class_map=None, image_ext="jpg", class_ids=None):
+        # label file contents as a string, shared by every dataset writer
+        class_ids = LabelFormatter.class_ids(labels, class_map or {}, class_ids)
 
         if format_type == "yolo":
-            LabelFormatter._save_yolo(boxes, labels, filename, save_path, img_w, img_h, mapping)
+            return LabelFormatter._render_yolo(boxes, class_ids, img_w, img_h)
         elif format_type == "voc":
-            LabelFormatter._save_voc(boxes, labels, filename, save_path, img_w, img_h, mapping)
+            return LabelFormatter._render_voc(boxes, class_ids, filename, img_w, img_h, image_ext)
         elif format_type == "json":
-            LabelFormatter._save_json(boxes, labels, filename, save_path, img_w, img_h, mapping)
+            return LabelFormatter._render_json(boxes, class_ids, filename, img_w, img_h, image_ext)
         else:
             raise ValueError(f"unsupported format: {format_type}")
 
+    @staticmethod
+    def class_ids(labels, class_map, class_ids=None):
+        # ids resolved by the detector are used as they are, label strings are only matched
+        # against class_map for detectors that don't return ids
+        if class_ids is not None:
+            return [int(class_id) for class_id in class_ids]
+        return [LabelFormatter._resolve_class_id(label, class_map) for label in labels]
+
     @staticmethod
     def _resolve_class_id(label, class_map):
         clean_label = str(label).strip()
@@ -34,12 +58,10 @@ class LabelFormatter:
         return -1
 
     @staticmethod
-    def _save_yolo(boxes, labels, filename, save_path, img_w, img_h, class_map):
+    def _render_yolo(boxes, class_ids, img_w, img_h):
         lines = []
         
-        for box, label in zip(boxes, labels):
-            class_id = LabelFormatter._resolve_class_id(label, class_map)
-            
+        for box, class_id in zip(boxes, class_ids):
             if class_id == -1:
                 continue
 
@@ -59,47 +81,52 @@ class LabelFormatter:
             
             lines.append(f"{class_id} {xc:.6f} {yc:.6f} {w:.6f} {h:.6f}")
             
-        with open(os.path.join(save_path, f"{filename}.txt"), "w") as f:
-            f.write("\n".join(lines))
+        return "\n".join(lines)
 
     @staticmethod
-    def _save_voc(boxes, labels, filename, save_path, img_w, img_h, class_map):
-        root = ET.Element("annotation")
-        ET.SubElement(root, "filename").text = f"{filename}.jpg"
-        size = ET.SubElement(root, "size")
-        ET.SubElement(size, "width").text = str(img_w)
-        ET.SubElement(size, "height").text = str(img_h)
-
-        for box, label in zip(boxes, labels):
-            class_id = LabelFormatter._resolve_class_id(label, class_map)
-            
+    def _render_voc(boxes, class_ids, filename, img_w, img_h, image_ext="jpg"):
+        # written out directly, same text as the old ElementTree -> minidom.toprettyxml round trip
+        def text(value):
+            return escape(str(value), {'"': "&quot;"})
+
+        lines = [
+            '<?xml version="1.0" ?>',
+            "<annotation>",
+            f"    <filename>{text(f'{filename}.{image_ext}')}</filename>",
+            "    <size>",
+            f"        <width>{text(img_w)}</width>",
+            f"        <height>{text(img_h)}</height>",
+            "    </size>"
+        ]
+
+        for box, class_id in zip(boxes, class_ids):
             if class_id == -1: continue
 
-            obj = ET.SubElement(root, "object")
-            ET.SubElement(obj, "name").text = str(class_id)
-            
-            bbox = ET.SubElement(obj, "bbox")
-            ET.SubElement(bbox, "xmin").text = str(int(box[0]))
-            ET.SubElement(bbox, "ymin").text = str(int(box[1]))
-            ET.SubElement(bbox, "xmax").text = str(int(box[2]))
-            ET.SubElement(bbox, "ymax").text = str(int(box[3]))
+            lines += [
+                "    <object>",
+                f"        <name>{text(class_id)}</name>",
+                "        <bbox>",
+                f"            <xmin>{int(box[0])}</xmin>",
+                f"            <ymin>{int(box[1])}</ymin>",
+                f"            <xmax>{int(box[2])}</xmax>",
+                f"            <ymax>{int(box[3])}</ymax>",
+                "        </bbox>",
+                "    </object>"
+            ]
 
-        xml_str = minidom.parseString(ET.tostring(root)).toprettyxml(indent="    ")
-        with open(os.path.join(save_path, f"{filename}.xml"), "w") as f:
-            f.write(xml_str)
+        lines.append("</annotation>")
+        return "\n".join(lines) + "\n"
 
     @staticmethod
-    def _save_json(boxes, labels, filename, save_path, img_w, img_h, class_map):
+    def _render_json(boxes, class_ids, filename, img_w, img_h, image_ext="jpg"):
         data = {
-            "image": f"{filename}.jpg",
+            "image": f"{filename}.{image_ext}",
             "width": img_w,
             "height": img_h,
             "annotations": []
         }
         
-        for box, label in zip(boxes, labels):
-            class_id = LabelFormatter._resolve_class_id(label, class_map)
-            
+        for box, class_id in zip(boxes, class_ids):
             if class_id == -1: continue
             
             data["annotations"].append({
@@ -107,5 +134,4 @@ class LabelFormatter:
                 "bbox": [int(x) for x in box]
             })
             
-        with open(os.path.join(save_path, f"{filename}.json"), "w") as f:
-            json.dump(data, f, indent=4)
\ No newline at end of file
+        return json.dumps(data, indent=4)
\ No newline at end of file
@@ -0,0 +1,98 @@
+import numpy as np
+
+# label decoding for grounding dino style detectors, numpy only so it can also run on cached outputs.
+# a detection prompt "helmet . safety vest" is tokenized into something like
+#   [CLS] helmet . safety vest . [SEP]
+# every run of tokens between the '.' separators is one class, multi-token names included
+
+class PromptSpans:
+    def __init__(self, names, spans, class_map=None, tokens=None):
+        self.names = list(names)
+        # (start, end) token range of every class
+        self.spans = [tuple(span) for span in spans]
+        self.tokens = list(tokens) if tokens is not None else None
+        self.class_ids = np.asarray(resolve_class_ids(self.names, class_map or {}), dtype=np.int64)
+
+    @classmethod
+    def from_tokens(cls, token_texts, decode_span, class_map=None):
+        # token_texts holds the decoded text of every prompt token, None for special tokens.
+        # decode_span(start, end) turns a token range back into text, called once per class
+        spans, start = [], None
+        for i, text in enumerate(list(token_texts) + [None]):
+            separator = text is None or text.strip() in (".", "")
+            if separator and start is not None:
+                spans.append((start, i))
+                start = None
+            elif not separator and start is None:
+                start = i
+        names = [decode_span(start, end).replace(" ##", "").strip() for start, end in spans]
+        return cls(names, spans, class_map, tokens=token_texts)
+
+    @classmethod
+    def from_names(cls, names, class_map=None):
+        # detectors without token outputs, every class is one "token"
+        return cls(names, [(k, k + 1) for k in range(len(names))], class_map, tokens=names)
+
+    def to_dict(self):
+        return {"names": self.names, "spans": self.spans, "tokens": self.tokens}
+
+    @classmethod
+    def from_dict(cls, data, class_map=None):
+        # class ids are resolved again, so a changed class_map applies to cached outputs too
+        return cls(data["names"], data["spans"], class_map, tokens=data.get("tokens"))
+
+    def span_scores(self, probs):
+        # (..., tokens) token probabilities -> (..., classes), the best token of every class
+        probs = np.asarray(probs, dtype=np.float32)
+        if not self.spans:
+            return np.zeros(probs.shape[:-1] + (0,), dtype=np.float32)
+        return np.stack([probs[..., start:end].max(axis=-1) for start, end in self.spans], axis=-1)
+
+    def labels(self, classes):
+        # class indices of decode_detections -> (names, class ids), unlabeled boxes (-1) get "" and -1
+        classes = np.asarray(classes, dtype=np.int64)
+        labeled = classes >= 0
+        class_ids = np.full(len(classes), -1, dtype=np.int64)
+        class_ids[labeled] = self.class_ids[classes[labeled]]
+        return [self.names[k] if k >= 0 else "" for k in classes.tolist()], class_ids
+
+def resolve_class_ids(names, class_map):
+    # exact name first, then case insensitive, then the single class fallback of LabelFormatter
+    lowered = {str(k).strip().lower(): v for k, v in class_map.items()}
+    ids = []
+    for name in names:
+        if name in class_map:
+            ids.append(class_map[name])
+        elif name.lower() in lowered:
+            ids.append(lowered[name.lower()])
+        elif len(class_map) == 1:
+            ids.append(next(iter(class_map.values())))
+        else:
+            ids.append(-1)
+    return ids
+
+def decode_detections(pred_boxes, span_scores, threshold, width, height, text_threshold=None):
+    # pred_boxes: (queries, 4) normalized cx, cy, w, h. span_scores: (queries, classes), the best
+    # token probability inside each class span. one keep mask picks boxes, scores and classes.
+    # boxes whose best class scores below text_threshold are kept unlabeled, with class -1
+    pred_boxes = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+    span_scores = np.asarray(span_scores, dtype=np.float64)
+    span_scores = span_scores.reshape(len(pred_boxes), span_scores.shape[-1])
+    if span_scores.shape[1] == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+
+    classes = span_scores.argmax(axis=1)
+    scores = span_scores[np.arange(len(span_scores)), classes]
+    keep = scores > threshold
+    if text_threshold is not None:
+        classes = np.where(scores > text_threshold, classes, -1)
+
+    cx, cy, w, h = pred_boxes[keep].T
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1) * [width, height, width, height]
+    return boxes, scores[keep], classes[keep]
+
+def to_query_boxes(boxes, width, height):
+    # xyxy pixels -> normalized cx, cy, w, h, the box format of the raw detector outputs
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4) / [width, height, width, height]
+    return np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2,
+                     boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]], axis=1)
@@ -0,0 +1,114 @@
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# 64 bit perceptual hashes as python ints. near identical images end up a few bits apart
+
+def _gray(image, width, height):
+    # images still encoded (see EncodedImage) are decoded here without keeping the pixels. jpegs
+    # are decoded at a fraction of their size, the hash only needs a thumbnail
+    if not getattr(image, "is_decoded", True):
+        image = Image.open(BytesIO(image.data))
+        image.draft("L", (width * 2, height * 2))
+    else:
+        image = getattr(image, "image", image)
+    return np.asarray(image.convert("L").resize((width, height), Image.LANCZOS), dtype=np.float32)
+
+@lru_cache(maxsize=4)
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+def _pack(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+def phash(image, hash_size=8, highfreq_factor=4):
+    # low frequencies of the 2d dct of a 32x32 thumbnail, each bit says if one is above their median
+    n = hash_size * highfreq_factor
+    dct = _dct_matrix(n)
+    low = (dct @ _gray(image, n, n) @ dct.T)[:hash_size, :hash_size]
+    return _pack(low > np.median(low))
+
+def dhash(image, hash_size=8):
+    # whether each pixel of a 9x8 thumbnail is brighter than its left neighbour
+    pixels = _gray(image, hash_size + 1, hash_size)
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+HASHES = {"phash": phash, "dhash": dhash}
+
+class HammingIndex:
+    # multi-index hashing: a 64 bit hash is split into chunks, each indexed in a dict of its own.
+    # two hashes at most radius bits apart differ in at most radius // chunks bits in one of their
+    # chunks, so a query only looks at the buckets within that many bits of each of its chunks
+    # instead of at every hash
+    def __init__(self, radius, bits=64, chunks=4):
+        self.radius = int(radius)
+        self.chunk_bits = bits // chunks
+        self.chunks = chunks
+        self.hashes = []
+        self.keys = []
+        self.ids = {}
+        self.tables = [{} for _ in range(chunks)]
+        self.probes = self._probes(self.chunk_bits, self.radius // chunks)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def add(self, value, key):
+        self.remove(key)
+        entry = len(self.hashes)
+        self.hashes.append(value)
+        self.keys.append(key)
+        self.ids[key] = entry
+        for table, chunk in zip(self.tables, self._split(value)):
+            table.setdefault(chunk, []).append(entry)
+
+    def remove(self, key):
+        entry = self.ids.pop(key, None)
+        if entry is None:
+            return
+        for table, chunk in zip(self.tables, self._split(self.hashes[entry])):
+            table[chunk].remove(entry)
+            if not table[chunk]:
+                del table[chunk]
+        self.hashes[entry] = None
+        self.keys[entry] = None
+
+    def query(self, value):
+        # every (distance, key) within radius bits, closest first
+        seen = set()
+        matches = []
+        for table, chunk in zip(self.tables, self._split(value)):
+            for probe in self.probes:
+                for entry in table.get(chunk ^ probe, ()):
+                    if entry in seen:
+                        continue
+                    seen.add(entry)
+                    distance = bin(value ^ self.hashes[entry]).count("1")
+                    if distance <= self.radius:
+                        matches.append((distance, self.keys[entry]))
+        return sorted(matches)
+
+    def _split(self, value):
+        mask = (1 << self.chunk_bits) - 1
+        return [(value >> (k * self.chunk_bits)) & mask for k in range(self.chunks)]
+
+    @staticmethod
+    def _probes(bits, radius):
+        # every xor mask of up to radius set bits
+        probes = [0]
+        frontier = [0]
+        for _ in range(radius):
+            frontier = list({mask | (1 << b) for mask in frontier for b in range(bits) if not mask >> b & 1})
+            probes.extend(frontier)
+        return probes
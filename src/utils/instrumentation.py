@@ -0,0 +1,284 @@
+import collections
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# timing of the pipeline stages. code that wants to be measured wraps itself in span("stage"), which
+# does nothing until a recorder is installed. DatasetPipeline installs one for the length of a run
+
+_recorder = None
+
+def install(recorder):
+    # returns the recorder that was installed before, so it can be put back
+    global _recorder
+    previous, _recorder = _recorder, recorder
+    return previous
+
+@contextmanager
+def span(stage, samples=()):
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+    with recorder.span(stage, samples):
+        yield
+
+def _cuda():
+    # only when something else already imported torch, measuring never loads it
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        return torch
+    return None
+
+class Instrumentation:
+    # records a span per stage call with the samples it covered and the peak vram it reached, and
+    # exports them to <output_dir>/metrics:
+    #   spans.jsonl   one line per span, one line per throughput report
+    #   soda.prom     prometheus textfile (node exporter textfile collector), rewritten on every report
+    # an optional profiler window captures profile_samples samples after profile_start have finished
+    PROFILERS = (None, "torch", "cprofile")
+
+    def __init__(self, output_dir, jsonl=True, prometheus=True, report_every=30.0, window=60.0,
+                 profile=None, profile_start=10, profile_samples=10, part=""):
+        if profile not in self.PROFILERS:
+            raise ValueError(f"unknown profiler '{profile}'. options: torch, cprofile")
+        self.dir = os.path.join(output_dir, "metrics")
+        self.jsonl = jsonl
+        self.prometheus = prometheus
+        self.report_every = float(report_every)
+        # seconds the rolling images/sec looks back
+        self.window = float(window)
+        self.profile = profile
+        self.profile_start = int(profile_start)
+        self.profile_samples = max(1, int(profile_samples))
+        # workers of a sharded run export their own files, e.g. "w0"
+        self.part = part
+        self._reset()
+
+    @classmethod
+    def from_config(cls, output_dir, cfg):
+        return cls(
+            output_dir,
+            jsonl=cfg.get("jsonl", True),
+            prometheus=cfg.get("prometheus", True),
+            report_every=cfg.get("report_every", 30),
+            profile=cfg.get("profile"),
+            profile_start=cfg.get("profile_start", 10),
+            profile_samples=cfg.get("profile_samples", 10)
+        )
+
+    def shard(self, shard_id):
+        metrics = copy.copy(self)
+        metrics.part = f"w{shard_id}"
+        metrics._reset()
+        return metrics
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.durations = collections.defaultdict(list)
+        self.per_image = collections.defaultdict(list)
+        self.peak_vram = {}
+        # open spans of the current thread, only the outermost one resets the vram peak
+        self._depth = threading.local()
+        self.samples_done = 0
+        self._finished = collections.deque()
+        self._handle = None
+        self._start = None
+        self._last_report = None
+        self._profiler = None
+        self._profiled = False
+
+    def open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        if self.jsonl:
+            self._handle = open(os.path.join(self.dir, self._file("spans", "jsonl")), "a")
+        self._start = self._last_report = time.time()
+        self._previous = install(self)
+        return self
+
+    def close(self):
+        install(self._previous)
+        self._stop_profiler()
+        self._write_prometheus()
+        if self._handle is not None:
+            self._handle.write(json.dumps({"type": "summary", "time": time.time(), "stages": self.stats()}) + "\n")
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextmanager
+    def span(self, stage, samples=()):
+        torch = _cuda()
+        depth = getattr(self._depth, "value", 0)
+        if torch is not None and depth == 0:
+            # peaks are per process, in pipelined mode a stage's peak includes whatever overlapped it.
+            # nested spans (transfers inside detect) report the peak since the outer span started
+            torch.cuda.reset_peak_memory_stats()
+        self._depth.value = depth + 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._depth.value = depth
+            duration = time.time() - start
+            peak = torch.cuda.max_memory_allocated() if torch is not None else None
+            indices = [s.index for s in samples]
+            with self.lock:
+                self.durations[stage].append(duration)
+                if indices:
+                    self.per_image[stage].append(duration / len(indices))
+                if peak is not None:
+                    self.peak_vram[stage] = max(self.peak_vram.get(stage, 0), peak)
+                if self._handle is not None:
+                    record = {"type": "span", "stage": stage, "start": round(start, 6), "duration": round(duration, 6), "samples": indices}
+                    if peak is not None:
+                        record["peak_vram"] = peak
+                    self._handle.write(json.dumps(record) + "\n")
+
+    def sample_finished(self, n=1):
+        if self._start is None:
+            # not open, e.g. when relabeling
+            return
+        now = time.time()
+        with self.lock:
+            self.samples_done += n
+            self._finished.append((now, n))
+            while self._finished and self._finished[0][0] < now - self.window:
+                self._finished.popleft()
+        self._update_profiler(self.samples_done)
+
+        if self.report_every and now - self._last_report >= self.report_every:
+            self._last_report = now
+            rate = self.images_per_sec()
+            print(f"throughput: {rate:.2f} img/s over the last {self.window:.0f}s, {self.samples_done} samples done")
+            if self._handle is not None:
+                self._handle.write(json.dumps({"type": "throughput", "time": now, "images_per_sec": rate, "samples": self.samples_done}) + "\n")
+                self._handle.flush()
+            self._write_prometheus()
+
+    def images_per_sec(self):
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - max(now - self.window, self._start), 1e-9)
+            return sum(n for t, n in self._finished if t >= now - self.window) / elapsed
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for stage, durations in self.durations.items():
+                values = np.asarray(durations)
+                per_image = np.asarray(self.per_image.get(stage) or durations)
+                stats[stage] = {
+                    "calls": len(values),
+                    "total": float(values.sum()),
+                    "p50": float(np.percentile(values, 50)),
+                    "p95": float(np.percentile(values, 95)),
+                    "per_image_p50": float(np.percentile(per_image, 50)),
+                    "peak_vram": self.peak_vram.get(stage)
+                }
+            return stats
+
+    def summary(self):
+        # table of every stage, slowest first
+        stats = self.stats()
+        if not stats:
+            return ""
+        elapsed = max(time.time() - self._start, 1e-9)
+        lines = [f"{'stage':<10} {'calls':>7} {'total s':>9} {'share':>6} {'p50 ms':>9} {'p95 ms':>9} {'ms/img':>9} {'peak vram':>10}"]
+        for stage, s in sorted(stats.items(), key=lambda item: -item[1]["total"]):
+            vram = f"{s['peak_vram'] / 1024 ** 3:.2f}GB" if s["peak_vram"] is not None else "-"
+            lines.append(f"{stage:<10} {s['calls']:>7} {s['total']:>9.1f} {100 * s['total'] / elapsed:>5.0f}% "
+                         f"{1000 * s['p50']:>9.1f} {1000 * s['p95']:>9.1f} {1000 * s['per_image_p50']:>9.1f} {vram:>10}")
+        lines.append(f"{self.samples_done} samples in {elapsed:.1f}s, {self.samples_done / elapsed:.2f} img/s")
+        if sum(s["total"] for s in stats.values()) > elapsed:
+            lines.append("stages overlapped (pipelined mode or nested spans), their shares add up to more than 100%")
+        return "\n".join(lines)
+
+    def _write_prometheus(self):
+        if not self.prometheus or self._start is None:
+            return
+        stats = self.stats()
+        shard = f',shard="{self.part}"' if self.part else ""
+        lines = [
+            "# HELP soda_stage_seconds duration of pipeline stage calls",
+            "# TYPE soda_stage_seconds summary"
+        ]
+        for stage, s in stats.items():
+            labels = f'stage="{stage}"{shard}'
+            lines.append(f'soda_stage_seconds{{{labels},quantile="0.5"}} {s["p50"]:.6f}')
+            lines.append(f'soda_stage_seconds{{{labels},quantile="0.95"}} {s["p95"]:.6f}')
+            lines.append(f"soda_stage_seconds_sum{{{labels}}} {s['total']:.6f}")
+            lines.append(f"soda_stage_seconds_count{{{labels}}} {s['calls']}")
+        lines += ["# HELP soda_stage_peak_vram_bytes peak allocated cuda memory during a stage", "# TYPE soda_stage_peak_vram_bytes gauge"]
+        for stage, s in stats.items():
+            if s["peak_vram"] is not None:
+                lines.append(f'soda_stage_peak_vram_bytes{{stage="{stage}"{shard}}} {s["peak_vram"]}')
+        labels = f"{{{shard[1:]}}}" if shard else ""
+        lines += [
+            "# HELP soda_samples_total samples finished by the pipeline",
+            "# TYPE soda_samples_total counter",
+            f"soda_samples_total{labels} {self.samples_done}",
+            "# HELP soda_images_per_second rolling throughput",
+            "# TYPE soda_images_per_second gauge",
+            f"soda_images_per_second{labels} {self.images_per_sec():.4f}"
+        ]
+        # written next to the final name and renamed, the collector never reads half a file
+        path = os.path.join(self.dir, self._file("soda", "prom"))
+        with open(f"{path}.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+    def _file(self, stem, ext):
+        return f"{stem}.{self.part}.{ext}" if self.part else f"{stem}.{ext}"
+
+    def _update_profiler(self, after):
+        if self.profile is None:
+            return
+        if self._profiler is None and not self._profiled and after >= self.profile_start:
+            self._start_profiler()
+        elif self._profiler is not None and after >= self.profile_start + self.profile_samples:
+            self._stop_profiler()
+
+    def _start_profiler(self):
+        if self.profile == "torch":
+            import torch
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._profiler.start()
+        else:
+            import cProfile
+
+            # cprofile only sees the thread it was started in, the one finishing samples: the main
+            # thread in serial mode, the persist stage in pipelined mode
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._profiled = True
+        print(f"{self.profile} profiler started after {self.samples_done} samples")
+
+    def _stop_profiler(self):
+        if self._profiler is None:
+            return
+        if self.profile == "torch":
+            self._profiler.stop()
+            path = os.path.join(self.dir, self._file("trace", "json"))
+            self._profiler.export_chrome_trace(path)
+        else:
+            self._profiler.disable()
+            path = os.path.join(self.dir, self._file("profile", "pstats"))
+            self._profiler.dump_stats(path)
+        self._profiler = None
+        print(f"profile of the capture window written to {path}")
@@ -53,4 +53,195 @@ def nms(boxes, scores, iou_threshold=0.3):
         inds = np.where(ovr <= iou_threshold)[0]
         order = order[inds + 1]
 
-    return keep
\ No newline at end of file
+    return keep
+
+# groups up to this size go through the n x n iou matrix. larger groups lose more boxes per
+# greedy step than the matrix saves, so they use the shrinking loop
+MATRIX_NMS_LIMIT = 256
+
+def _intersection_union(a, b):
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    ax1, ay1, ax2, ay2 = (a[:, k, None] for k in range(4))
+    bx1, by1, bx2, by2 = (np.ascontiguousarray(b[:, k]) for k in range(4))
+
+    # one coordinate at a time and in place, (n, m, 2) temporaries are several times slower
+    w = np.minimum(ax2, bx2)
+    w -= np.maximum(ax1, bx1)
+    np.maximum(w, 0.0, out=w)
+    inter = np.minimum(ay2, by2)
+    inter -= np.maximum(ay1, by1)
+    np.maximum(inter, 0.0, out=inter)
+    inter *= w
+
+    union = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1)
+    union -= inter
+    return inter, union
+
+def box_iou(a, b):
+    inter, union = _intersection_union(a, b)
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+def batched_nms(boxes, scores, classes=None, image_ids=None, iou_threshold=0.3, score_threshold=0.0,
+                method="hard", sigma=0.5):
+    # class and image aware nms: boxes only suppress boxes of the same (image, class) group.
+    # iou_threshold and score_threshold can be scalars or one value per box. returns kept
+    # indices sorted by score and their scores, which soft-nms decays
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    n = len(boxes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    iou_thr = np.broadcast_to(np.asarray(iou_threshold, dtype=np.float64), (n,))
+    score_thr = np.broadcast_to(np.asarray(score_threshold, dtype=np.float64), (n,))
+
+    groups = np.zeros(n, dtype=np.int64)
+    for key in (image_ids, classes):
+        if key is not None:
+            _, inverse = np.unique(np.asarray(key), return_inverse=True)
+            groups = groups * (inverse.max() + 1) + inverse.reshape(-1)
+
+    candidates = np.flatnonzero(np.nan_to_num(scores, nan=-np.inf) >= score_thr)
+    # candidates sorted by group, and by score inside every group
+    order = candidates[np.lexsort((-scores[candidates], groups[candidates]))]
+    starts = np.flatnonzero(np.diff(groups[order], prepend=-1))
+    ends = np.append(starts[1:], len(order))
+
+    if method not in ("hard", "soft", "gaussian", "linear"):
+        raise ValueError(f"unknown nms method: {method}")
+
+    keep, kept_scores = [], []
+    for start, end in zip(starts, ends):
+        idx = order[start:end]
+        if method == "hard":
+            kept = idx[_hard_nms(boxes[idx], iou_thr[idx])]
+            keep.append(kept)
+            kept_scores.append(scores[kept])
+        else:
+            kept, decayed = _soft_nms(boxes[idx], scores[idx], iou_thr[idx], score_thr[idx], sigma, linear=method == "linear")
+            keep.append(idx[kept])
+            kept_scores.append(decayed)
+
+    if not keep:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    keep = np.concatenate(keep)
+    kept_scores = np.concatenate(kept_scores)
+    by_score = np.argsort(-kept_scores, kind="stable")
+    return keep[by_score], kept_scores[by_score]
+
+def _hard_nms(boxes, iou_thr):
+    # boxes are sorted by score. returns positions of the kept ones
+    n = len(boxes)
+    if n <= 1:
+        return np.arange(n)
+
+    if n <= MATRIX_NMS_LIMIT:
+        # cluster-nms: box j is dropped if a kept, higher scored box overlaps it. starting from
+        # "keep everything" and re-applying that rule converges to exactly the greedy result,
+        # with every step being one vectorized pass over the upper triangle of the iou matrix
+        inter, union = _intersection_union(boxes, boxes)
+        union *= iou_thr[:, None]
+        suppresses = inter > union
+        suppresses[np.tril_indices(n)] = False
+        keep = np.ones(n, dtype=bool)
+        while True:
+            new_keep = ~(suppresses & keep[:, None]).any(axis=0)
+            if np.array_equal(new_keep, keep):
+                return np.flatnonzero(keep)
+            keep = new_keep
+
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.arange(n)
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        h = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = w * h
+        ovr = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-12)
+        order = rest[ovr <= iou_thr[i]]
+    return np.asarray(keep, dtype=np.int64)
+
+def _soft_nms(boxes, scores, iou_thr, score_thr, sigma, linear=False):
+    work = scores.astype(np.float64).copy()
+    remaining = np.arange(len(boxes))
+    keep, kept_scores = [], []
+    while remaining.size > 0:
+        top = np.argmax(work[remaining])
+        i = remaining[top]
+        keep.append(i)
+        kept_scores.append(work[i])
+        remaining = np.delete(remaining, top)
+        if remaining.size == 0:
+            break
+
+        ovr = box_iou(boxes[i], boxes[remaining])[0]
+        if linear:
+            decay = np.where(ovr > iou_thr[i], 1.0 - ovr, 1.0)
+        else:
+            decay = np.exp(-(ovr ** 2) / sigma)
+        work[remaining] *= decay
+        remaining = remaining[work[remaining] >= score_thr[remaining]]
+    return np.asarray(keep, dtype=np.int64), np.asarray(kept_scores)
+
+def filter_detections(batch_results, nms_cfg=None):
+    # runs nms over the detections of a whole batch of images at once, using the per class
+    # thresholds of detection.nms in config. returns one dict of numpy arrays per image
+    nms_cfg = nms_cfg or {}
+    per_class = nms_cfg.get("per_class") or {}
+
+    # detectors that resolve class ids return them next to the label strings
+    with_ids = bool(batch_results) and all(results.get("class_ids") is not None for results in batch_results)
+
+    boxes, scores, labels, class_ids, image_ids = [], [], [], [], []
+    for b, results in enumerate(batch_results):
+        n = len(results["boxes"])
+        boxes.extend(results["boxes"])
+        scores.extend(results["scores"])
+        labels.extend(results["labels"])
+        if with_ids:
+            class_ids.extend(results["class_ids"])
+        image_ids.extend([b] * n)
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    labels = np.asarray([str(label) for label in labels], dtype=object)
+    class_ids = np.asarray(class_ids, dtype=np.int64) if with_ids else None
+    image_ids = np.asarray(image_ids, dtype=np.int64)
+
+    iou_thr = np.full(len(boxes), float(nms_cfg.get("iou_threshold", 0.3)))
+    score_thr = np.full(len(boxes), float(nms_cfg.get("score_threshold", 0.0)))
+    for name, thresholds in per_class.items():
+        mask = labels == name
+        if "iou_threshold" in thresholds:
+            iou_thr[mask] = thresholds["iou_threshold"]
+        if "score_threshold" in thresholds:
+            score_thr[mask] = thresholds["score_threshold"]
+
+    keep, kept_scores = batched_nms(
+        boxes, scores,
+        classes=None if nms_cfg.get("class_agnostic", False) else (class_ids if with_ids else labels),
+        image_ids=image_ids,
+        iou_threshold=iou_thr,
+        score_threshold=score_thr,
+        method=nms_cfg.get("method", "hard"),
+        sigma=nms_cfg.get("soft_sigma", 0.5)
+    )
+
+    filtered = []
+    kept_images = image_ids[keep]
+    for b in range(len(batch_results)):
+        sel = kept_images == b
+        idx = keep[sel]
+        filtered.append({
+            "boxes": boxes[idx],
+            "scores": kept_scores[sel],
+            "labels": labels[idx],
+            "class_ids": class_ids[idx] if with_ids else None,
+            "indices": idx - (np.searchsorted(image_ids, b) if len(image_ids) else 0)
+        })
+    return filtered
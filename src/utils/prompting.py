@@ -1,16 +1,237 @@
 import random
 import re
+from functools import lru_cache
 
-def process_wildcards(text: str) -> str:
-    # regex to find patterns like {option1|option2|option3}
-    pattern = r"\{([^{}]+)\}"
-    
-    def replace_match(match):
-        # get the content (e.g red|green|blue)
-        options = match.group(1).split('|')
-        return random.choice(options).strip()
-    
-    while re.search(pattern, text):
-        text = re.sub(pattern, replace_match, text)
-    
-    return text
\ No newline at end of file
+# template syntax:
+#   {a|b|c}            one of the options, options can hold further groups: {a {x|y}|b}
+#   {red::3|blue}      option weights for random sampling, default 1, must be above 0
+#   {$color=red|blue}  named group, {$color} repeats whatever the group picked
+
+_WEIGHT = re.compile(r"::\s*(\d+(?:\.\d+)?)\s*$")
+_NAME = re.compile(r"\$(\w+)\s*(=)?")
+
+class _Text:
+    def __init__(self, text):
+        self.text = text
+        self.count = 1
+
+    def render(self, index, bindings):
+        return self.text
+
+    def sample(self, rng):
+        return 0
+
+class _Ref:
+    def __init__(self, name):
+        self.name = name
+        self.count = 1
+
+    def render(self, index, bindings):
+        return bindings.get(self.name, "")
+
+    def sample(self, rng):
+        return 0
+
+class _Seq:
+    def __init__(self, parts):
+        self.parts = parts
+        self.count = 1
+        for part in parts:
+            self.count *= part.count
+
+    def render(self, index, bindings):
+        # the index is read as a mixed radix number, one digit per part
+        out = []
+        for part in self.parts:
+            index, sub = divmod(index, part.count)
+            out.append(part.render(sub, bindings))
+        return "".join(out)
+
+    def sample(self, rng):
+        index, stride = 0, 1
+        for part in self.parts:
+            index += part.sample(rng) * stride
+            stride *= part.count
+        return index
+
+class _Choice:
+    def __init__(self, options, weights, name=None):
+        self.options = options
+        self.weights = weights
+        self.name = name
+        self.count = sum(option.count for option in options)
+
+        self.offsets = []
+        offset = 0
+        for option in options:
+            self.offsets.append(offset)
+            offset += option.count
+
+    def render(self, index, bindings):
+        for option, offset in zip(self.options, self.offsets):
+            if index < offset + option.count:
+                text = option.render(index - offset, bindings).strip()
+                if self.name:
+                    bindings[self.name] = text
+                return text
+        raise IndexError(index)
+
+    def sample(self, rng):
+        k = rng.choices(range(len(self.options)), weights=self.weights)[0] if len(self.options) > 1 else 0
+        return self.offsets[k] + self.options[k].sample(rng)
+
+    def probabilities(self):
+        total = sum(self.weights)
+        return [w / total for w in self.weights]
+
+class PromptTemplate:
+    def __init__(self, text: str):
+        self.text = text
+        self.names = set()
+        self.root, _ = self._parse(text, 0, top=True)
+
+    def count(self) -> int:
+        # number of distinct combinations of choices
+        return self.root.count
+
+    def render(self, index: int) -> str:
+        if not 0 <= index < self.root.count:
+            raise IndexError(f"combination {index} out of range, template has {self.root.count}")
+        return self.root.render(index, {})
+
+    def enumerate(self):
+        for index in range(self.root.count):
+            yield self.root.render(index, {})
+
+    def sample_index(self, rng=None) -> int:
+        return self.root.sample(rng or random)
+
+    def sample(self, rng=None) -> str:
+        return self.render(self.sample_index(rng))
+
+    def probability(self, index: int) -> float:
+        # chance of a combination under weighted random sampling
+        return _probability(self.root, index)
+
+    def round_robin(self, count: int) -> list:
+        return [i % self.root.count for i in range(count)]
+
+    def stratified(self, count: int, rng=None) -> list:
+        # every combination gets its weighted share of count (largest remainder rounding),
+        # then the order is shuffled so no combination is bunched up at the start or the end
+        rng = rng or random
+        total = self.root.count
+        if total > count * 4:
+            # far more combinations than samples, shares would round to zero. weighted draws
+            # without repeats until every sample has a distinct combination. heavy weights can leave
+            # too few likely combinations, after enough draws the rest is filled with repeats
+            picked = set()
+            draws = []
+            for _ in range(count * 20):
+                if len(picked) >= count:
+                    break
+                index = self.sample_index(rng)
+                picked.add(index)
+                draws.append(index)
+            schedule = sorted(picked)
+            schedule += draws[:count - len(schedule)]
+        else:
+            shares = [count * self.probability(i) for i in range(total)]
+            schedule_counts = [int(share) for share in shares]
+            remainders = sorted(range(total), key=lambda i: shares[i] - schedule_counts[i], reverse=True)
+            for i in remainders[:count - sum(schedule_counts)]:
+                schedule_counts[i] += 1
+            schedule = [i for i, n in enumerate(schedule_counts) for _ in range(n)]
+        rng.shuffle(schedule)
+        return schedule
+
+    def schedule(self, mode: str, count: int, rng=None) -> list:
+        if mode == "round_robin":
+            return self.round_robin(count)
+        if mode == "stratified":
+            return self.stratified(count, rng)
+        if mode == "random":
+            rng = rng or random
+            return [self.sample_index(rng) for _ in range(count)]
+        raise ValueError(f"unknown prompt sampling mode: {mode}")
+
+    def _parse(self, text, pos, top=False):
+        # parses a sequence up to the next '|' or '}' of the enclosing group
+        parts, buf = [], []
+        while pos < len(text):
+            ch = text[pos]
+            if ch == "{":
+                if buf:
+                    parts.append(_Text("".join(buf)))
+                    buf = []
+                node, pos = self._parse_group(text, pos + 1)
+                parts.append(node)
+                continue
+            if not top and ch in "|}":
+                break
+            buf.append(ch)
+            pos += 1
+        if buf:
+            parts.append(_Text("".join(buf)))
+        return _Seq(parts), pos
+
+    def _parse_group(self, text, pos):
+        name = None
+        match = _NAME.match(text, pos)
+        if match:
+            name = match.group(1)
+            if not match.group(2):
+                # {$name} refers back to a named group
+                close = text.find("}", match.end())
+                if close == -1 or text[match.end():close].strip():
+                    raise ValueError(f"malformed variable reference at position {pos} in prompt")
+                if name not in self.names:
+                    raise ValueError(f"variable '${name}' is used before it is defined")
+                return _Ref(name), close + 1
+            pos = match.end()
+
+        options, weights = [], []
+        while True:
+            option, pos = self._parse(text, pos)
+            if pos >= len(text):
+                raise ValueError("unclosed '{' in prompt")
+            weight = 1.0
+            last = option.parts[-1] if option.parts else None
+            if isinstance(last, _Text):
+                found = _WEIGHT.search(last.text)
+                if found:
+                    weight = float(found.group(1))
+                    if weight <= 0:
+                        raise ValueError(f"option weight must be above 0, got '{found.group(0).strip()}' in prompt")
+                    last.text = last.text[:found.start()]
+            options.append(option)
+            weights.append(weight)
+            if text[pos] == "}":
+                break
+            pos += 1
+
+        if name:
+            self.names.add(name)
+        return _Choice(options, weights, name), pos + 1
+
+def _probability(node, index):
+    if isinstance(node, _Seq):
+        p = 1.0
+        for part in node.parts:
+            index, sub = divmod(index, part.count)
+            p *= _probability(part, sub)
+        return p
+    if isinstance(node, _Choice):
+        probs = node.probabilities()
+        for k, (option, offset) in enumerate(zip(node.options, node.offsets)):
+            if index < offset + option.count:
+                return probs[k] * _probability(option, index - offset)
+    return 1.0
+
+@lru_cache(maxsize=64)
+def compile_template(text: str) -> PromptTemplate:
+    return PromptTemplate(text)
+
+def process_wildcards(text: str, rng=None) -> str:
+    # picks one option of every {option1|option2|option3} group
+    return compile_template(text).sample(rng)
@@ -0,0 +1,30 @@
+import random
+import threading
+import time
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        # rate: tokens per second, burst: bucket size. a rate of 0 or less disables limiting
+        self.rate = float(rate or 0)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1.0):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    # exponential backoff with full jitter, attempt starts from 0
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,10 @@
+import hashlib
+import random
+
+def derive_seed(master_seed: int, index: int) -> int:
+    # seed of a sample depends only on the master seed and its index, not on what ran before it
+    digest = hashlib.blake2b(f"{master_seed}:{index}".encode(), digest_size=4).digest()
+    return int.from_bytes(digest, "little")
+
+def new_master_seed() -> int:
+    return random.randint(0, 2**32 - 1)
@@ -0,0 +1,75 @@
+import copy
+import os
+
+import pytest
+import yaml
+
+from src.core.factory import build_backends
+from src.core.manifest import RunManifest
+from src.core.pipeline import DatasetPipeline
+
+# end to end runs on the cpu stand-ins: the fake backends and the local replicate stub
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+def fake_config(output_dir, count=24):
+    with open(CONFIG, "r") as f:
+        cfg = yaml.safe_load(f)
+    cfg["project"].update({"mode": "fake", "devices": None, "detector_device": None, "output_dir": str(output_dir)})
+    cfg["generation"].update({"seed": 1234, "count": count, "target_saved": None, "batch_size": 4})
+    cfg["generation"]["params"].update({"width": 64, "height": 64})
+    cfg["system"].update({"optimize_gpu": False, "pipelined": False, "save_empty_images": False})
+    cfg["fake"] = {"generation_latency": 0.0, "detection_latency": 0.0, "min_boxes": 0, "max_boxes": 3}
+    return cfg
+
+def run(cfg):
+    gen, det = build_backends(cfg)
+    pipeline = DatasetPipeline(generator=gen, detector=det, config=cfg)
+    pipeline.run(cfg["generation"]["prompt"], cfg["detection"]["prompt"], cfg["generation"]["count"])
+    return pipeline
+
+def outputs(output_dir):
+    # what a run produced: manifest status, prompt and seed of every sample, and every label file
+    records = RunManifest(output_dir).load().samples
+    samples = {i: (r["status"], r["prompt"], r["seed"]) for i, r in records.items()}
+    labels = {}
+    for name in sorted(os.listdir(os.path.join(output_dir, "labels"))):
+        with open(os.path.join(output_dir, "labels", name)) as f:
+            labels[name] = f.read()
+    return samples, labels
+
+def test_pipelined_matches_serial(tmp_path):
+    serial = fake_config(tmp_path / "serial")
+    pipelined = copy.deepcopy(serial)
+    pipelined["project"]["output_dir"] = str(tmp_path / "pipelined")
+    pipelined["system"]["pipelined"] = True
+
+    run(serial)
+    run(pipelined)
+
+    serial_samples, serial_labels = outputs(serial["project"]["output_dir"])
+    assert len(serial_samples) == serial["generation"]["count"]
+    assert serial_labels
+    assert outputs(pipelined["project"]["output_dir"]) == (serial_samples, serial_labels)
+
+def test_api_mode_against_stub(tmp_path, monkeypatch):
+    pytest.importorskip("replicate")
+    from src.testing.replicate_stub import ReplicateStub
+
+    monkeypatch.setenv("REPLICATE_API_TOKEN", "stub")
+    # every fifth prediction is throttled or fails, the client retries them
+    with ReplicateStub(image_size=(64, 64), rate_limit_prob=0.1, error_prob=0.1, seed=1) as stub:
+        cfg = fake_config(tmp_path / "api", count=12)
+        cfg["project"]["mode"] = "api"
+        cfg["detection"]["prompt"] = "thread"
+        cfg["api"].update({"base_url": stub.base_url, "requests_per_second": 0, "backoff_base": 0.01, "backoff_max": 0.05})
+        cfg["system"]["save_empty_images"] = True
+        run(cfg)
+
+    samples, labels = outputs(cfg["project"]["output_dir"])
+    assert sorted(samples) == list(range(12))
+    assert all(status == "saved" for status, _, _ in samples.values())
+    assert len(labels) == 12
+    # api mode detects a single class, every box gets its id
+    class_id = cfg["detection"]["class_map"]["thread"]
+    assert all(line.split()[0] == str(class_id) for text in labels.values() for line in text.splitlines())